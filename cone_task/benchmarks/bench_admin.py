@@ -0,0 +1,39 @@
+"""
+    任务管理后台列表页: number个任务, 其中每children个任务挂在同一个父任务下, 统计列表页的SQL条数和平均耗时
+    python benchmarks/bench_admin.py [number] [children] [repeat]
+"""
+import sys
+import time
+from common import setup_django, create_queue
+
+
+def main(number=50000, children=10, repeat=10):
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import Client
+    from task_system import models
+    from task_system.admin import TaskParentFilter
+
+    queue = create_queue()
+    category = models.Category.objects.create(name='bench')
+    parents = models.Task.objects.bulk_create(
+        models.Task(name=f'parent-{i}', category=category, queue=queue) for i in range(number // children))
+    models.Task.objects.bulk_create(
+        models.Task(name=f'task-{i}', category=category, queue=queue, parent=parents[i % len(parents)])
+        for i in range(number - len(parents)))
+    client = Client()
+    client.force_login(User.objects.create_superuser('bench', password='bench'))
+    for name, params in (('list', {}), ('other parents', {'parent': TaskParentFilter.other[0]})):
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+            client.get('/admin/task_system/task/', params)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            client.get('/admin/task_system/task/', params)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f'{name:<16} {len(queries):>4} queries (first load) {elapsed * 1000:>8.1f} ms/page')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:4]))
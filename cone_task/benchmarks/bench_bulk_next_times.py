@@ -0,0 +1,47 @@
+"""
+    批量重新计算next_start_time: 逐个generate_next_task vs Task.bulk_generate_next_task
+    python benchmarks/bench_bulk_next_times.py [tasks]
+"""
+import sys
+import time
+from datetime import timedelta
+from common import setup_django
+
+
+def main(number=100000):
+    setup_django()
+    from django.utils import timezone
+    from task_system import models
+    from task_system.schedule import bulk
+    from task_system.schedule.times import to_schedule_time, from_schedule_time
+
+    category = models.Category.objects.create(name='bench')
+    interval = models.Schedule.objects.create(schedule_type='interval', config={'interval': 10, 'period': 'minutes'})
+    timing = models.Schedule.objects.create(schedule_type='timing', config={'type': 'DAY', 'DAY': {'time': '09:00'}})
+    now = timezone.now()
+    models.Task.objects.bulk_create([
+        models.Task(name=f'task-{i}', category=category, schedule=interval if i % 2 else timing,
+                    last_run_at=now - timedelta(seconds=i)) for i in range(number)
+    ], batch_size=1000)
+    tasks = list(models.Task.objects.select_related('schedule'))
+
+    for use_numpy in (False, True) if bulk.np is not None else (False,):
+        start = time.perf_counter()
+        bulk.bulk_next_times(tasks, now, use_numpy=use_numpy)
+        print(f'compute only, numpy={use_numpy}: {time.perf_counter() - start:.2f}s')
+
+    start = time.perf_counter()
+    models.Task.bulk_generate_next_task(tasks, now)
+    print(f'bulk_generate_next_task: {time.perf_counter() - start:.2f}s')
+
+    start = time.perf_counter()
+    # 等价于逐个generate_next_task: 每个任务单独计算并save一次
+    for task in tasks:
+        next_time = task.schedule.get_next_time(to_schedule_time(task.last_run_at), task.is_rigorous)
+        task.next_start_time = from_schedule_time(next_time)
+        task.save(update_fields=('next_start_time', 'enabled'))
+    print(f'generate_next_task per row: {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
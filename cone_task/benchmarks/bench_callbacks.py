@@ -0,0 +1,45 @@
+"""
+    回调引擎:
+    - 解析: 每次import_string与LRU缓存的resolve对比;
+    - 提交: number个耗时delay秒的回调, 对比在上报路径中直接执行与提交到线程池/进程池, 统计提交方的耗时和全部完成的耗时
+    python benchmarks/bench_callbacks.py [number] [delay] [workers]
+"""
+import sys
+import time
+from common import setup_django, timeit, report
+
+
+def sleep_callback(task, status):
+    time.sleep(task['delay'])
+
+
+def main(number=200, delay=0.01, workers=8):
+    setup_django()
+    from django.utils.module_loading import import_string
+    from task_system import callbacks
+
+    path = 'bench_callbacks.sleep_callback'
+    report('import_string', timeit(lambda: import_string(path), 100000), 100000)
+    report('resolve (lru)', timeit(lambda: callbacks.resolve(path), 100000), 100000)
+
+    start = time.perf_counter()
+    for _ in range(number):
+        sleep_callback({'delay': delay}, 'SUCCESS')
+    print(f'inline: caller blocked {time.perf_counter() - start:.2f}s')
+
+    for mode in ('thread', 'process'):
+        engine = callbacks.Callback(mode=mode, workers=workers, max_pending=number, timeout=30)
+        engine.submit(path, {'delay': 0}, 'SUCCESS').result()
+        start = time.perf_counter()
+        futures = [engine.submit(path, {'delay': delay}, 'SUCCESS') for _ in range(number)]
+        submitted = time.perf_counter() - start
+        for future in futures:
+            future.result()
+        metrics = engine.metrics()
+        print(f'{mode}: caller blocked {submitted:.3f}s, all done in {time.perf_counter() - start:.2f}s, '
+              f'latency p50 {metrics["latency"]["p50"] * 1000:.1f}ms p99 {metrics["latency"]["p99"] * 1000:.1f}ms')
+        engine.shutdown()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]), *map(float, sys.argv[2:3]), *map(int, sys.argv[3:4]))
@@ -0,0 +1,51 @@
+"""
+    DAG执行: 构造tasks个任务、每个节点branch个子任务的树, 启动后模拟worker循环取出已发布的任务并批量上报成功,
+    统计启动耗时、全部任务完成的耗时和每个完成任务平均的查询数
+    python benchmarks/bench_dag.py [tasks] [branch]
+"""
+import sys
+import time
+from common import setup_django, create_queue
+
+
+def main(number=5000, branch=10):
+    setup_django()
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from task_system import models
+    from task_system import dag
+
+    queue = create_queue()
+    category = models.Category.objects.create(name='bench')
+    tasks = [models.Task(name=f'dag-{i}', category=category, queue=queue) for i in range(number)]
+    for i, task in enumerate(tasks[1:], 1):
+        task.parent_id = tasks[(i - 1) // branch].id
+    models.Task.objects.bulk_create(tasks, batch_size=1000)
+    client = Client()
+    path = f'/task/get/{queue.exchange.name}/{queue.name}/{queue.routing_key}/'
+
+    start = time.perf_counter()
+    run, _ = dag.start(tasks[0].id)
+    print(f'start dag of {number} tasks: {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    finished, rounds = 0, 0
+    start = time.perf_counter()
+    with CaptureQueriesContext(connection) as queries:
+        while True:
+            messages = client.get(path, {'max': 1000}).json()
+            if not messages:
+                break
+            rounds += 1
+            events = [{'task': message['task']['id'], 'state': 'SUCCESS', 'dag': str(run.id)}
+                      for message in messages]
+            client.post('/task/report/', events, content_type='application/json')
+            finished += len(messages)
+    elapsed = time.perf_counter() - start
+    run.refresh_from_db()
+    print(f'{finished} tasks finished in {rounds} rounds, {elapsed:.2f}s, {finished / elapsed:.0f} tasks/s, '
+          f'{len(queries) / finished:.2f} queries/task, state {run.state}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
@@ -0,0 +1,43 @@
+"""
+    内置broker(local://, 数据库表)与kombu的memory transport的吞吐对比:
+    put为经过TaskAPI.put批量发布number个任务, get为经过TaskAPI.get每次取出batch条直到队列为空
+    python benchmarks/bench_local_broker.py [number] [batch]
+"""
+import os
+import sys
+import tempfile
+import time
+from common import setup_django, create_queue, report
+
+
+def main(number=5000, batch=100):
+    setup_django(os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'))
+    from django.test import Client
+    from task_system import models
+
+    category = models.Category.objects.create(name='bench')
+    tasks = models.Task.objects.bulk_create([models.Task(name=f'bench-{i}', category=category, priority=i % 10)
+                                             for i in range(number)])
+    task_ids = [str(task.id) for task in tasks]
+    client = Client()
+    for connection in ('memory://', 'local://'):
+        name = connection.split(':')[0]
+        queue = create_queue(name=name, routing_key=name, connection=connection)
+        path = f'/task/%s/{queue.exchange.name}/{queue.name}/{queue.routing_key}/'
+
+        start = time.perf_counter()
+        client.post(path % 'put', task_ids, content_type='application/json')
+        report(f'{name} put', time.perf_counter() - start, number)
+
+        received = 0
+        start = time.perf_counter()
+        while True:
+            messages = client.get(path % 'get', {'max': batch}).json()
+            if not messages:
+                break
+            received += len(messages)
+        report(f'{name} get (max={batch})', time.perf_counter() - start, received)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
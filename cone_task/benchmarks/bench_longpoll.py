@@ -0,0 +1,87 @@
+"""
+    长轮询并发, 比较WSGI和ASGI两种部署:
+    - 空闲: consumers个消费者同时长轮询空队列, 统计全部请求返回的耗时, WSGI约为consumers / threads * wait, ASGI约为wait;
+    - 投递: consumers个消费者长轮询(最多等待30秒), 0.5秒后逐条发布consumers条消息, 统计全部消费者拿到消息的耗时
+    WSGI为同步TaskAPI.get, 模拟threads个工作线程的部署(如gunicorn --threads), 超出线程数的请求排队等待;
+    ASGI为async_views.get, 单个事件循环处理全部请求; 请求直接交给Django的handler, 不经过网络
+    python benchmarks/bench_longpoll.py [consumers] [threads] [wait]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from common import setup_django, create_queue
+
+
+def main(consumers=320, threads=32, wait=2):
+    setup_django(os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'))
+    from django.test import Client, AsyncClient
+    from task_system import models
+    from task_system.connections import pools
+
+    # 同步长轮询在等待期间一直占用一个broker连接, 连接池按线程数配置
+    pools.limit, pools.acquire_timeout = threads + 1, 60
+    queue = create_queue()
+    category = models.Category.objects.create(name='bench')
+    task = models.Task.objects.create(name='bench', category=category)
+    path = f'/task/%s/{queue.exchange.name}/{queue.name}/{queue.routing_key}/'
+
+    def wsgi(deliver):
+        params = {'max': 1, 'wait': 30 if deliver else wait}
+
+        def poll(_):
+            return len(Client().get(path % 'get', params).json())
+
+        def publish():
+            time.sleep(0.5)
+            client = Client()
+            for _ in range(consumers):
+                client.get(path % 'put', {'task_id': str(task.id)})
+
+        publisher = threading.Thread(target=publish)
+        if deliver:
+            publisher.start()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            received = sum(executor.map(poll, range(consumers)))
+        if deliver:
+            publisher.join()
+        return received, threads
+
+    async def asgi(deliver):
+        client = AsyncClient()
+        params = {'max': 1, 'wait': 30 if deliver else wait}
+        peak = 0
+
+        async def poll():
+            return len((await client.get(path % 'async/get', params)).json())
+
+        async def publish():
+            await asyncio.sleep(0.5)
+            for _ in range(consumers):
+                await client.get(path % 'async/put', {'task_id': str(task.id)})
+
+        async def watch():
+            nonlocal peak
+            while True:
+                peak = max(peak, threading.active_count())
+                await asyncio.sleep(0.05)
+
+        watcher = asyncio.create_task(watch())
+        results = await asyncio.gather(*(poll() for _ in range(consumers)), *([publish()] if deliver else []))
+        watcher.cancel()
+        return sum(results[:consumers]), peak
+
+    for deliver in (False, True):
+        scenario = '投递' if deliver else '空闲'
+        for name, run in (('WSGI', wsgi), ('ASGI', lambda deliver: asyncio.run(asgi(deliver)))):
+            start = time.perf_counter()
+            received, peak = run(deliver)
+            print(f'{scenario} {name}: {received}/{consumers} received in {time.perf_counter() - start:.2f}s, '
+                  f'threads {peak}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]), *map(float, sys.argv[3:4]))
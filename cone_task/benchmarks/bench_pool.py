@@ -0,0 +1,41 @@
+"""
+    对比TaskAPI.get在使用连接池和每次请求新建连接时的吞吐
+    python benchmarks/bench_pool.py [requests]
+"""
+import sys
+from contextlib import contextmanager
+from common import setup_django, create_queue, timeit, report
+
+
+def main(number=2000):
+    setup_django()
+    from django.test import Client
+    from kombu import Connection
+    from task_system import connections
+
+    queue = create_queue()
+    url = f'/task/get/{queue.exchange.name}/{queue.name}/{queue.routing_key}/'
+    client = Client()
+
+    @contextmanager
+    def unpooled(q):
+        with Connection(q.connection) as conn:
+            yield conn
+
+    def fill():
+        with Connection(queue.connection) as conn:
+            simple_queue = conn.SimpleQueue(queue.name)
+            for i in range(number):
+                simple_queue.put({'i': i})
+
+    pooled = connections.pools.acquire
+    for name, acquire in (('unpooled', unpooled), ('pooled', pooled)):
+        connections.pools.acquire = acquire
+        fill()
+        elapsed = timeit(lambda: client.get(url), number)
+        report(f'task-get {name}', elapsed, number)
+    connections.pools.acquire = pooled
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,56 @@
+"""
+    低优先级任务积压时高优先级任务的派发延迟:
+    队列中先积压backlog条低优先级消息, 之后每轮发布batch条低优先级和1条高优先级消息, 消费者每轮取出batch + 1条,
+    队列始终处于饱和状态; 统计高优先级消息从发布到被取出的延迟分位数
+    memory://不支持优先级, 按先进先出; local://按priority出队
+    python benchmarks/bench_priority.py [backlog] [rounds] [batch]
+"""
+import os
+import sys
+import tempfile
+import time
+from common import setup_django, create_queue
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def main(backlog=2000, rounds=200, batch=10):
+    setup_django(os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'))
+    from django.test import Client
+    from task_system import models
+
+    category = models.Category.objects.create(name='bench')
+    low = models.Task.objects.create(name='low', category=category, priority=0)
+    high = models.Task.objects.bulk_create([models.Task(name=f'high-{i}', category=category, priority=9)
+                                            for i in range(rounds)])
+    client = Client()
+    for connection in ('memory://', 'local://'):
+        name = connection.split(':')[0]
+        queue = create_queue(name=name, routing_key=name, connection=connection, config={'max_priority': 10})
+        path = f'/task/%s/{queue.exchange.name}/{queue.name}/{queue.routing_key}/'
+        for _ in range(backlog):
+            client.get(path % 'put', {'task_id': str(low.id)})
+
+        published, latencies = {}, []
+        for task in high:
+            for _ in range(batch):
+                client.get(path % 'put', {'task_id': str(low.id)})
+            client.get(path % 'put', {'task_id': str(task.id)})
+            published[str(task.id)] = time.perf_counter()
+            for message in client.get(path % 'get', {'max': batch + 1}).json():
+                sent = published.pop(message['task']['id'], None)
+                if sent is not None:
+                    latencies.append(time.perf_counter() - sent)
+        print(f'{name}: {len(latencies)}/{rounds} high priority delivered, '
+              f'p50 {percentile(latencies, 0.5) * 1000:.1f}ms, p99 {percentile(latencies, 0.99) * 1000:.1f}ms'
+              if latencies else f'{name}: 0/{rounds} high priority delivered')
+        # 清空队列
+        while client.get(path % 'get', {'max': 1000}).json():
+            pass
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:4]))
@@ -0,0 +1,48 @@
+"""
+    运行状态上报: 逐个事件写日志并更新任务 vs reports.apply批量合并
+    python benchmarks/bench_report.py [runs]
+"""
+import sys
+import time
+from common import setup_django
+
+
+def main(number=10000):
+    setup_django()
+    from django.db.models import F
+    from django.utils import timezone
+    from task_system import models
+    from task_system import reports
+
+    category = models.Category.objects.create(name='bench')
+    tasks = models.Task.objects.bulk_create([models.Task(name=f'task-{i}', category=category) for i in range(1000)])
+    now = timezone.now()
+    events = []
+    for i in range(number):
+        task = tasks[i % len(tasks)]
+        events.append({'task': str(task.id), 'run': f'run-{i}', 'state': 'STARTED', 'time': now.isoformat()})
+        events.append({'task': str(task.id), 'run': f'run-{i}', 'state': 'SUCCESS', 'time': now.isoformat(),
+                       'result': {'ok': True}})
+
+    start = time.perf_counter()
+    for event in events:
+        if event['state'] == 'STARTED':
+            models.TaskLog.objects.create(task_id=event['task'], run_id=event['run'] + '-single',
+                                          state=event['state'], start_time=now)
+            models.Task.objects.filter(id=event['task']).update(
+                last_run_at=now, total_run_count=F('total_run_count') + 1)
+        else:
+            models.TaskLog.objects.filter(run_id=event['run'] + '-single').update(
+                state=event['state'], result=event['result'])
+    elapsed = time.perf_counter() - start
+    print(f'per event: {len(events) / elapsed:.0f} events/s')
+
+    start = time.perf_counter()
+    for i in range(0, len(events), 1000):
+        reports.apply(events[i: i + 1000], now)
+    elapsed = time.perf_counter() - start
+    print(f'reports.apply, 1000 events per request: {len(events) / elapsed:.0f} events/s')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
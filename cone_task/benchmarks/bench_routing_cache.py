@@ -0,0 +1,46 @@
+"""
+    路由查询: 对比原来按请求从django cache取出pickle的Exchange/Queue, 和进程内路由表快照(含版本号检查)的耗时;
+    同时统计加载全部queues个队列的快照耗时, 即每个进程第一次请求时的预热开销
+    python benchmarks/bench_routing_cache.py [queues] [number]
+"""
+import sys
+import time
+from common import setup_django, create_queue, timeit, report
+
+
+def main(queues=1000, number=100000):
+    setup_django()
+    from django.core.cache import cache
+    from task_system import models
+    from task_system import routing
+
+    for i in range(queues):
+        create_queue(name=f'bench-{i}', routing_key=f'bench-{i}')
+    exchange = models.Exchange.objects.get(name='bench')
+    for queue in models.Queue.objects.all():
+        cache.set(f'queue:{queue.name}', queue)
+    cache.set(f'exchange:{exchange.name}', exchange)
+
+    start = time.perf_counter()
+    routing.table.load()
+    print(f'load snapshot of {queues} queues: {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    names = [f'bench-{i}' for i in range(queues)]
+
+    def lookup(func):
+        it = iter(names * (number // queues + 1))
+        return lambda: func(next(it))
+
+    def from_cache(name):
+        cache.get('exchange:bench')
+        return cache.get(f'queue:{name}')
+
+    def from_snapshot(name):
+        return routing.table.get_queue(routing.table.get_exchange('bench'), name, name)
+
+    report('django cache (locmem, pickled)', timeit(lookup(from_cache), number), number)
+    report('routing snapshot', timeit(lookup(from_snapshot), number), number)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
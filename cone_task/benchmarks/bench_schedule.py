@@ -0,0 +1,31 @@
+"""
+    计划时间计算的单次耗时: 每次调用都重新解析配置 vs 使用缓存的编译结果
+    python benchmarks/bench_schedule.py [calls]
+"""
+import sys
+from datetime import datetime
+from common import setup_django, timeit, report
+
+
+def main(number=20000):
+    setup_django()
+    from task_system import models
+    from task_system.schedule.config import get_next_schedule_time
+
+    configs = {
+        'crontab': {'crontab': '*/5 * * * *'},
+        'interval': {'start_time': '2024-05-08 12:00:00', 'interval': 10, 'period': 'minutes'},
+        'timing': {'type': 'WEEKDAY', 'WEEKDAY': {'time': '09:00:00', 'weekdays': [1, 3, 5]}},
+        'clocked': {'clocked': [datetime(2024, 1, 1, i % 24, i % 60) for i in range(200)]},
+    }
+    last_time = datetime(2024, 1, 1, 12)
+    for i, (schedule_type, config) in enumerate(configs.items()):
+        schedule = models.Schedule(id=i + 1, schedule_type=schedule_type, config=config, update_time=datetime.now())
+        elapsed = timeit(lambda: get_next_schedule_time(schedule_type, config, last_time, True), number)
+        report(f'{schedule_type} parse per call', elapsed, number)
+        elapsed = timeit(lambda: schedule.get_next_time(last_time, True), number)
+        report(f'{schedule_type} compiled', elapsed, number)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
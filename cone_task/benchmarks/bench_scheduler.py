@@ -0,0 +1,38 @@
+"""
+    调度进程吞吐: 准备一批已到期的任务, 统计Scheduler.tick每分钟能发布多少任务
+    python benchmarks/bench_scheduler.py [tasks]
+"""
+import sys
+import time
+from datetime import timedelta
+from common import setup_django, create_queue
+
+
+def main(number=20000):
+    setup_django()
+    from django.utils import timezone
+    from task_system import models
+    from task_system.scheduler import Scheduler
+    from task_system import timeline
+
+    queue = create_queue()
+    category = models.Category.objects.create(name='bench')
+    schedule = models.Schedule.objects.create(schedule_type='interval', config={
+        'interval': {'start_time': '2024-01-01 00:00:00', 'interval': 1, 'period': 'hours'}
+    })
+    now = timezone.now()
+    models.Task.objects.bulk_create([
+        models.Task(name=f'task-{i}', category=category, queue=queue, schedule=schedule,
+                    next_start_time=now - timedelta(seconds=1)) for i in range(number)
+    ], batch_size=1000)
+    # 运行计划在平时由保存任务和调度维护, 这里预先生成, 只统计调度时的增量补齐
+    timeline.rebuild(models.Task.objects.select_related('schedule'))
+
+    start = time.perf_counter()
+    dispatched = Scheduler().tick()
+    elapsed = time.perf_counter() - start
+    print(f'dispatched {dispatched} tasks in {elapsed:.2f}s, {dispatched / elapsed * 60:.0f} dispatches/min')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,54 @@
+"""
+    投递延迟: 逐条发布消息, 统计SSE推送收到消息的延迟, 与按固定间隔轮询task-get的期望延迟比较
+    python benchmarks/bench_stream.py [messages] [poll_interval]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from common import setup_django, create_queue
+
+
+def main(number=200, poll_interval=1.0):
+    setup_django(os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'))
+    from kombu import Exchange
+    from task_system import models
+    from task_system.connections import pools
+    from task_system import broker
+    from task_system.streaming import Stream
+
+    queue = create_queue()
+    category = models.Category.objects.create(name='bench')
+    task = models.Task.objects.create(name='bench', category=category)
+    exchange = Exchange(queue.exchange.name, type=queue.exchange.type)
+    stream = Stream(queue, exchange, prefetch=100, heartbeat=60)
+    events = stream.events()
+    next(events)
+    published = []
+
+    def publish():
+        for _ in range(number):
+            time.sleep(0.01)
+            with pools.acquire(queue) as conn:
+                published.append(time.perf_counter())
+                list(broker.publish_loaded_tasks(conn, queue, exchange, queue.routing_key, [task]))
+
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    latencies = []
+    for event in events:
+        latencies.append(time.perf_counter())
+        stream.ack([event.split('\n', 1)[0][len('id: '):]])
+        if len(latencies) == number:
+            break
+    publisher.join()
+    events.close()
+    latencies = [(received - sent) * 1000 for sent, received in zip(published, latencies)]
+    print(f'SSE push: median {statistics.median(latencies):.1f}ms, max {max(latencies):.1f}ms')
+    print(f'polling every {poll_interval}s: expected {poll_interval * 500:.0f}ms, max {poll_interval * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]), *map(float, sys.argv[2:3]))
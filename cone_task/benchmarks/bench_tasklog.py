@@ -0,0 +1,35 @@
+"""
+    TaskLog写入: 逐条create vs TaskLogWriter批量插入
+    python benchmarks/bench_tasklog.py [logs]
+"""
+import sys
+import time
+from common import setup_django
+
+
+def main(number=20000):
+    setup_django()
+    from django.utils import timezone
+    from task_system import models
+    from task_system.tasklog import TaskLogWriter
+
+    category = models.Category.objects.create(name='bench')
+    task = models.Task.objects.create(name='bench', category=category)
+
+    start = time.perf_counter()
+    for _ in range(number):
+        models.TaskLog.objects.create(task=task, state='SUCCESS', queue='bench', start_time=timezone.now())
+    elapsed = time.perf_counter() - start
+    print(f'create per row: {number / elapsed:.0f} logs/s')
+
+    writer = TaskLogWriter(batch_size=500, flush_interval=0)
+    start = time.perf_counter()
+    for _ in range(number):
+        writer.write(task, 'SUCCESS', 'bench')
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    print(f'TaskLogWriter: {number / elapsed:.0f} logs/s')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
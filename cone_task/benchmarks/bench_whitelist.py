@@ -0,0 +1,41 @@
+"""
+    IP白名单查询: 队列配置networks个网段(/8~/32混合), 对比进程内前缀表和原来按IP逐个查询Django缓存的耗时
+    python benchmarks/bench_whitelist.py [networks] [number]
+"""
+import random
+import sys
+from common import setup_django, create_queue, timeit, report
+
+
+def main(networks=1000, number=200000):
+    setup_django()
+    from django.core.cache import cache
+    from task_system import models
+    from task_system.whitelist import whitelist
+
+    queue = create_queue()
+    rng = random.Random(0)
+    entries = []
+    for i in range(networks):
+        prefixlen = rng.choice((8, 16, 24, 32))
+        address = rng.getrandbits(32) >> (32 - prefixlen) << (32 - prefixlen)
+        entries.append(models.QueueIPWhitelist(
+            queue=queue, allowed_ip=f'{".".join(str(address >> s & 255) for s in (24, 16, 8, 0))}/{prefixlen}'))
+    models.QueueIPWhitelist.objects.bulk_create(entries, ignore_conflicts=True)
+    whitelist.load()
+    ips = [f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}' for _ in range(1000)]
+    for ip in ips[::2]:
+        cache.set(f'{queue.name}:whitelist:{ip}', 1)
+
+    def lookup(check):
+        it = iter(ips * (number // len(ips) + 1))
+        return lambda: check(next(it))
+
+    for ip in ips:
+        whitelist.is_allowed(queue.name, ip)
+    report('prefix table', timeit(lookup(lambda ip: whitelist.is_allowed(queue.name, ip)), number), number)
+    report('cache (locmem)', timeit(lookup(lambda ip: cache.get(f'{queue.name}:whitelist:{ip}')), number), number)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
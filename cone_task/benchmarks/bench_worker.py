@@ -0,0 +1,54 @@
+"""
+    内置worker吞吐量: 向队列发布number个任务, 每个任务耗时delay秒, 分别以thread/process/asyncio方式执行,
+    统计从开始消费到全部任务执行、确认并写入TaskLog的耗时; broker使用memory和local(数据库)两种transport
+    python benchmarks/bench_worker.py [number] [delay] [concurrency]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from common import setup_django, create_queue
+
+
+def sleep_task(delay):
+    time.sleep(delay)
+    return delay
+
+
+async def async_sleep_task(delay):
+    await asyncio.sleep(delay)
+    return delay
+
+
+def main(number=2000, delay=0.005, concurrency=16):
+    setup_django(os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'))
+    from kombu import Exchange, Producer
+    from task_system import broker, models, serializers
+    from task_system.connections import pools
+    from task_system.worker import Worker
+
+    category = models.Category.objects.create(name='bench')
+    for transport in ('memory://', 'local://'):
+        queue = create_queue(name=f'bench-{transport[:-3]}', connection=transport)
+        for mode in ('thread', 'process', 'asyncio'):
+            function = 'bench_worker.async_sleep_task' if mode == 'asyncio' else 'bench_worker.sleep_task'
+            task = models.Task.objects.create(name=f'{transport}{mode}', category=category, queue=queue,
+                                              function=function, config={'delay': delay})
+            body = serializers.TaskSerializer(task).data
+            exchange = Exchange(queue.exchange.name)
+            with pools.acquire(queue) as conn:
+                broker.build_queue(queue, exchange, channel=conn.default_channel).declare()
+                producer = Producer(conn.default_channel, exchange=exchange)
+                for _ in range(number):
+                    producer.publish(body, routing_key=queue.routing_key, serializer='json')
+            start = time.perf_counter()
+            Worker(queue, mode=mode, concurrency=concurrency).run(max_tasks=number)
+            elapsed = time.perf_counter() - start
+            logs = models.TaskLog.objects.filter(task=task, state='SUCCESS').count()
+            print(f'{transport:<10} {mode:<8} {number / elapsed:>8.1f} tasks/s {elapsed:>6.2f}s '
+                  f'(ideal {number * delay / concurrency:.2f}s), {logs}/{number} logged')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]), *map(float, sys.argv[2:3]), *map(int, sys.argv[3:4]))
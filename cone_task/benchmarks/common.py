@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django(database=':memory:'):
+    """以内存数据库启动项目, 供各个benchmark脚本使用; 多线程访问数据库的脚本需要指定数据库文件"""
+    sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cone_task.settings')
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = database
+    settings.DEBUG = False
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    call_command('migrate', verbosity=0)
+
+
+def create_queue(name='bench', connection='memory://', routing_key='bench', exchange='bench', **kwargs):
+    from task_system import models
+    exchange, _ = models.Exchange.objects.get_or_create(name=exchange)
+    return models.Queue.objects.create(exchange=exchange, name=name, routing_key=routing_key,
+                                       connection=connection, **kwargs)
+
+
+def timeit(func, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return time.perf_counter() - start
+
+
+def report(name, elapsed, number):
+    print(f'{name:<40} {number / elapsed:>12.1f} ops/s {elapsed / number * 1e6:>10.1f} us/op')
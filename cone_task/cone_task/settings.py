@@ -37,6 +37,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'rest_framework',
+    'task_system',
 ]
 
 MIDDLEWARE = [
@@ -47,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'task_system.middleware.IPWhitelistMiddleware',
 ]
 
 ROOT_URLCONF = 'cone_task.urls'
@@ -80,6 +83,12 @@ DATABASES = {
     }
 }
 
+# 路由表和IP白名单是进程内快照, 跨进程失效依赖共享的缓存(版本号)和broker(广播);
+# 默认的本地内存缓存和memory://只在单个进程内生效, 多进程/多节点部署时需要配置为共享的服务,
+# 否则其它进程的修改最多等到重启才生效, manage.py check --deploy会给出警告
+# CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379'}}
+# TASK_INVALIDATION_BROKER = 'redis://127.0.0.1:6379/1'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -1,20 +1,57 @@
 from django.contrib import admin
-from django.db.models import Exists, OuterRef, Q
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Exists, OuterRef
+from django.utils.functional import cached_property
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
 from . import forms
+from . import invalidation
 from . import models
 from .choices import ScheduleType, ScheduleTimingType
 from datetime import datetime
-import uuid
 from django.conf import settings
 
 
 admin_prefix = settings.FORCE_SCRIPT_NAME if settings.FORCE_SCRIPT_NAME else '/'
 
 
+def estimate_count(queryset):
+    """数据库统计信息中的表行数, 不支持的数据库返回None"""
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql, params = 'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table]
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s'
+        params = [table]
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+        没有过滤条件时使用数据库统计的行数, 大表上不再执行COUNT(*)全表扫描;
+        估算值小于TASK_ADMIN_ESTIMATE_THRESHOLD或有过滤条件时仍使用精确计数
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate >= getattr(settings, 'TASK_ADMIN_ESTIMATE_THRESHOLD', 10000):
+                return estimate
+        return super().count
+
+
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('id', 'parent', 'name', 'update_time')
     fields = (
@@ -94,22 +131,31 @@ class QueueAdmin(admin.ModelAdmin):
 
 
 class TaskParentFilter(admin.SimpleListFilter):
+    """
+        有子任务的父任务列表只查询id和name, 按parent_id索引判断是否有子任务;
+        结果缓存TASK_ADMIN_LOOKUP_TIMEOUT秒, 任务变更后递增版本号使缓存失效
+    """
 
     title = '父任务'
     parameter_name = 'parent'
-    other = (uuid.uuid4(), '其它')
+    # 任务id是UUID, 固定的取值不会与父任务冲突, 各进程生成的链接一致
+    other = ('none', '其它')
+
+    @staticmethod
+    def parents():
+        return list(models.Task.objects.filter(Exists(models.Task.objects.filter(parent=OuterRef('id'))))
+                    .order_by('name').values_list('id', 'name'))
 
     def lookups(self, request, model_admin):
-        parent_tasks_with_children = models.Task.objects.annotate(
-            has_children=Exists(models.Task.objects.filter(parent=OuterRef('id')))).filter(has_children=True)
-        lookups = [(task.id, task.name) for task in parent_tasks_with_children]
-        lookups.append(self.other)
-        return lookups
+        key = 'task:admin:parents:%s' % invalidation.get_version(invalidation.TASK_PARENTS)
+        lookups = cache.get_or_set(key, self.parents, getattr(settings, 'TASK_ADMIN_LOOKUP_TIMEOUT', 300))
+        return [*lookups, self.other]
 
     def queryset(self, request, queryset):
         value = self.value()
         if value == self.other[0]:
-            queryset = queryset.filter(~Q(parent__id__in=[choice[0] for choice in self.lookup_choices]))
+            # 所有父任务都在选项中, 其它即没有父任务
+            queryset = queryset.filter(parent__isnull=True)
         elif value:
             queryset = queryset.filter(parent_id=value)
         return queryset
@@ -133,6 +179,8 @@ class TaskAdmin(admin.ModelAdmin):
     list_filter = ('category', 'tags', TaskParentFilter)
     filter_horizontal = ('tags',)
     form = forms.TaskForm
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def admin_parent(self, obj):
         if obj.parent:
@@ -144,9 +192,11 @@ class TaskAdmin(admin.ModelAdmin):
     admin_parent.short_description = '父任务'
 
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('parent', 'category').prefetch_related('tags')
+        return super().get_queryset(request).select_related('parent', 'category', 'queue__exchange')
 
     def put(self, task: models.Task):
+        if task.queue is None:
+            return '-'
         url = reverse('task-put', args=(task.queue.exchange.name, task.queue.name, task.queue.routing_key)) + '?task_id=%s' % task.id
         return mark_safe(f'<a href="{url}" target="_blank">运行</a>')
     put.short_description = '运行'
@@ -155,6 +205,8 @@ class TaskAdmin(admin.ModelAdmin):
 class TaskLogAdmin(admin.ModelAdmin):
     list_display = ('id', 'task', 'state', 'queue', 'start_time', 'create_time')
     list_filter = ('state', 'queue', 'task__name')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def has_change_permission(self, request, obj=None):
         return False
@@ -166,6 +218,28 @@ class TaskLogAdmin(admin.ModelAdmin):
         return super().get_queryset(request).select_related('task')
 
 
+class ScheduledRunAdmin(admin.ModelAdmin):
+    list_display = ('run_time', 'task')
+    list_select_related = ('task', )
+    date_hierarchy = 'run_time'
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_add_permission(self, request):
+        return False
+
+
+class DagRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'root', 'state', 'create_time', 'finish_time')
+    list_select_related = ('root', )
+    list_filter = ('state', )
+    readonly_fields = ('root', 'graph', 'create_time', 'finish_time')
+
+    def has_add_permission(self, request):
+        return False
+
+
 class QueueIPWhitelistAdmin(admin.ModelAdmin):
     list_display = ('id', 'queue', 'enabled', 'allowed_ip', 'update_time')
     fields = (
@@ -182,6 +256,8 @@ admin.site.register(models.Schedule, ScheduleAdmin)
 admin.site.register(models.Task, TaskAdmin)
 admin.site.register(models.TaskLog, TaskLogAdmin)
 admin.site.register(models.QueueIPWhitelist, QueueIPWhitelistAdmin)
+admin.site.register(models.ScheduledRun, ScheduledRunAdmin)
+admin.site.register(models.DagRun, DagRunAdmin)
 
 admin.site.site_header = '任务管理系统'
 admin.site.site_title = '任务管理系统'
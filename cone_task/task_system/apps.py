@@ -5,3 +5,8 @@ class TaskSystemConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'task_system'
     verbose_name = '任务管理'
+
+    def ready(self):
+        from .local_broker import register
+        from . import checks  # noqa: F401
+        register()
@@ -0,0 +1,125 @@
+"""
+    task-get/task-put的异步版本, 部署在ASGI(uvicorn等)下使用:
+    - kombu和Django ORM的同步调用(路由解析、broker收发、租约、任务查询和序列化)都放到有界线程池中执行,
+      不在事件循环中阻塞; 线程池中的调用会访问数据库, 每次调用前后像请求一样按CONN_MAX_AGE关闭过期连接;
+    - put与同步版本共用broker.publish_tasks, 按TASK_PUBLISH_CHUNK分批查询和发布;
+    - 长轮询不是broker推送: kombu没有异步consumer, 等待期间在事件循环中asyncio.sleep退避后再次basic_get,
+      不占用线程, 但每次轮询都要占用一个线程和一个broker连接, 退避间隔从TASK_ASYNC_POLL_MIN增长到
+      TASK_ASYNC_POLL_MAX, 消息到达后最多延迟TASK_ASYNC_POLL_MAX秒才返回;
+      同时轮询的请求数受TASK_ASYNC_IO_THREADS和连接池的limit限制, 需要低延迟时使用同步接口的wait或SSE推送
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+from kombu import Exchange
+from .connections import pools
+from . import broker
+from . import leases
+from . import models
+from .views import _get_number_param, get_exchange_and_queue
+
+_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'TASK_ASYNC_IO_THREADS', 32),
+                               thread_name_prefix='task-io')
+
+
+def _call(func, *args, **kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def _run(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(_call, func, *args, **kwargs))
+
+
+def _error(e: APIException):
+    return JsonResponse(e.detail if isinstance(e.detail, (dict, list)) else {'detail': e.detail},
+                        status=e.status_code, safe=False)
+
+
+def _fetch(queue: models.Queue, exchange: Exchange, routing_key, limit, visibility=None):
+    """不等待地取出最多limit条消息, visibility不为None时按租用模式取出, 由客户端用token确认"""
+    with pools.acquire(queue) as conn:
+        if visibility is not None:
+            return leases.lease(conn, queue, exchange, routing_key, limit, 0, visibility)
+        with broker.consume(conn, queue, exchange, limit, 0) as messages:
+            return [broker.message_to_dict(message) for message in messages]
+
+
+async def _long_poll(queue, exchange, routing_key, limit, wait, visibility=None):
+    """basic_get轮询并指数退避, 不是broker推送, 限制见模块说明"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    delay = getattr(settings, 'TASK_ASYNC_POLL_MIN', 0.05)
+    max_delay = getattr(settings, 'TASK_ASYNC_POLL_MAX', 1)
+    while True:
+        messages = await _run(_fetch, queue, exchange, routing_key, limit, visibility)
+        remaining = deadline - loop.time()
+        if messages or remaining <= 0:
+            return messages
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+@require_http_methods(['GET'])
+async def get(request, exchange, queue: str, routing_key: str):
+    """同TaskAPI.get, 参数?max=&wait=&ack=auto|lease|explicit&visibility="""
+    try:
+        exchange, queue = await _run(get_exchange_and_queue, exchange, queue, routing_key)
+        params = request.GET
+        ack = params.get('ack', 'auto')
+        if ack not in ('auto', 'lease', 'explicit'):
+            raise ValidationError({'ack': 'ack只能为auto、explicit或lease'})
+        visibility = None
+        if ack != 'auto':
+            max_visibility = getattr(settings, 'TASK_LEASE_MAX_TIMEOUT', 3600)
+            visibility = _get_number_param(params, 'visibility', float, 1, max_visibility,
+                                           default=getattr(settings, 'TASK_LEASE_TIMEOUT', 60))
+        if 'max' not in params:
+            messages = await _run(_fetch, queue, exchange, routing_key, 1, visibility)
+            if not messages:
+                raise NotFound
+            return JsonResponse(messages[0])
+        limit = _get_number_param(params, 'max', int, 1, getattr(settings, 'TASK_MAX_BATCH', 1000))
+        wait = _get_number_param(params, 'wait', float, 0, getattr(settings, 'TASK_MAX_WAIT', 30), default=0)
+    except APIException as e:
+        return _error(e)
+    messages = await _long_poll(queue, exchange, routing_key, limit, wait, visibility)
+    return JsonResponse(messages, safe=False)
+
+
+def _publish(queue: models.Queue, exchange: Exchange, routing_key, task_ids, confirm):
+    with pools.acquire(queue) as conn:
+        return list(broker.publish_tasks(conn, queue, exchange, routing_key, task_ids,
+                                         chunk_size=getattr(settings, 'TASK_PUBLISH_CHUNK', 500), confirm=confirm))
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+async def put(request, exchange, queue: str, routing_key: str):
+    """同TaskAPI.put, ?task_id=id1,id2或POST任务id列表, ?confirm=1等待publisher confirm"""
+    task_ids = request.GET.get('task_id')
+    try:
+        if task_ids:
+            task_ids = task_ids.split(',')
+        else:
+            try:
+                task_ids = json.loads(request.body or b'[]')
+            except ValueError:
+                raise ValidationError({'task_id': '请求体必须是任务id的JSON列表'})
+            if not isinstance(task_ids, list):
+                raise ValidationError({'task_id': '请求体必须是任务id的JSON列表'})
+        exchange, queue_model = await _run(get_exchange_and_queue, exchange, queue, routing_key)
+    except APIException as e:
+        return _error(e)
+    confirm = request.GET.get('confirm') in ('1', 'true')
+    return JsonResponse(await _run(_publish, queue_model, exchange, routing_key, task_ids, confirm), safe=False)
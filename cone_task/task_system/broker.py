@@ -0,0 +1,217 @@
+import socket
+import uuid
+from contextlib import contextmanager
+from time import monotonic
+from kombu import Consumer, Exchange, Producer, Queue, Message
+from . import models
+from . import serializers
+
+
+def build_queue(queue: models.Queue, exchange: Exchange, channel=None) -> Queue:
+    # 绑定使用Queue.routing_key, 请求中的routing_key只用于发布消息, topic交换机下两者可能不同(如task.*和task.a)
+    # Queue.config中配置max_priority时声明为优先级队列(x-max-priority), 已存在的队列不能修改该参数
+    max_priority = (queue.config or {}).get('max_priority')
+    return Queue(channel=channel, name=queue.name, exchange=exchange, routing_key=queue.routing_key,
+                 max_priority=int(max_priority) if max_priority else None)
+
+
+def message_to_dict(message: Message):
+    return {
+        'properties': message.properties,
+        'headers': message.headers,
+        'task': message.payload
+    }
+
+
+def message_priority(task: models.Task):
+    # AMQP的priority是0-255的整数
+    return min(max(task.priority, 0), 255)
+
+
+def _drain(channel, queue_name, limit, no_ack):
+    messages = []
+    while len(messages) < limit:
+        message = channel.basic_get(queue_name, no_ack=no_ack)
+        if not message:
+            break
+        messages.append(message)
+    return messages
+
+
+def _wait(conn, channel, queue: Queue, limit, wait, no_ack):
+    messages = []
+
+    def on_message(body, message: Message):
+        if no_ack:
+            message.ack()
+        messages.append(message)
+
+    deadline = monotonic() + wait
+    with Consumer(channel, queues=[queue], callbacks=[on_message], no_ack=False, prefetch_count=limit):
+        while not messages:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                conn.drain_events(timeout=remaining)
+            except socket.timeout:
+                break
+    return messages
+
+
+@contextmanager
+def consume(conn, queue: models.Queue, exchange: Exchange, limit=1, wait=0, no_ack=True):
+    """
+        一次取出最多limit条消息; 队列为空且wait>0时注册consumer长轮询, 直到至少收到一条消息或超时
+        no_ack=False时消息在with块正常结束后才确认, with块内出现异常则退回队列
+    """
+    # 长轮询时consumer可能预取到多于本次需要的消息, 使用独立channel, 关闭时未确认的消息会退回队列
+    channel = conn.channel() if wait > 0 else conn.default_channel
+    messages = []
+    try:
+        messages.extend(_drain(channel, queue.name, limit, no_ack))
+        if not messages and wait > 0:
+            kombu_queue = build_queue(queue, exchange, channel=channel)
+            messages.extend(_wait(conn, channel, kombu_queue, limit, wait, no_ack))
+            messages.extend(_drain(channel, queue.name, limit - len(messages), no_ack))
+        yield messages
+    except BaseException:
+        if not no_ack:
+            for message in messages:
+                if not message.acknowledged:
+                    message.requeue()
+        raise
+    else:
+        if not no_ack:
+            for message in messages:
+                if not message.acknowledged:
+                    message.ack()
+    finally:
+        if channel is not conn.default_channel:
+            channel.close()
+
+
+class PublisherConfirms:
+    """
+        批量等待publisher confirm, 每发布一批后统一等待broker确认;
+        transport不支持confirm(如memory)时发布成功即视为确认
+    """
+
+    def __init__(self, conn, channel, timeout=10):
+        self.conn = conn
+        self.channel = channel
+        self.timeout = timeout
+        self.supported = hasattr(channel, 'confirm_select') and hasattr(channel, 'events')
+        self.delivery_tag = 0
+        self.pending = {}
+        self.failed = set()
+        if self.supported:
+            channel.confirm_select()
+            channel.events['basic_ack'].add(self._on_ack)
+            channel.events['basic_nack'].add(self._on_nack)
+
+    def _settle(self, delivery_tag, multiple):
+        tags = [tag for tag in self.pending if tag <= delivery_tag] if multiple else [delivery_tag]
+        return [self.pending.pop(tag) for tag in tags if tag in self.pending]
+
+    def _on_ack(self, delivery_tag, multiple):
+        self._settle(delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self.failed.update(self._settle(delivery_tag, multiple))
+
+    def published(self, key):
+        if self.supported:
+            self.delivery_tag += 1
+            self.pending[self.delivery_tag] = key
+
+    def wait(self):
+        """等待本批次全部确认, 返回被nack或超时的key"""
+        deadline = monotonic() + self.timeout
+        while self.pending:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self.conn.drain_events(timeout=remaining)
+            except socket.timeout:
+                break
+        failed = self.failed | set(self.pending.values())
+        self.pending.clear()
+        self.failed = set()
+        return failed
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i: i + size]
+
+
+@contextmanager
+def _publisher(conn, queue: models.Queue, exchange: Exchange, routing_key, confirm=False, confirm_timeout=10):
+    channel = conn.channel() if confirm else conn.default_channel
+    try:
+        build_queue(queue, exchange, channel=channel).declare()
+        producer = Producer(channel, exchange=exchange)
+        yield producer, PublisherConfirms(conn, channel, confirm_timeout) if confirm else None
+    finally:
+        if channel is not conn.default_channel:
+            channel.close()
+
+
+def _publish_chunk(producer: Producer, confirms: PublisherConfirms, routing_key, tasks: dict, results: dict,
+                   headers=None):
+    # 复用同一个serializer实例, 避免每个任务都重新构建字段
+    serializer = serializers.TaskSerializer()
+    for task_id, task in tasks.items():
+        try:
+            producer.publish(serializer.to_representation(task), routing_key=routing_key, serializer='json',
+                             priority=message_priority(task), headers=headers)
+        except Exception as e:
+            results[task_id] = {'id': task_id, 'status': 'failed', 'error': str(e)}
+        else:
+            results[task_id] = {'id': task_id, 'status': 'published'}
+            if confirms:
+                confirms.published(task_id)
+    if confirms:
+        for task_id in confirms.wait():
+            results[task_id] = {'id': task_id, 'status': 'failed', 'error': 'not confirmed by broker'}
+
+
+def publish_tasks(conn, queue: models.Queue, exchange: Exchange, routing_key, task_ids, chunk_size=500,
+                  confirm=False, confirm_timeout=10):
+    """
+        批量发布任务: 队列只声明一次, 按chunk_size分批查询、序列化、发布, 内存中只保留当前批次的数据;
+        confirm=True时每批发布后等待publisher confirm
+        逐个返回每个任务的结果 {"id": ..., "status": "published|failed|missing", "error": ...}
+    """
+    with _publisher(conn, queue, exchange, routing_key, confirm, confirm_timeout) as (producer, confirms):
+        for chunk in _chunks(list(dict.fromkeys(str(task_id) for task_id in task_ids)), chunk_size):
+            results, ids = {}, {}
+            for task_id in chunk:
+                try:
+                    ids[task_id] = str(uuid.UUID(task_id))
+                except ValueError:
+                    results[task_id] = {'id': task_id, 'status': 'failed', 'error': 'invalid task id'}
+            tasks = serializers.prefetch_task_tree(models.Task.objects.filter(id__in=ids.values()))
+            tasks = {str(task.id): task for task in tasks}
+            found = {}
+            for task_id, pk in ids.items():
+                if pk in tasks:
+                    found[task_id] = tasks[pk]
+                else:
+                    results[task_id] = {'id': task_id, 'status': 'missing'}
+            _publish_chunk(producer, confirms, routing_key, found, results)
+            yield from results.values()
+
+
+def publish_loaded_tasks(conn, queue: models.Queue, exchange: Exchange, routing_key, tasks, chunk_size=500,
+                         confirm=False, confirm_timeout=10, headers=None):
+    """同publish_tasks, 发布已经查询出来的任务, headers为附加到每条消息的消息头"""
+    with _publisher(conn, queue, exchange, routing_key, confirm, confirm_timeout) as (producer, confirms):
+        for chunk in _chunks(list(tasks), chunk_size):
+            results = {}
+            serializers.prefetch_task_tree(chunk)
+            _publish_chunk(producer, confirms, routing_key, {str(task.id): task for task in chunk}, results,
+                           headers)
+            yield from results.values()
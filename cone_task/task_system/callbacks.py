@@ -1,7 +1,213 @@
+"""
+    任务回调: Task.callback为函数的导入路径(如"app.callbacks.notify"), 任务结束时调用callback(task, status);
+    - 导入路径解析结果按LRU缓存, 同一路径在每个进程中只import一次, 导入失败的结果同样缓存;
+    - 回调在有界的线程池或进程池中执行, 不阻塞调度和上报; 已提交未结束的回调达到max_pending时,
+      block为0直接拒绝, 否则最多等待block秒;
+    - 每个回调从提交开始计时, 超过timeout记为超时; 还在排队的直接取消, 进程池中运行的由SIGALRM中断,
+      线程无法强制中止, 只是不再等待它的结果; 超时的回调直到真正结束才释放名额, 不会超出线程池的容量;
+    - 同一次运行(run)的回调只提交一次, 按最近recent_runs个运行去重;
+    - metrics()返回排队深度、各类计数和最近的耗时分位数
+    配置(settings.TASK_CALLBACK):
+    {
+        "mode": "thread",           # thread或process
+        "workers": 4,
+        "max_pending": 1000,
+        "timeout": 30,
+        "block": 0,
+        "recent_runs": 10000,
+        "cache_size": 1024,         # 导入路径的LRU缓存大小
+    }
+"""
+import atexit
+import heapq
+import itertools
+import logging
+import signal
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from time import monotonic
+import django
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_config = getattr(settings, 'TASK_CALLBACK', {})
+
+
+class CallbackTimeout(Exception):
+    pass
+
+
+@lru_cache(maxsize=_config.get('cache_size', 1024))
+def resolve(path):
+    """返回(函数, 错误信息)"""
+    try:
+        func = import_string(path)
+    except ImportError as e:
+        return None, str(e)
+    if not callable(func):
+        return None, f'{path} is not callable'
+    return func, None
+
+
+def _on_alarm(signum, frame):
+    raise CallbackTimeout()
+
+
+def invoke(path, task, status, timeout=None):
+    """在线程池/进程池中执行的入口, timeout只在进程的主线程中通过SIGALRM生效"""
+    func, error = resolve(path)
+    if func is None:
+        raise ImportError(error)
+    alarm = timeout and hasattr(signal, 'SIGALRM') and threading.current_thread() is threading.main_thread()
+    if alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(task, status)
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
 
 
 class Callback:
+    """回调引擎, 线程池/进程池和超时检查线程在第一次提交时创建"""
+
+    def __init__(self, mode='thread', workers=4, max_pending=1000, timeout=30, block=0, recent_runs=10000,
+                 latency_samples=1000):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f'invalid callback mode: {mode}')
+        self.mode = mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.block = block
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._inflight = {}
+        # 超时但还没有结束的回调, 结束时才释放名额
+        self._abandoned = set()
+        self._recent_runs = OrderedDict()
+        self.recent_runs = recent_runs
+        self._deadlines = []
+        self._seq = itertools.count()
+        self._latencies = deque(maxlen=latency_samples)
+        self._counts = dict.fromkeys(('submitted', 'completed', 'failed', 'timeouts', 'rejected', 'duplicates'), 0)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._watchdog = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(**{key: value for key, value in _config.items() if key != 'cache_size'})
+
+    def _start(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            if self.mode == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=django.setup)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='task-callback')
+            self._watchdog = threading.Thread(target=self._watch, name='task-callback-watchdog', daemon=True)
+            self._watchdog.start()
+
+    def submit(self, path, task: dict, status):
+        """提交一个回调, 返回Future; 超过max_pending被拒绝时返回None"""
+        if self._executor is None:
+            self._start()
+        acquired = self._slots.acquire(timeout=self.block) if self.block else self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self._counts['rejected'] += 1
+            logger.warning('callback %s of task %s rejected, %s pending', path, task.get('id'), self.max_pending)
+            return None
+        started = monotonic()
+        future = self._executor.submit(invoke, path, task, status, self.timeout if self.mode == 'process' else None)
+        with self._lock:
+            self._counts['submitted'] += 1
+            self._inflight[future] = (path, started)
+            if self.timeout:
+                heapq.heappush(self._deadlines, (started + self.timeout, next(self._seq), future))
+        self._wakeup.set()
+        future.add_done_callback(self._done)
+        return future
+
+    def run(self, task, status, **extra):
+        """任务结束后调用任务的回调, task为Task实例, extra(如run、result)一并传给回调"""
+        if not task.callback:
+            return None
+        if extra.get('run') is not None and self._seen((task.id, extra['run'])):
+            return None
+        return self.submit(task.callback, {'id': str(task.id), 'name': task.name, **extra}, status)
+
+    def _seen(self, key):
+        with self._lock:
+            if key in self._recent_runs:
+                self._counts['duplicates'] += 1
+                return True
+            self._recent_runs[key] = None
+            if len(self._recent_runs) > self.recent_runs:
+                self._recent_runs.popitem(last=False)
+        return False
+
+    def _done(self, future):
+        with self._lock:
+            item = self._inflight.pop(future, None)
+            if item is None:
+                if future in self._abandoned:
+                    self._abandoned.discard(future)
+                    self._slots.release()
+                return
+            path, started = item
+            self._latencies.append(monotonic() - started)
+            failed = future.cancelled() or future.exception() is not None
+            self._counts['failed' if failed else 'completed'] += 1
+        self._slots.release()
+        if failed and not future.cancelled():
+            logger.error('callback %s failed: %r', path, future.exception())
+
+    def _watch(self):
+        while True:
+            self._wakeup.clear()
+            timed_out = []
+            with self._lock:
+                now = monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, _, future = heapq.heappop(self._deadlines)
+                    item = self._inflight.pop(future, None)
+                    if item is not None:
+                        self._counts['timeouts'] += 1
+                        self._latencies.append(now - item[1])
+                        self._abandoned.add(future)
+                        timed_out.append((future, item[0]))
+                wait = self._deadlines[0][0] - now if self._deadlines else None
+            for future, path in timed_out:
+                # 还在排队的回调直接取消, 名额在done回调中释放; done回调会获取锁, 需要在锁外执行
+                future.cancel()
+                logger.warning('callback %s timed out after %ss', path, self.timeout)
+            self._wakeup.wait(wait)
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            data = dict(self._counts, mode=self.mode, workers=self.workers, max_pending=self.max_pending,
+                        pending=len(self._inflight), abandoned=len(self._abandoned))
+        if latencies:
+            data['latency'] = {name: latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+                               for name, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))}
+            data['latency']['max'] = latencies[-1]
+        else:
+            data['latency'] = None
+        return data
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=not wait)
 
-    def run(self, task, status):
-        pass
 
+engine = Callback.from_settings()
+atexit.register(engine.shutdown, False)
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',
+                        'django.core.cache.backends.dummy.DummyCache')
+
+
+@register(Tags.caches, deploy=True)
+def check_invalidation(app_configs, **kwargs):
+    """路由表和IP白名单的跨进程失效需要共享的缓存和broker"""
+    warnings = []
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES:
+        warnings.append(Warning(
+            f'CACHES["default"]使用{backend}, 路由表和IP白名单的版本号只在本进程内有效',
+            hint='多进程部署时配置redis/memcached等共享缓存', id='task_system.W001'))
+    if getattr(settings, 'TASK_INVALIDATION_BROKER', 'memory://').startswith('memory://'):
+        warnings.append(Warning(
+            'TASK_INVALIDATION_BROKER为memory://, 失效广播只在本进程内传递',
+            hint='多进程部署时配置为共享的broker, 如redis://或amqp://', id='task_system.W002'))
+    return warnings
@@ -11,6 +11,15 @@ class TaskState(TextChoices):
     REVOKED = 'REVOKED'
 
 
+class DagState(TextChoices):
+    WAITING = 'WAITING', '等待依赖'
+    QUEUED = 'QUEUED', '已发布'
+    RUNNING = 'RUNNING', '运行中'
+    SUCCESS = 'SUCCESS', '成功'
+    FAILURE = 'FAILURE', '失败'
+    SKIPPED = 'SKIPPED', '跳过'
+
+
 class ScheduleStatus(TextChoices):
     OPENING = 'O', '开启'
     AUTO = 'A', '自动'
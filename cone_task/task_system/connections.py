@@ -0,0 +1,109 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from kombu import Connection
+
+
+class BrokerPools:
+    """
+        每个进程按Queue.connection维护一个长连接池, 连接上的default_channel随连接复用;
+        连接池被invalidate后不再分配, 已取出的连接继续使用, 全部归还后才关闭
+        配置(settings.TASK_BROKER_POOL):
+        {
+            "limit": 10,                # 每个connection的最大连接数
+            "acquire_timeout": 5,       # 连接池耗尽时的等待秒数
+            "max_retries": 3,           # 连接失败时的重连次数
+        }
+    """
+
+    def __init__(self, limit=10, acquire_timeout=5, max_retries=3):
+        self.limit = limit
+        self.acquire_timeout = acquire_timeout
+        self.max_retries = max_retries
+        self._pools = {}
+        self._queue_connections = {}
+        # 每个连接池已取出的连接数, 以及已经失效、等待连接归还后关闭的连接池
+        self._active = defaultdict(int)
+        self._retired = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(**getattr(settings, 'TASK_BROKER_POOL', {}))
+
+    def _get_pool(self, url):
+        pool = self._pools.get(url)
+        if pool is None:
+            pool = self._pools[url] = Connection(url).Pool(limit=self.limit)
+        return pool
+
+    def _checkout(self, url):
+        with self._lock:
+            pool = self._get_pool(url)
+            self._active[pool] += 1
+        return pool
+
+    def _checkin(self, pool):
+        with self._lock:
+            self._active[pool] -= 1
+            if self._active[pool]:
+                return
+            del self._active[pool]
+            if pool not in self._retired:
+                return
+            self._retired.discard(pool)
+        pool.force_close_all()
+
+    def acquire(self, queue):
+        """取出queue所在broker的连接, 记录queue使用的connection, Queue修改后invalidate关闭旧的连接池"""
+        self._queue_connections[queue.name] = queue.connection
+        return self.connection(queue.connection)
+
+    @contextmanager
+    def connection(self, url):
+        """
+            从连接池取出一个可用连接, 取出时做健康检查, 连接断开则重连;
+            使用过程中出现连接/通道错误时丢弃底层连接, 下次取出时自动重建
+        """
+        pool = self._checkout(url)
+        try:
+            conn = pool.acquire(block=True, timeout=self.acquire_timeout)
+        except BaseException:
+            self._checkin(pool)
+            raise
+        try:
+            if not conn.connected:
+                conn.collect()
+            conn.ensure_connection(max_retries=self.max_retries)
+            yield conn
+        except (conn.connection_errors + conn.channel_errors):
+            conn.collect()
+            raise
+        finally:
+            conn.release()
+            self._checkin(pool)
+
+    def close(self, url):
+        """连接池不再分配新连接, 没有取出的连接时立即关闭, 否则等最后一个连接归还时关闭"""
+        with self._lock:
+            pool = self._pools.pop(url, None)
+            if pool is None:
+                return
+            if self._active.get(pool):
+                self._retired.add(pool)
+                return
+        pool.force_close_all()
+
+    def invalidate(self, queue):
+        """Queue修改或删除后关闭其旧连接和新连接对应的连接池"""
+        old_url = self._queue_connections.pop(queue.name, None)
+        for url in {old_url, queue.connection} - {None}:
+            self.close(url)
+
+    def close_all(self):
+        for url in list(self._pools):
+            self.close(url)
+
+
+pools = BrokerPools.from_settings()
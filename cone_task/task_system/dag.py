@@ -0,0 +1,194 @@
+"""
+    按Task.parent执行DAG, 父任务成功后才发布子任务:
+    - start: 递归CTE一次查出根任务的全部后代, 用Kahn算法拓扑排序, parent成环时在发布任何任务之前报错;
+      依赖图{父: [子]}保存在DagRun.graph, 每个任务一行DagRunTask记录剩余的依赖数;
+    - advance: worker上报的事件带有dag(消息头x-dag-run)时, 成功的任务按依赖图给子任务的依赖数减一,
+      减到0的子任务在同一批中按队列发布, 每完成一个任务只处理它的出边, 不再查询依赖图;
+    - 失败的任务在依赖图中的后代标记为SKIPPED, 全部任务结束后DagRun结束
+"""
+import logging
+import uuid
+from collections import Counter, defaultdict, deque
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from kombu import Exchange
+from .choices import DagState, TaskState
+from .connections import pools
+from . import broker
+from . import models
+
+logger = logging.getLogger(__name__)
+
+DAG_HEADER = 'x-dag-run'
+FAILED_STATES = (TaskState.FAILURE, TaskState.REVOKED)
+FINISHED_STATES = (TaskState.SUCCESS, ) + FAILED_STATES
+
+
+class CycleError(ValueError):
+
+    def __init__(self, task_ids):
+        self.task_ids = task_ids
+        super().__init__('parent成环: %s' % ', '.join(sorted(map(str, task_ids))))
+
+
+def _descendants(root_id):
+    """递归CTE查出root及其全部后代的(id, parent_id), UNION去重保证parent成环时也能结束"""
+    meta, qn = models.Task._meta, connection.ops.quote_name
+    pk, parent = meta.pk, meta.get_field('parent')
+    table, pk_column, parent_column = qn(meta.db_table), qn(pk.column), qn(parent.column)
+    sql = f'''
+        WITH RECURSIVE descendants(id, parent_id) AS (
+            SELECT {pk_column}, {parent_column} FROM {table} WHERE {pk_column} = %s
+            UNION
+            SELECT t.{pk_column}, t.{parent_column} FROM {table} t JOIN descendants d ON t.{parent_column} = d.id
+        )
+        SELECT id, parent_id FROM descendants
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [pk.get_db_prep_value(root_id, connection)])
+        return [(pk.to_python(task_id), pk.to_python(parent_id) if parent_id is not None else None)
+                for task_id, parent_id in cursor.fetchall()]
+
+
+def topological_sort(nodes, graph):
+    """Kahn算法, 返回(拓扑序, 每个节点的入度); 有环时抛出CycleError, 包含所有无法排序的节点"""
+    indegree = dict.fromkeys(nodes, 0)
+    for children in graph.values():
+        for child in children:
+            indegree[child] += 1
+    remaining = dict(indegree)
+    ready = deque(node for node, degree in remaining.items() if not degree)
+    order = []
+    while ready:
+        node = ready.popleft()
+        order.append(node)
+        for child in graph.get(node, ()):
+            remaining[child] -= 1
+            if not remaining[child]:
+                ready.append(child)
+    if len(order) < len(indegree):
+        raise CycleError([node for node, degree in remaining.items() if degree])
+    return order, indegree
+
+
+def build_graph(root_id):
+    rows = _descendants(root_id)
+    if not rows:
+        raise models.Task.DoesNotExist(root_id)
+    nodes = [task_id for task_id, _ in rows]
+    graph = defaultdict(list)
+    node_set = set(nodes)
+    for task_id, parent_id in rows:
+        if parent_id in node_set:
+            graph[parent_id].append(task_id)
+    return nodes, graph
+
+
+def start(root_id):
+    """以root_id为根启动一次DAG运行, 返回(DagRun, 发布的任务数)"""
+    nodes, graph = build_graph(root_id)
+    order, indegree = topological_sort(nodes, graph)
+    no_queue = list(models.Task.objects.filter(id__in=nodes, queue__isnull=True).values_list('id', flat=True))
+    if no_queue:
+        raise ValueError('任务没有队列: %s' % ', '.join(map(str, no_queue)))
+    with transaction.atomic():
+        run = models.DagRun.objects.create(root_id=root_id, graph={
+            str(parent): [str(child) for child in children] for parent, children in graph.items()})
+        models.DagRunTask.objects.bulk_create([
+            models.DagRunTask(dag_run=run, task_id=task_id, remaining=indegree[task_id]) for task_id in order
+        ], batch_size=1000)
+    released = _release(run, [task_id for task_id in order if not indegree[task_id]])
+    _finish_if_done(run)
+    return run, released
+
+
+def _claim(queryset, state):
+    """一条条件UPDATE修改状态并打上claim标记, 并发处理同一批任务时每个任务只会被一个请求修改"""
+    claim = uuid.uuid4()
+    queryset.update(state=state, claim=claim)
+    return list(models.DagRunTask.objects.filter(claim=claim).values_list('task_id', flat=True))
+
+
+def _release(run: models.DagRun, task_ids):
+    """发布依赖已全部完成的任务, 同一队列的任务一次批量发布, 返回发布成功的任务数"""
+    if not task_ids:
+        return 0
+    ready = models.DagRunTask.objects.filter(dag_run=run, task_id__in=task_ids, state=DagState.WAITING,
+                                             remaining=0)
+    task_ids = _claim(ready, DagState.QUEUED)
+    by_queue = defaultdict(list)
+    for task in models.Task.objects.filter(id__in=task_ids).select_related('queue__exchange'):
+        by_queue[task.queue].append(task)
+    published, headers = set(), {DAG_HEADER: str(run.id)}
+    for queue, tasks in by_queue.items():
+        exchange = Exchange(name=queue.exchange.name, type=queue.exchange.type)
+        try:
+            with pools.acquire(queue) as conn:
+                for result in broker.publish_loaded_tasks(conn, queue, exchange, queue.routing_key, tasks,
+                                                          headers=headers):
+                    if result['status'] == 'published':
+                        published.add(result['id'])
+        except Exception:
+            logger.exception('publish dag %s tasks to queue %s failed', run.id, queue)
+    failed = [task_id for task_id in task_ids if str(task_id) not in published]
+    if failed:
+        logger.warning('dag %s: %s tasks failed to publish', run.id, len(failed))
+        models.DagRunTask.objects.filter(dag_run=run, task_id__in=failed).update(state=DagState.FAILURE)
+        _skip_descendants(run, failed)
+    return len(task_ids) - len(failed)
+
+
+def _skip_descendants(run: models.DagRun, task_ids):
+    skipped, stack = set(), [str(task_id) for task_id in task_ids]
+    while stack:
+        for child in run.graph.get(stack.pop(), ()):
+            if child not in skipped:
+                skipped.add(child)
+                stack.append(child)
+    if skipped:
+        models.DagRunTask.objects.filter(dag_run=run, task_id__in=skipped, state=DagState.WAITING).update(
+            state=DagState.SKIPPED)
+
+
+def _finish_if_done(run: models.DagRun):
+    tasks = models.DagRunTask.objects.filter(dag_run=run)
+    if tasks.filter(state__in=(DagState.WAITING, DagState.QUEUED)).exists():
+        return
+    failed = tasks.filter(state__in=(DagState.FAILURE, DagState.SKIPPED)).exists()
+    models.DagRun.objects.filter(id=run.id, state=DagState.RUNNING).update(
+        state=DagState.FAILURE if failed else DagState.SUCCESS, finish_time=timezone.now())
+
+
+def _advance(run: models.DagRun, finished):
+    queued = models.DagRunTask.objects.filter(dag_run=run, state=DagState.QUEUED)
+    succeeded = _claim(queued.filter(task_id__in=[task_id for task_id, state in finished.items()
+                                                  if state == TaskState.SUCCESS]), DagState.SUCCESS)
+    failed = _claim(queued.filter(task_id__in=[task_id for task_id, state in finished.items()
+                                               if state in FAILED_STATES]), DagState.FAILURE)
+    # 子任务可能同时依赖本批中的多个任务, 按减少量分组更新
+    decrements = Counter(child for task_id in succeeded for child in run.graph.get(str(task_id), ()))
+    by_count = defaultdict(list)
+    for child, count in decrements.items():
+        by_count[count].append(child)
+    waiting = models.DagRunTask.objects.filter(dag_run=run, state=DagState.WAITING)
+    for count, children in by_count.items():
+        waiting.filter(task_id__in=children).update(remaining=F('remaining') - count)
+    _skip_descendants(run, failed)
+    released = _release(run, list(decrements))
+    _finish_if_done(run)
+    return released
+
+
+def advance(events):
+    """
+        应用worker上报的结束事件[(dag_run_id, task_id, state)], 发布依赖已全部完成的子任务;
+        同一任务重复上报时只处理一次, 返回发布的任务数
+    """
+    if not events:
+        return 0
+    by_run = defaultdict(dict)
+    for dag_run_id, task_id, state in events:
+        by_run[uuid.UUID(str(dag_run_id))][task_id] = state
+    runs = models.DagRun.objects.filter(state=DagState.RUNNING).in_bulk(list(by_run))
+    return sum(_advance(run, by_run[run_id]) for run_id, run in runs.items())
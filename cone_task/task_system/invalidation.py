@@ -0,0 +1,140 @@
+"""
+    进程内快照(路由表、IP白名单)的跨进程失效:
+    - 每个命名空间在共享缓存(django cache)中保存版本号, 数据变更的事务提交后递增, 多进程部署时CACHES必须是共享缓存;
+    - 递增后通过kombu的fanout交换机广播失效消息, 默认使用memory://只在进程内传递, 作为pub/sub的本地替代,
+      多进程/多节点部署时配置settings.TASK_INVALIDATION_BROKER为共享的broker, 其它进程收到后立即丢弃快照;
+    - 广播可能丢失, 快照使用时最多每TASK_CACHE_CHECK_INTERVAL秒比较一次版本号, 不一致时丢弃快照重新加载
+"""
+import logging
+import socket
+import threading
+import uuid
+from collections import defaultdict
+from time import monotonic
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from kombu import Connection, Consumer, Exchange, Producer, Queue
+from .connections import pools
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'task:version:%s'
+# 管理后台父任务选项缓存的命名空间
+TASK_PARENTS = 'task-parents'
+
+
+def get_version(namespace):
+    return cache.get(VERSION_KEY % namespace, 0)
+
+
+def incr_version(namespace):
+    key = VERSION_KEY % namespace
+    cache.add(key, 0, timeout=None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # 版本号在add和incr之间被淘汰, 重新写入后其它进程比较时同样会发现不一致
+        cache.set(key, 1, timeout=None)
+        return 1
+
+
+class Stamp:
+    """快照加载时的版本号, is_stale按interval间隔比较共享缓存中的版本号"""
+
+    def __init__(self, namespace, interval=1):
+        self.namespace = namespace
+        self.interval = interval
+        self.version = None
+        self.next_check = 0
+
+    def reset(self):
+        """加载快照前调用, 先读版本号再读数据库, 加载期间发生的修改会在下次检查时发现"""
+        self.version = get_version(self.namespace)
+        self.next_check = monotonic() + self.interval
+
+    def is_stale(self):
+        now = monotonic()
+        if now < self.next_check:
+            return False
+        self.next_check = now + self.interval
+        return get_version(self.namespace) != self.version
+
+    def advance(self, version):
+        """本进程的修改已经增量应用到快照, 中间没有其它进程的修改时直接采用新版本号"""
+        if self.version == version - 1:
+            self.version = version
+
+
+class Broadcaster:
+    """失效消息的发布和订阅, 每个进程一个订阅队列, 由后台线程接收"""
+
+    def __init__(self, url='memory://', exchange='task.invalidation'):
+        self.url = url
+        self.exchange = Exchange(exchange, type='fanout', durable=False, delivery_mode='transient')
+        self.node = uuid.uuid4().hex
+        self._callbacks = defaultdict(list)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def subscribe(self, namespace, callback):
+        self._callbacks[namespace].append(callback)
+
+    def publish(self, namespace, version):
+        try:
+            with pools.connection(self.url) as conn:
+                Producer(conn.default_channel).publish(
+                    {'namespace': namespace, 'version': version, 'node': self.node},
+                    exchange=self.exchange, routing_key='', declare=[self.exchange], serializer='json')
+        except Exception:
+            logger.exception('broadcast invalidation of %s failed', namespace)
+
+    def _on_message(self, body, message):
+        if body.get('node') == self.node:
+            return
+        for callback in self._callbacks.get(body.get('namespace'), ()):
+            callback()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='task-invalidation', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        queue = Queue(f'{self.exchange.name}.{self.node}', self.exchange, durable=False, exclusive=True,
+                      auto_delete=True)
+        while not self._stopped.is_set():
+            try:
+                with Connection(self.url) as conn:
+                    with Consumer(conn, queues=[queue], callbacks=[self._on_message], no_ack=True):
+                        while not self._stopped.is_set():
+                            try:
+                                conn.drain_events(timeout=1)
+                            except socket.timeout:
+                                pass
+            except Exception:
+                logger.exception('receive invalidation failed')
+                self._stopped.wait(5)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+broadcaster = Broadcaster(getattr(settings, 'TASK_INVALIDATION_BROKER', 'memory://'))
+
+
+def changed(stamp: Stamp):
+    """数据变更后调用, 事务提交后递增版本号并广播"""
+    def bump():
+        version = incr_version(stamp.namespace)
+        stamp.advance(version)
+        broadcaster.publish(stamp.namespace, version)
+    transaction.on_commit(bump)
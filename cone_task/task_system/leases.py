@@ -0,0 +1,157 @@
+import logging
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from kombu import Exchange, Producer
+from .connections import pools
+from . import broker
+from . import models
+
+logger = logging.getLogger(__name__)
+
+DELIVERIES_HEADER = 'x-lease-deliveries'
+
+
+def _to_lease(message, queue: models.Queue, exchange: Exchange, routing_key, lease_until):
+    body = message.body
+    if isinstance(body, bytes):
+        body = body.decode(message.content_encoding or 'utf-8')
+    headers = dict(message.headers or {})
+    return models.MessageLease(queue=queue.name, exchange=exchange.name, exchange_type=exchange.type,
+                               routing_key=routing_key, body=body, content_type=message.content_type,
+                               content_encoding=message.content_encoding, headers=headers,
+                               priority=message.properties.get('priority'),
+                               deliveries=int(headers.get(DELIVERIES_HEADER, 0)) + 1, lease_until=lease_until)
+
+
+def lease(conn, queue: models.Queue, exchange: Exchange, routing_key, limit=1, wait=0, timeout=60):
+    """
+        租用模式取消息: 取出的消息先保存为MessageLease再向broker确认, 保存失败时消息退回队列;
+        返回消息列表, 每条附带token/lease_until/deliveries, 消费者在lease_until之前用token确认
+    """
+    lease_until = timezone.now() + timedelta(seconds=timeout)
+    with broker.consume(conn, queue, exchange, limit, wait, no_ack=False) as messages:
+        leases = [_to_lease(message, queue, exchange, routing_key, lease_until) for message in messages]
+        models.MessageLease.objects.bulk_create(leases)
+        data = []
+        for message, item in zip(messages, leases):
+            data.append(dict(broker.message_to_dict(message), token=item.token, lease_until=item.lease_until,
+                             deliveries=item.deliveries))
+    if leases:
+        sweeper.start()
+    return data
+
+
+def ack(tokens):
+    """确认消息, 返回确认的条数; 已超时被重新发布的消息不会再被确认"""
+    return models.MessageLease.objects.filter(token__in=tokens).delete()[0]
+
+
+def _claim(queryset, now: datetime, claim_timeout):
+    """
+        用一条条件UPDATE给本批租约打上claim标记, 多个进程同时处理时每条租约只会被一个进程认领;
+        认领后lease_until推迟claim_timeout, 进程在重新发布前退出的话到期后再被其它进程认领
+    """
+    claim = uuid.uuid4()
+    queryset.update(claim=claim, lease_until=now + timedelta(seconds=claim_timeout))
+    return list(models.MessageLease.objects.filter(claim=claim))
+
+
+def _republish(leases):
+    """按队列把租约里的消息重新发布, 返回成功发布的租约token"""
+    by_queue = defaultdict(list)
+    for item in leases:
+        by_queue[item.queue].append(item)
+    queues = models.Queue.objects.select_related('exchange').in_bulk(list(by_queue))
+    published = []
+    for name, items in by_queue.items():
+        queue = queues.get(name)
+        if queue is None:
+            logger.warning('queue %s not found, %s leased messages dropped', name, len(items))
+            published.extend(item.token for item in items)
+            continue
+        try:
+            with pools.acquire(queue) as conn:
+                channel = conn.default_channel
+                producer = Producer(channel)
+                declared = set()
+                for item in items:
+                    exchange = Exchange(item.exchange, type=item.exchange_type)
+                    if item.exchange not in declared:
+                        broker.build_queue(queue, exchange, channel=channel).declare()
+                        declared.add(item.exchange)
+                    producer.publish(item.body, exchange=exchange, routing_key=item.routing_key,
+                                     content_type=item.content_type, content_encoding=item.content_encoding,
+                                     priority=item.priority,
+                                     headers=dict(item.headers, **{DELIVERIES_HEADER: item.deliveries}))
+                    published.append(item.token)
+        except Exception:
+            logger.exception('republish leased messages to queue %s failed', name)
+    models.MessageLease.objects.filter(token__in=published).delete()
+    return published
+
+
+def nack(tokens, requeue=True, now: datetime = None, claim_timeout=30):
+    """退回消息: requeue为True时重新发布到原队列, 否则丢弃; 返回处理的条数"""
+    if not requeue:
+        return ack(tokens)
+    now = now or timezone.now()
+    queryset = models.MessageLease.objects.filter(Q(claim__isnull=True) | Q(lease_until__lt=now), token__in=tokens)
+    return len(_republish(_claim(queryset, now, claim_timeout)))
+
+
+def sweep(now: datetime = None, batch_size=1000, claim_timeout=30):
+    """把租约已过期的消息重新发布到原队列, 返回重新发布的条数"""
+    now = now or timezone.now()
+    total = 0
+    while True:
+        tokens = list(models.MessageLease.objects.filter(lease_until__lt=now).values_list('token', flat=True)
+                      [:batch_size])
+        if not tokens:
+            return total
+        queryset = models.MessageLease.objects.filter(token__in=tokens, lease_until__lt=now)
+        published = _republish(_claim(queryset, now, claim_timeout))
+        total += len(published)
+        if len(tokens) < batch_size or not published:
+            return total
+
+
+class LeaseSweeper:
+    """后台线程每interval秒执行一次sweep, 进程第一次产生租约时启动"""
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='lease-sweeper', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                sweep()
+            except Exception:
+                logger.exception('sweep leases failed')
+        connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+sweeper = LeaseSweeper(getattr(settings, 'TASK_LEASE_SWEEP_INTERVAL', 5))
@@ -0,0 +1,99 @@
+"""
+    内置broker: Queue.connection配置为local://时, 消息保存在项目数据库的LocalMessage表中, 不需要外部AMQP服务;
+    作为kombu的virtual transport实现, 连接池、批量获取、长轮询、推送、租约等逻辑与AMQP队列完全一致;
+    消息按发布时的priority(即Task.priority)从高到低出队, 同优先级先进先出
+"""
+from json import dumps, loads
+from queue import Empty
+from django.db import DatabaseError, connection, transaction
+from kombu.transport import TRANSPORT_ALIASES, virtual
+from . import models
+
+
+def supports_delete_returning():
+    """DELETE ... RETURNING: PostgreSQL、SQLite 3.35+、MariaDB 10.5+支持, MySQL和Oracle不支持"""
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    if connection.vendor == 'mysql':
+        return connection.mysql_is_mariadb and connection.mysql_version >= (10, 5)
+    return False
+
+
+class Channel(virtual.Channel):
+    # 取出时最多重试的次数, 并发消费时选中的消息可能已被其它消费者删除
+    max_get_retries = 10
+
+    def _new_queue(self, queue, **kwargs):
+        pass
+
+    def _has_queue(self, queue, **kwargs):
+        return True
+
+    def _get(self, queue, timeout=None):
+        for _ in range(self.max_get_retries):
+            if supports_delete_returning():
+                payload = self._delete_returning(queue)
+            else:
+                payload = self._select_and_delete(queue)
+            if payload is not None:
+                return loads(payload)
+        raise Empty()
+
+    @staticmethod
+    def _delete_returning(queue):
+        """查出优先级最高的消息后按id DELETE ... RETURNING, 省去事务和再次查询; 被其它消费者抢先删除时返回None"""
+        table = connection.ops.quote_name(models.LocalMessage._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT id FROM {table} WHERE queue = %s ORDER BY priority DESC, id LIMIT 1', [queue])
+            row = cursor.fetchone()
+            if row is None:
+                raise Empty()
+            cursor.execute(f'DELETE FROM {table} WHERE id = %s RETURNING payload', [row[0]])
+            row = cursor.fetchone()
+        return row and row[0]
+
+    @staticmethod
+    def _select_and_delete(queue):
+        messages = models.LocalMessage.objects.filter(queue=queue).order_by('-priority', 'id')
+        with transaction.atomic():
+            if connection.features.has_select_for_update_skip_locked:
+                messages = messages.select_for_update(skip_locked=True)
+            row = messages.values_list('id', 'payload').first()
+            if row is None:
+                raise Empty()
+            # 条件删除成功的消费者才取得这条消息
+            return row[1] if models.LocalMessage.objects.filter(id=row[0]).delete()[0] else None
+
+    def _put(self, queue, message, **kwargs):
+        try:
+            priority = int(message['properties'].get('priority') or 0)
+        except (TypeError, ValueError):
+            priority = 0
+        models.LocalMessage.objects.create(queue=queue, priority=priority, payload=dumps(message))
+
+    def _size(self, queue):
+        return models.LocalMessage.objects.filter(queue=queue).count()
+
+    def _purge(self, queue):
+        return models.LocalMessage.objects.filter(queue=queue).delete()[0]
+
+    def _delete(self, queue, *args, **kwargs):
+        self._purge(queue)
+
+
+class Transport(virtual.Transport):
+    Channel = Channel
+
+    polling_interval = 0.1
+    driver_type = driver_name = 'local'
+    connection_errors = virtual.Transport.connection_errors + (DatabaseError, )
+    channel_errors = virtual.Transport.channel_errors + (DatabaseError, )
+
+    def driver_version(self):
+        return '1.0'
+
+
+def register():
+    TRANSPORT_ALIASES.setdefault('local', 'task_system.local_broker:Transport')
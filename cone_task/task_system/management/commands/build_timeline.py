@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from task_system import models
+from task_system import timeline
+
+
+class Command(BaseCommand):
+    help = '重新生成所有启用任务的ScheduledRun运行计划'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, help='每个任务预先计算的运行次数, 默认为settings.TASK_TIMELINE_SIZE或10')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批处理的任务数')
+
+    def handle(self, *args, **options):
+        size, batch_size = options['size'], options['batch_size']
+        models.ScheduledRun.objects.all().delete()
+        tasks = models.Task.objects.filter(enabled=True, schedule__isnull=False).select_related('schedule')
+        batch, total = [], 0
+        for task in tasks.iterator(chunk_size=batch_size):
+            batch.append(task)
+            if len(batch) >= batch_size:
+                timeline.rebuild(batch, size)
+                total, batch = total + len(batch), []
+        timeline.rebuild(batch, size)
+        self.stdout.write(f'rebuilt timeline for {total + len(batch)} tasks')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from task_system import tasklog
+
+
+class Command(BaseCommand):
+    help = '分批删除过期的任务日志, 每批单独提交, 不会长时间锁表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, help='保留最近多少天的日志, 默认为settings.TASK_LOG_RETENTION_DAYS或30')
+        parser.add_argument('--batch-size', type=int, default=5000, help='每批删除的日志数')
+        parser.add_argument('--pause', type=float, default=0.1, help='每批之间等待的秒数')
+        parser.add_argument('--state', action='append', help='只删除指定状态的日志, 可以指定多次')
+
+    def handle(self, *args, **options):
+        before = tasklog.retention_cutoff(options['days'])
+        deleted = tasklog.prune(before, batch_size=options['batch_size'], pause=options['pause'],
+                                states=options['state'])
+        self.stdout.write(f'deleted {deleted} task logs created before {before.isoformat()}')
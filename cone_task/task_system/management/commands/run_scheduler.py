@@ -0,0 +1,29 @@
+import signal
+from django.core.management.base import BaseCommand
+from task_system.scheduler import Scheduler
+from task_system.sharding import ShardCoordinator
+
+
+class Command(BaseCommand):
+    help = '调度进程: 扫描到期任务并发布到对应队列'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=float, default=60, help='每次加载未来多少秒内的任务')
+        parser.add_argument('--refill-interval', type=float, default=10, help='重新加载任务的间隔秒数')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批发布和更新的任务数')
+        parser.add_argument('--retry-delay', type=float, default=5, help='发布失败后重试的间隔秒数')
+        parser.add_argument('--node', help='节点名, 默认为hostname:pid')
+        parser.add_argument('--shards', type=int, help='分片数, 默认为settings.TASK_SCHEDULER_SHARDS或64')
+        parser.add_argument('--ttl', type=float, default=30, help='节点心跳和分片租约的有效秒数')
+        parser.add_argument('--standalone', action='store_true', help='单节点运行, 不参与分片')
+
+    def handle(self, *args, **options):
+        coordinator = None
+        if not options['standalone']:
+            coordinator = ShardCoordinator(name=options['node'], shards=options['shards'], ttl=options['ttl'])
+        scheduler = Scheduler(window=options['window'], refill_interval=options['refill_interval'],
+                              batch_size=options['batch_size'], retry_delay=options['retry_delay'],
+                              coordinator=coordinator)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: scheduler.stop())
+        scheduler.run()
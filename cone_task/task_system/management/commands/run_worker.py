@@ -0,0 +1,28 @@
+import signal
+from django.core.management.base import BaseCommand, CommandError
+from task_system import models
+from task_system.worker import Worker
+
+
+class Command(BaseCommand):
+    help = 'worker进程: 消费指定队列并执行任务的function, 运行状态批量写入任务日志'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queue', help='队列编码')
+        parser.add_argument('--mode', choices=('thread', 'process', 'asyncio'), default='thread', help='执行方式')
+        parser.add_argument('--concurrency', type=int, default=4, help='同时执行的任务数')
+        parser.add_argument('--prefetch', type=int, help='未确认的消息数上限, 默认为concurrency的2倍')
+        parser.add_argument('--report-interval', type=float, default=1, help='批量上报运行状态的间隔秒数')
+        parser.add_argument('--report-batch', type=int, default=500, help='累计多少个事件后立即上报')
+        parser.add_argument('--max-tasks', type=int, help='处理完多少个任务后退出')
+
+    def handle(self, *args, **options):
+        queue = models.Queue.objects.select_related('exchange').filter(name=options['queue']).first()
+        if queue is None:
+            raise CommandError(f'queue {options["queue"]} not found')
+        worker = Worker(queue, mode=options['mode'], concurrency=options['concurrency'], prefetch=options['prefetch'],
+                        report_interval=options['report_interval'], report_batch=options['report_batch'])
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: worker.stop())
+        processed = worker.run(max_tasks=options['max_tasks'])
+        self.stdout.write(f'{processed} tasks processed')
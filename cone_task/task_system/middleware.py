@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.exceptions import PermissionDenied
+from .whitelist import whitelist
+
+
+def get_client_ip(request):
+    """
+        默认取REMOTE_ADDR; 部署在反向代理后时settings.TASK_WHITELIST_IP_HEADER指定代理写入的请求头(如HTTP_X_FORWARDED_FOR),
+        TASK_WHITELIST_TRUSTED_PROXIES为可信代理的级数: 每级代理在末尾追加它看到的地址, 只有最右边的这几个是可信的,
+        取倒数第N个作为客户端地址, 更左边的由客户端自己填写, 不能使用; 地址数不足时退回REMOTE_ADDR
+    """
+    remote_addr = request.META.get('REMOTE_ADDR') or ''
+    header = getattr(settings, 'TASK_WHITELIST_IP_HEADER', None)
+    proxies = getattr(settings, 'TASK_WHITELIST_TRUSTED_PROXIES', 1)
+    if not header or header == 'REMOTE_ADDR' or proxies < 1:
+        return remote_addr
+    addresses = [ip.strip() for ip in (request.META.get(header) or '').split(',') if ip.strip()]
+    if len(addresses) < proxies:
+        return remote_addr
+    return addresses[-proxies]
+
+
+def check_queues(request, queues):
+    """没有queue参数的接口(ack/nack/report/stream ack)按涉及的队列检查白名单, 不允许时抛出403"""
+    ip = get_client_ip(request)
+    for queue in queues:
+        if not whitelist.is_allowed(queue, ip):
+            raise PermissionDenied(f'IP {ip} Not Allowed')
+
+
+class IPWhitelistMiddleware(MiddlewareMixin):
+    """对带有queue参数的接口(task-get/task-put/stream等)按队列的IP白名单检查客户端地址, 客户端地址见get_client_ip"""
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        queue = view_kwargs.get('queue')
+        if queue is None:
+            return None
+        ip = get_client_ip(request)
+        if not whitelist.is_allowed(queue, ip):
+            return JsonResponse({'detail': f'IP {ip} Not Allowed'}, status=403)
+        return None
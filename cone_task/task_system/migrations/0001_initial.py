@@ -0,0 +1,163 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:54
+
+import datetime
+import django.db.models.deletion
+import django.utils.timezone
+import task_system.models
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Exchange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='名称')),
+                ('type', models.CharField(choices=[('direct', 'Direct'), ('topic', 'Topic'), ('fanout', 'Fanout')], default='direct', max_length=10, verbose_name='类型')),
+                ('is_default', models.BooleanField(default=False, verbose_name='是否默认')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '路由交换',
+                'verbose_name_plural': '路由交换',
+                'db_table': 'ts_exchange',
+            },
+        ),
+        migrations.CreateModel(
+            name='Schedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('schedule_type', models.CharField(choices=[('crontab', 'Crontab'), ('clocked', '指定时间'), ('interval', '连续性'), ('timing', '指定时间'), ('nlp', 'NLP')], default='crontab', max_length=20, verbose_name='计划类型')),
+                ('config', models.JSONField(verbose_name='参数')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '计划中心',
+                'verbose_name_plural': '计划中心',
+                'db_table': 'ts_schedule',
+            },
+        ),
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='标签名')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '任务标签',
+                'verbose_name_plural': '任务标签',
+                'db_table': 'ts_tag',
+            },
+        ),
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='名称')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('parent', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='task_system.category', verbose_name='父类别')),
+            ],
+            options={
+                'verbose_name': '任务类别',
+                'verbose_name_plural': '任务类别',
+                'db_table': 'ts_category',
+            },
+        ),
+        migrations.CreateModel(
+            name='Queue',
+            fields=[
+                ('connection', models.CharField(max_length=200, verbose_name='链接')),
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False, validators=[task_system.models.code_validator], verbose_name='队列编码')),
+                ('routing_key', models.CharField(max_length=100, verbose_name='路由键')),
+                ('status', models.BooleanField(default=True, verbose_name='状态')),
+                ('is_default', models.BooleanField(default=False, verbose_name='是否默认')),
+                ('config', models.JSONField(blank=True, default=dict, null=True, verbose_name='配置')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('exchange', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='task_system.exchange', verbose_name='交换机')),
+            ],
+            options={
+                'verbose_name': '任务队列',
+                'verbose_name_plural': '任务队列',
+                'db_table': 'ts_queue',
+            },
+        ),
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, verbose_name='UUID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='任务名')),
+                ('function', models.CharField(blank=True, max_length=200, null=True, verbose_name='任务函数')),
+                ('description', models.TextField(blank=True, null=True, verbose_name='描述')),
+                ('priority', models.IntegerField(default=0, verbose_name='优先级')),
+                ('next_start_time', models.DateTimeField(db_index=True, default=datetime.datetime(9999, 12, 31, 23, 59, 59, 999999), verbose_name='下次运行时间')),
+                ('is_rigorous', models.BooleanField(default=False, verbose_name='严格模式')),
+                ('callback', models.CharField(blank=True, max_length=500, null=True, verbose_name='回调')),
+                ('preserve_log', models.BooleanField(default=True, verbose_name='保留日志')),
+                ('config', models.JSONField(blank=True, null=True, verbose_name='参数')),
+                ('enabled', models.BooleanField(default=True, verbose_name='启用')),
+                ('last_run_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='上次运行时间')),
+                ('total_run_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='运行次数')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('category', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='task_system.category', verbose_name='类别')),
+                ('parent', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='task_system.task', verbose_name='父任务')),
+                ('queue', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='task_system.queue', verbose_name='队列')),
+                ('schedule', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='task_system.schedule')),
+                ('tags', models.ManyToManyField(db_constraint=False, to='task_system.tag', verbose_name='标签')),
+            ],
+            options={
+                'verbose_name': '任务中心',
+                'verbose_name_plural': '任务中心',
+                'db_table': 'ts_task',
+            },
+        ),
+        migrations.CreateModel(
+            name='TaskLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('PENDING', 'Pending'), ('RECEIVED', 'Received'), ('STARTED', 'Started'), ('SUCCESS', 'Success'), ('FAILURE', 'Failure'), ('RETRY', 'Retry'), ('REVOKED', 'Revoked')], max_length=20, verbose_name='运行状态')),
+                ('queue', models.CharField(max_length=100, verbose_name='队列')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='结果')),
+                ('start_time', models.DateTimeField(verbose_name='运行时间')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+                ('task', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='logs', to='task_system.task', verbose_name='任务')),
+            ],
+            options={
+                'verbose_name': '计划日志',
+                'verbose_name_plural': '计划日志',
+                'db_table': 'ts_task_log',
+                'ordering': ('-create_time',),
+            },
+        ),
+        migrations.CreateModel(
+            name='QueueIPWhitelist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('enabled', models.BooleanField(default=True, verbose_name='启用状态')),
+                ('allowed_ip', models.GenericIPAddressField(verbose_name='白名单IP')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('queue', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='task_system.queue', verbose_name='队列')),
+            ],
+            options={
+                'verbose_name': 'IP白名单',
+                'verbose_name_plural': 'IP白名单',
+                'db_table': 'ts_queue_ip_whitelist',
+                'unique_together': {('queue', 'allowed_ip')},
+            },
+        ),
+    ]
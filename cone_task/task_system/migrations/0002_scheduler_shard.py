@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerNode',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='节点')),
+                ('heartbeat', models.DateTimeField(db_index=True, verbose_name='心跳时间')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '调度节点',
+                'verbose_name_plural': '调度节点',
+                'db_table': 'ts_scheduler_node',
+            },
+        ),
+        migrations.CreateModel(
+            name='SchedulerShard',
+            fields=[
+                ('shard', models.PositiveSmallIntegerField(primary_key=True, serialize=False, verbose_name='分片')),
+                ('owner', models.CharField(blank=True, default='', max_length=100, verbose_name='持有节点')),
+                ('lease_until', models.DateTimeField(blank=True, null=True, verbose_name='租约到期时间')),
+            ],
+            options={
+                'verbose_name': '调度分片',
+                'verbose_name_plural': '调度分片',
+                'db_table': 'ts_scheduler_shard',
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0002_scheduler_shard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_time', models.DateTimeField(verbose_name='运行时间')),
+                ('task', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_runs', to='task_system.task', verbose_name='任务')),
+            ],
+            options={
+                'verbose_name': '运行计划',
+                'verbose_name_plural': '运行计划',
+                'db_table': 'ts_scheduled_run',
+                'ordering': ('run_time',),
+                'indexes': [models.Index(fields=['run_time', 'task'], name='ts_scheduled_run_time_idx')],
+                'unique_together': {('task', 'run_time')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:18
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0003_scheduled_run'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tasklog',
+            name='create_time',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='创建时间'),
+        ),
+        migrations.AlterField(
+            model_name='tasklog',
+            name='task',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='logs', to='task_system.task', verbose_name='任务'),
+        ),
+        migrations.AddIndex(
+            model_name='tasklog',
+            index=models.Index(fields=['task', 'create_time'], name='ts_task_log_task_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tasklog',
+            index=models.Index(fields=['state', 'create_time'], name='ts_task_log_state_time_idx'),
+        ),
+    ]
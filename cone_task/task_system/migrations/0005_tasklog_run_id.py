@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0004_tasklog_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tasklog',
+            name='run_id',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True, verbose_name='运行ID'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:28
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0005_tasklog_run_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageLease',
+            fields=[
+                ('token', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, verbose_name='令牌')),
+                ('queue', models.CharField(max_length=100, verbose_name='队列')),
+                ('exchange', models.CharField(max_length=100, verbose_name='交换机')),
+                ('exchange_type', models.CharField(max_length=10, verbose_name='交换机类型')),
+                ('routing_key', models.CharField(max_length=100, verbose_name='路由键')),
+                ('body', models.TextField(verbose_name='消息体')),
+                ('content_type', models.CharField(blank=True, max_length=100, null=True, verbose_name='内容类型')),
+                ('content_encoding', models.CharField(blank=True, max_length=50, null=True, verbose_name='内容编码')),
+                ('headers', models.JSONField(blank=True, default=dict, verbose_name='消息头')),
+                ('deliveries', models.PositiveIntegerField(default=1, verbose_name='投递次数')),
+                ('lease_until', models.DateTimeField(db_index=True, verbose_name='租约到期时间')),
+                ('claim', models.UUIDField(blank=True, db_index=True, null=True, verbose_name='重新发布批次')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '消息租约',
+                'verbose_name_plural': '消息租约',
+                'db_table': 'ts_message_lease',
+            },
+        ),
+    ]
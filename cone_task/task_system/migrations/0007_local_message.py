@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:30
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0006_message_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocalMessage',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('queue', models.CharField(max_length=200, verbose_name='队列')),
+                ('priority', models.IntegerField(default=0, verbose_name='优先级')),
+                ('payload', models.TextField(verbose_name='消息')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '本地消息',
+                'verbose_name_plural': '本地消息',
+                'db_table': 'ts_local_message',
+                'indexes': [models.Index(fields=['queue', '-priority', 'id'], name='ts_local_message_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0007_local_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelease',
+            name='priority',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='优先级'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:34
+
+import task_system.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0008_message_lease_priority'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='queueipwhitelist',
+            name='allowed_ip',
+            field=models.CharField(max_length=49, validators=[task_system.models.ip_network_validator], verbose_name='白名单IP/网段'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:39
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0009_queue_ip_whitelist_cidr'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DagRun',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, verbose_name='UUID')),
+                ('state', models.CharField(choices=[('WAITING', '等待依赖'), ('QUEUED', '已发布'), ('RUNNING', '运行中'), ('SUCCESS', '成功'), ('FAILURE', '失败'), ('SKIPPED', '跳过')], default='RUNNING', max_length=20, verbose_name='状态')),
+                ('graph', models.JSONField(default=dict, verbose_name='依赖图')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='创建时间')),
+                ('finish_time', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('root', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='dag_runs', to='task_system.task', verbose_name='根任务')),
+            ],
+            options={
+                'verbose_name': 'DAG运行',
+                'verbose_name_plural': 'DAG运行',
+                'db_table': 'ts_dag_run',
+            },
+        ),
+        migrations.CreateModel(
+            name='DagRunTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('WAITING', '等待依赖'), ('QUEUED', '已发布'), ('RUNNING', '运行中'), ('SUCCESS', '成功'), ('FAILURE', '失败'), ('SKIPPED', '跳过')], default='WAITING', max_length=20, verbose_name='状态')),
+                ('remaining', models.PositiveIntegerField(default=0, verbose_name='未完成的依赖数')),
+                ('claim', models.UUIDField(blank=True, db_index=True, null=True, verbose_name='状态变更批次')),
+                ('dag_run', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='tasks', to='task_system.dagrun', verbose_name='DAG运行')),
+                ('task', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='task_system.task', verbose_name='任务')),
+            ],
+            options={
+                'verbose_name': 'DAG运行任务',
+                'verbose_name_plural': 'DAG运行任务',
+                'db_table': 'ts_dag_run_task',
+                'unique_together': {('dag_run', 'task')},
+            },
+        ),
+    ]
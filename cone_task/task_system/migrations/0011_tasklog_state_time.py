@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0010_dag_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tasklog',
+            name='state_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='状态时间'),
+        ),
+    ]
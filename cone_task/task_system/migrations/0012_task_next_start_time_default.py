@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:09
+
+import task_system.schedule.times
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_system', '0011_tasklog_state_time'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='task',
+            name='next_start_time',
+            field=models.DateTimeField(db_index=True, default=task_system.schedule.times.max_time, verbose_name='下次运行时间'),
+        ),
+    ]
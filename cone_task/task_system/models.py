@@ -1,9 +1,12 @@
-from django.db import models
+from django.db import models, connection
 from datetime import datetime
 from django.core.validators import ValidationError
 from django.utils import timezone
-from .choices import TaskState, ScheduleType, ExchangeType
-from .schedule.config import get_next_schedule_time
+from .choices import TaskState, ScheduleType, ExchangeType, DagState
+from .schedule.compiled import compiled_schedules
+from .schedule.bulk import bulk_next_times
+from .schedule.times import to_schedule_time, from_schedule_time, max_time
+import ipaddress
 import re
 import uuid
 
@@ -13,6 +16,13 @@ def code_validator(value):
         raise ValidationError('编码只能包含字母、数字、下划线和中划线')
 
 
+def ip_network_validator(value):
+    try:
+        ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        raise ValidationError('请输入IP地址或CIDR网段, 如10.0.0.1、10.0.0.0/8')
+
+
 class Category(models.Model):
     parent = models.ForeignKey('self', blank=True, null=True, db_constraint=False, on_delete=models.CASCADE,
                                related_name='children', verbose_name='父类别')
@@ -56,8 +66,17 @@ class Schedule(models.Model):
         verbose_name = verbose_name_plural = '计划中心'
         db_table = 'ts_schedule'
 
-    def get_next_time(self, last_time: datetime, is_rigorous=False):
-        return get_next_schedule_time(self.schedule_type, self.config, last_time, is_rigorous)
+    @property
+    def compiled(self):
+        return compiled_schedules.get(self)
+
+    def get_next_time(self, last_time: datetime, is_rigorous=False, now: datetime = None):
+        return self.compiled.next_time(last_time, is_rigorous, now)
+
+    @staticmethod
+    def bulk_next_times(tasks, now: datetime = None):
+        """批量计算tasks的下次运行时间, 按计划类型分组向量化计算"""
+        return bulk_next_times(tasks, now)
 
     def __str__(self):
         return f'{self.schedule_type}'
@@ -117,6 +136,9 @@ class Queue(models.Model):
 
 
 class Task(models.Model):
+    # 影响运行计划(ScheduledRun)的字段, 只有这些字段变化时才重新生成
+    TIMELINE_FIELDS = ('schedule', 'next_start_time', 'enabled')
+
     id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4, verbose_name='UUID')
     schedule = models.ForeignKey(Schedule, db_constraint=False, on_delete=models.SET_NULL, null=True, blank=True)
     parent = models.ForeignKey('self', db_constraint=False, on_delete=models.CASCADE,
@@ -127,7 +149,7 @@ class Task(models.Model):
     tags = models.ManyToManyField(Tag, db_constraint=False, verbose_name='标签')
     description = models.TextField(blank=True, null=True, verbose_name='描述')
     priority = models.IntegerField(default=0, verbose_name='优先级')
-    next_start_time = models.DateTimeField(default=datetime.max, verbose_name='下次运行时间', db_index=True)
+    next_start_time = models.DateTimeField(default=max_time, verbose_name='下次运行时间', db_index=True)
     is_rigorous = models.BooleanField(default=False, verbose_name='严格模式')
     callback = models.CharField(max_length=500, null=True, blank=True, verbose_name='回调')
     preserve_log = models.BooleanField(default=True, verbose_name='保留日志')
@@ -144,19 +166,69 @@ class Task(models.Model):
         verbose_name = verbose_name_plural = '任务中心'
         db_table = 'ts_task'
 
-    def generate_next_task(self):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.saved_timeline_state = instance.timeline_state()
+        return instance
+
+    def timeline_state(self):
+        """TIMELINE_FIELDS的当前值, 延迟加载的字段取None, 不触发查询"""
+        return tuple(self.__dict__.get(self._meta.get_field(name).attname) for name in self.TIMELINE_FIELDS)
+
+    def generate_next_task(self, now: datetime = None):
+        """从last_run_at计算下次运行时间, 没有运行过的任务从now开始计算, 与bulk_generate_next_task一致"""
         if not self.schedule:
             return None
-        next_time = self.schedule.get_next_time(self.last_run_at, self.is_rigorous)
-        if not self.next_start_time:
+        now = to_schedule_time(now or timezone.now())
+        last_time = to_schedule_time(self.last_run_at) or now
+        next_time = self.schedule.get_next_time(last_time, self.is_rigorous, now)
+        if next_time is None:
             self.enabled = False
             # 优化数据库查询, 所以将时间置为最大
-            self.next_start_time = datetime.max
+            self.next_start_time = max_time()
         else:
-            self.next_start_time = next_time
+            self.next_start_time = from_schedule_time(next_time)
         self.save(update_fields=('next_start_time', 'enabled'))
         return self
 
+    @classmethod
+    def bulk_generate_next_task(cls, tasks, now: datetime = None, batch_size=1000):
+        """
+            批量版的generate_next_task, 每batch_size个任务计算一次并用一条bulk_update写回,
+            用于调度停顿或批量启用后重新计算大量任务的next_start_time; 批量写回不触发post_save, 运行计划在这里同步
+        """
+        from . import timeline
+        tasks = [task for task in tasks if task.schedule]
+        for i in range(0, len(tasks), batch_size):
+            chunk = tasks[i: i + batch_size]
+            for task, next_time in zip(chunk, Schedule.bulk_next_times(chunk, now)):
+                if next_time is None:
+                    task.enabled = False
+                    task.next_start_time = max_time()
+                else:
+                    task.next_start_time = from_schedule_time(next_time)
+            cls.bulk_save_next_times(chunk)
+            timeline.extend(chunk, timezone.now())
+        return tasks
+
+    @classmethod
+    def bulk_save_next_times(cls, tasks):
+        """
+            按主键批量写回next_start_time/enabled, 一条参数化UPDATE executemany;
+            bulk_update为每一行构造CASE WHEN表达式, 大批量时耗时主要在表达式解析上
+        """
+        if not tasks:
+            return
+        meta, quote = cls._meta, connection.ops.quote_name
+        fields = [meta.get_field(name) for name in ('next_start_time', 'enabled', 'id')]
+        sql = 'UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s' % (
+            quote(meta.db_table), *(quote(field.column) for field in fields))
+        params = [[field.get_db_prep_save(getattr(task, field.attname), connection) for field in fields]
+                  for task in tasks]
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
     def __str__(self):
         return self.name
 
@@ -170,18 +242,25 @@ class Task(models.Model):
 
 
 class TaskLog(models.Model):
-    task = models.ForeignKey(Task, db_constraint=False, on_delete=models.CASCADE,
+    # (task, create_time)联合索引已覆盖按task查询, 不再单独为外键建索引
+    task = models.ForeignKey(Task, db_constraint=False, db_index=False, on_delete=models.CASCADE,
                              verbose_name='任务', related_name='logs')
+    run_id = models.CharField(max_length=64, null=True, blank=True, unique=True, verbose_name='运行ID')
     state = models.CharField(verbose_name='运行状态', choices=TaskState.choices, max_length=20)
     queue = models.CharField(max_length=100, verbose_name='队列')
     result = models.JSONField(blank=True, null=True, verbose_name='结果')
     start_time = models.DateTimeField(verbose_name='运行时间')
-    create_time = models.DateTimeField(default=timezone.now, verbose_name='创建时间')
+    state_time = models.DateTimeField(null=True, blank=True, verbose_name='状态时间')
+    create_time = models.DateTimeField(default=timezone.now, verbose_name='创建时间', db_index=True)
 
     class Meta:
         verbose_name = verbose_name_plural = '计划日志'
         ordering = ('-create_time',)
         db_table = 'ts_task_log'
+        indexes = [
+            models.Index(fields=('task', 'create_time'), name='ts_task_log_task_time_idx'),
+            models.Index(fields=('state', 'create_time'), name='ts_task_log_state_time_idx'),
+        ]
 
     def __str__(self):
         return "task: %s, status: %s" % (self.task, self.state)
@@ -192,7 +271,7 @@ class TaskLog(models.Model):
 class QueueIPWhitelist(models.Model):
     queue = models.ForeignKey(Queue, db_constraint=False, on_delete=models.CASCADE, verbose_name='队列')
     enabled = models.BooleanField(default=True, verbose_name='启用状态')
-    allowed_ip = models.GenericIPAddressField(verbose_name='白名单IP')
+    allowed_ip = models.CharField(max_length=49, validators=[ip_network_validator], verbose_name='白名单IP/网段')
     create_time = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
     update_time = models.DateTimeField(auto_now=True, verbose_name='更新时间')
 
@@ -201,7 +280,149 @@ class QueueIPWhitelist(models.Model):
         unique_together = ('queue', 'allowed_ip')
         db_table = 'ts_queue_ip_whitelist'
 
+    @property
+    def network(self):
+        return ipaddress.ip_network(self.allowed_ip, strict=False)
+
     def __str__(self):
         return '%s: %s' % (self.queue, self.allowed_ip)
 
     __repr__ = __str__
+
+
+class SchedulerNode(models.Model):
+    name = models.CharField(max_length=100, primary_key=True, verbose_name='节点')
+    heartbeat = models.DateTimeField(db_index=True, verbose_name='心跳时间')
+    create_time = models.DateTimeField(default=timezone.now, verbose_name='创建时间')
+
+    class Meta:
+        verbose_name = verbose_name_plural = '调度节点'
+        db_table = 'ts_scheduler_node'
+
+    def __str__(self):
+        return self.name
+
+    __repr__ = __str__
+
+
+class SchedulerShard(models.Model):
+    shard = models.PositiveSmallIntegerField(primary_key=True, verbose_name='分片')
+    owner = models.CharField(max_length=100, blank=True, default='', verbose_name='持有节点')
+    lease_until = models.DateTimeField(blank=True, null=True, verbose_name='租约到期时间')
+
+    class Meta:
+        verbose_name = verbose_name_plural = '调度分片'
+        db_table = 'ts_scheduler_shard'
+
+    def __str__(self):
+        return '%s: %s' % (self.shard, self.owner)
+
+    __repr__ = __str__
+
+
+class ScheduledRun(models.Model):
+    """任务未来的运行时间点, 每个任务预先计算TASK_TIMELINE_SIZE个, 用于按时间窗口查询"""
+    task = models.ForeignKey(Task, db_constraint=False, on_delete=models.CASCADE,
+                             verbose_name='任务', related_name='scheduled_runs')
+    run_time = models.DateTimeField(verbose_name='运行时间')
+
+    class Meta:
+        verbose_name = verbose_name_plural = '运行计划'
+        ordering = ('run_time',)
+        db_table = 'ts_scheduled_run'
+        unique_together = ('task', 'run_time')
+        indexes = [models.Index(fields=('run_time', 'task'), name='ts_scheduled_run_time_idx')]
+
+    def __str__(self):
+        return '%s: %s' % (self.task_id, self.run_time)
+
+    __repr__ = __str__
+
+
+class MessageLease(models.Model):
+    """HTTP消费者租用中的消息: 从broker取出后保存在这里, 确认后删除, 超时未确认的重新发布到原队列"""
+    token = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, verbose_name='令牌')
+    queue = models.CharField(max_length=100, verbose_name='队列')
+    exchange = models.CharField(max_length=100, verbose_name='交换机')
+    exchange_type = models.CharField(max_length=10, verbose_name='交换机类型')
+    routing_key = models.CharField(max_length=100, verbose_name='路由键')
+    body = models.TextField(verbose_name='消息体')
+    content_type = models.CharField(max_length=100, null=True, blank=True, verbose_name='内容类型')
+    content_encoding = models.CharField(max_length=50, null=True, blank=True, verbose_name='内容编码')
+    headers = models.JSONField(default=dict, blank=True, verbose_name='消息头')
+    priority = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name='优先级')
+    deliveries = models.PositiveIntegerField(default=1, verbose_name='投递次数')
+    lease_until = models.DateTimeField(db_index=True, verbose_name='租约到期时间')
+    claim = models.UUIDField(null=True, blank=True, db_index=True, verbose_name='重新发布批次')
+    create_time = models.DateTimeField(default=timezone.now, verbose_name='创建时间')
+
+    class Meta:
+        verbose_name = verbose_name_plural = '消息租约'
+        db_table = 'ts_message_lease'
+
+    def __str__(self):
+        return '%s: %s' % (self.queue, self.token)
+
+    __repr__ = __str__
+
+
+class LocalMessage(models.Model):
+    """local://内置broker的消息, 按(queue, -priority, id)索引, 优先级高的先出队, 同优先级先进先出"""
+    id = models.BigAutoField(primary_key=True)
+    queue = models.CharField(max_length=200, verbose_name='队列')
+    priority = models.IntegerField(default=0, verbose_name='优先级')
+    payload = models.TextField(verbose_name='消息')
+    create_time = models.DateTimeField(default=timezone.now, verbose_name='创建时间')
+
+    class Meta:
+        verbose_name = verbose_name_plural = '本地消息'
+        db_table = 'ts_local_message'
+        indexes = [models.Index(fields=('queue', '-priority', 'id'), name='ts_local_message_queue_idx')]
+
+    def __str__(self):
+        return '%s: %s' % (self.queue, self.id)
+
+    __repr__ = __str__
+
+
+class DagRun(models.Model):
+    """以root为根按parent展开的一次DAG运行, graph保存依赖图{父任务id: [子任务id]}, 只在启动时构建一次"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, verbose_name='UUID')
+    root = models.ForeignKey(Task, db_constraint=False, on_delete=models.CASCADE, related_name='dag_runs',
+                             verbose_name='根任务')
+    state = models.CharField(max_length=20, choices=DagState.choices, default=DagState.RUNNING, verbose_name='状态')
+    graph = models.JSONField(default=dict, verbose_name='依赖图')
+    create_time = models.DateTimeField(default=timezone.now, verbose_name='创建时间')
+    finish_time = models.DateTimeField(null=True, blank=True, verbose_name='结束时间')
+
+    class Meta:
+        verbose_name = verbose_name_plural = 'DAG运行'
+        db_table = 'ts_dag_run'
+
+    def __str__(self):
+        return '%s: %s' % (self.root_id, self.id)
+
+    __repr__ = __str__
+
+
+class DagRunTask(models.Model):
+    """DAG运行中的一个任务, remaining为尚未完成的依赖数, 减到0时发布"""
+    # (dag_run, task)唯一索引已覆盖按dag_run查询
+    dag_run = models.ForeignKey(DagRun, db_constraint=False, db_index=False, on_delete=models.CASCADE,
+                                related_name='tasks', verbose_name='DAG运行')
+    task = models.ForeignKey(Task, db_constraint=False, db_index=False, on_delete=models.CASCADE,
+                             related_name='+', verbose_name='任务')
+    state = models.CharField(max_length=20, choices=DagState.choices, default=DagState.WAITING,
+                             verbose_name='状态')
+    remaining = models.PositiveIntegerField(default=0, verbose_name='未完成的依赖数')
+    claim = models.UUIDField(null=True, blank=True, db_index=True, verbose_name='状态变更批次')
+
+    class Meta:
+        verbose_name = verbose_name_plural = 'DAG运行任务'
+        db_table = 'ts_dag_run_task'
+        unique_together = ('dag_run', 'task')
+
+    def __str__(self):
+        return '%s: %s' % (self.dag_run_id, self.task_id)
+
+    __repr__ = __str__
@@ -0,0 +1,194 @@
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .choices import TaskState
+from . import callbacks
+from . import dag
+from . import models
+
+
+# 还没有开始运行的状态, 运行离开这些状态时计入total_run_count
+NOT_STARTED_STATES = (TaskState.PENDING, TaskState.RECEIVED)
+
+
+class Run:
+    """同一次运行(task, run)在一批上报中合并后的结果, time为最晚事件的时间"""
+    __slots__ = ('task_id', 'run_id', 'state', 'time', 'result', 'queue', 'start_time', 'started', 'scheduled',
+                 'dag')
+
+    def __init__(self, task_id, run_id):
+        self.task_id = task_id
+        self.run_id = run_id
+        self.state = None
+        self.time = None
+        self.result = None
+        self.queue = ''
+        self.start_time = None
+        self.started = False
+        self.scheduled = False
+        self.dag = None
+
+    def merge(self, log: models.TaskLog):
+        """
+            与已经写入的日志合并: 状态以时间较晚的为准, 迟到的旧事件不会让状态倒退;
+            result/queue只用较新事件中非空的值覆盖, start_time取较早的开始时间
+        """
+        newer = log.state_time is None or self.time >= log.state_time
+        if not newer:
+            self.state, self.time = log.state, log.state_time
+        if self.result is None or not newer:
+            self.result = log.result if log.result is not None else self.result
+        if not self.queue or not newer:
+            self.queue = log.queue or self.queue
+        if log.start_time and (not self.started or log.start_time < self.start_time):
+            self.start_time = log.start_time
+
+
+def _parse_time(value, now):
+    if value is None:
+        return now
+    value = value if isinstance(value, datetime) else parse_datetime(value)
+    if value is None:
+        raise ValueError('invalid time')
+    return timezone.make_aware(value) if timezone.is_naive(value) else value
+
+
+def parse_events(events, now):
+    """
+        校验上报的事件, 返回([(index, task_id, run_id, state, time, event)], [{"index": ..., "error": ...}])
+        事件格式: {"task": uuid, "state": "STARTED|SUCCESS|FAILURE|RETRY|...", "run": 运行id,
+                 "time": ISO时间, "queue": 队列, "result": 结果, "dag": DAG运行id, "scheduled": 是否由调度进程发布},
+                 除task和state外都可选; 消息头带有x-scheduled时上报scheduled=true
+    """
+    parsed, errors = [], []
+    if not isinstance(events, list):
+        return parsed, [{'index': None, 'error': 'events must be a list'}]
+    for index, event in enumerate(events):
+        try:
+            if not isinstance(event, dict):
+                raise ValueError('event must be an object')
+            task_id = uuid.UUID(str(event.get('task')))
+            state = event.get('state')
+            if state not in TaskState.values:
+                raise ValueError(f'invalid state: {state}')
+            run_id = event.get('run')
+            if event.get('dag') is not None:
+                uuid.UUID(str(event['dag']))
+            parsed.append((index, task_id, str(run_id) if run_id else None, state,
+                           _parse_time(event.get('time'), now), event))
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+    return parsed, errors
+
+
+def coalesce(parsed):
+    """
+        按(task, run)合并事件, 以时间最晚的事件为最终状态; 没有run的事件无法关联, 每个事件作为一次独立的运行;
+        返回Run列表
+    """
+    runs = {}
+    for index, task_id, run_id, state, time, event in sorted(parsed, key=lambda item: (item[4], item[0])):
+        key = (task_id, run_id) if run_id else (task_id, index)
+        run = runs.get(key)
+        if run is None:
+            run = runs[key] = Run(task_id, run_id)
+        run.state, run.time = state, time
+        if event.get('result') is not None:
+            run.result = event['result']
+        run.queue = event.get('queue') or run.queue
+        run.dag = event.get('dag') or run.dag
+        run.scheduled = run.scheduled or bool(event.get('scheduled'))
+        if state == TaskState.STARTED:
+            run.start_time = min(run.start_time, time) if run.started else time
+            run.started = True
+        elif run.start_time is None:
+            run.start_time = time
+    return list(runs.values())
+
+
+def _touch_last_run(last_runs):
+    """last_run_at只向后移动, 一条参数化UPDATE executemany"""
+    if not last_runs:
+        return
+    meta, quote = models.Task._meta, connection.ops.quote_name
+    field, pk = meta.get_field('last_run_at'), meta.pk
+    column = quote(field.column)
+    sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s AND (%s IS NULL OR %s < %%s)' % (
+        quote(meta.db_table), column, quote(pk.column), column, column)
+    params = []
+    for task_id, last_run_at in last_runs.items():
+        value = field.get_db_prep_save(last_run_at, connection)
+        params.append((value, pk.get_db_prep_save(task_id, connection), value))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def _load_logs(run_ids):
+    """已经写入的同一批运行的日志, 支持时锁住这些行, 并发上报同一次运行时依次合并"""
+    queryset = models.TaskLog.objects.filter(run_id__in=run_ids).only(
+        'run_id', 'state', 'state_time', 'result', 'queue', 'start_time')
+    if connection.features.has_select_for_update:
+        queryset = queryset.select_for_update()
+    return {log.run_id: log for log in queryset} if run_ids else {}
+
+
+def apply(events, now: datetime = None, batch_size=1000):
+    """
+        批量应用上报的状态事件, 重复上报同一次运行是幂等的:
+        - 同一次运行的多个事件合并为一条TaskLog, 有run的按run_id upsert, 与已写入的日志合并后再写回,
+          迟到的旧事件不会让状态倒退, 缺少result/queue的事件不会清空已有的值;
+        - 运行第一次离开PENDING/RECEIVED时计入total_run_count(按增量分组F()更新), 已经记录过的运行不再计数;
+          调度进程发布的运行已在发布时计数, 不再重复计入; last_run_at取最晚的开始时间;
+        - preserve_log为False的任务不写日志, 也就无法识别重复上报;
+        - 运行第一次进入结束状态时推进DAG, 发布依赖已全部完成的子任务;
+          并提交到回调引擎执行Task.callback, 不等待回调完成
+        :return: {"events": 有效事件数, "runs": 合并后的运行数, "logs": 写入的日志数, "released": 发布的子任务数,
+                  "missing": [...], "errors": [...]}
+    """
+    now = now or timezone.now()
+    parsed, errors = parse_events(events, now)
+    runs = coalesce(parsed)
+    tasks = models.Task.objects.only('id', 'name', 'preserve_log', 'callback').in_bulk(
+        {run.task_id for run in runs})
+    missing = sorted({str(run.task_id) for run in runs if run.task_id not in tasks})
+    runs = [run for run in runs if run.task_id in tasks]
+    logged = [run for run in runs if tasks[run.task_id].preserve_log]
+
+    with transaction.atomic():
+        existing = _load_logs([run.run_id for run in logged if run.run_id])
+        started, finished, last_runs = defaultdict(int), [], {}
+        for run in runs:
+            log = existing.get(run.run_id) if run.run_id else None
+            previous = log.state if log else None
+            if log:
+                run.merge(log)
+            if run.state not in NOT_STARTED_STATES and (previous is None or previous in NOT_STARTED_STATES):
+                if not run.scheduled:
+                    started[run.task_id] += 1
+            if run.state in dag.FINISHED_STATES and previous not in dag.FINISHED_STATES:
+                finished.append(run)
+            if run.started and (run.task_id not in last_runs or last_runs[run.task_id] < run.start_time):
+                last_runs[run.task_id] = run.start_time
+        by_increment = defaultdict(list)
+        for task_id, count in started.items():
+            by_increment[count].append(task_id)
+
+        logs = [models.TaskLog(task_id=run.task_id, run_id=run.run_id, state=run.state, state_time=run.time,
+                               queue=run.queue, result=run.result, start_time=run.start_time) for run in logged]
+        upserts = [log for log in logs if log.run_id]
+        models.TaskLog.objects.bulk_create([log for log in logs if not log.run_id], batch_size=batch_size)
+        models.TaskLog.objects.bulk_create(upserts, batch_size=batch_size, update_conflicts=True,
+                                           unique_fields=('run_id', ),
+                                           update_fields=('state', 'state_time', 'result', 'queue', 'start_time'))
+        for count, task_ids in by_increment.items():
+            models.Task.objects.filter(id__in=task_ids).update(total_run_count=F('total_run_count') + count)
+        _touch_last_run(last_runs)
+    released = dag.advance([(run.dag, run.task_id, run.state) for run in finished if run.dag])
+    for run in finished:
+        callbacks.engine.run(tasks[run.task_id], run.state, run=run.run_id, result=run.result)
+    return {'events': len(parsed), 'runs': len(runs), 'logs': len(logs), 'released': released, 'missing': missing,
+            'errors': errors}
@@ -0,0 +1,235 @@
+import threading
+from django.conf import settings
+from .choices import ExchangeType
+from . import invalidation
+from . import models
+
+
+class DirectIndex:
+    """direct: (routing_key, 队列名)完全匹配"""
+
+    def __init__(self):
+        self._queues = {}
+
+    def bind(self, queue: models.Queue):
+        self._queues[(queue.routing_key, queue.name)] = queue
+
+    def unbind(self, queue: models.Queue):
+        self._queues.pop((queue.routing_key, queue.name), None)
+
+    def get_queue(self, routing_key, queue_name):
+        return self._queues.get((routing_key, queue_name))
+
+
+class FanoutIndex:
+    """fanout: 忽略routing_key, 只按队列名匹配"""
+
+    def __init__(self):
+        self._queues = {}
+
+    def bind(self, queue: models.Queue):
+        self._queues[queue.name] = queue
+
+    def unbind(self, queue: models.Queue):
+        self._queues.pop(queue.name, None)
+
+    def get_queue(self, routing_key, queue_name):
+        return self._queues.get(queue_name)
+
+
+class _TopicNode:
+    __slots__ = ('children', 'queues')
+
+    def __init__(self):
+        self.children = {}
+        self.queues = {}
+
+
+class TopicIndex:
+    """
+        topic: 队列的routing_key作为绑定模式存入按"."分词的trie,
+        "*"匹配一个词, "#"匹配零个或多个词, 与AMQP topic交换机语义一致
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+
+    def bind(self, queue: models.Queue):
+        node = self._root
+        for word in queue.routing_key.split('.'):
+            node = node.children.setdefault(word, _TopicNode())
+        node.queues[queue.name] = queue
+
+    def unbind(self, queue: models.Queue):
+        path, node = [], self._root
+        for word in queue.routing_key.split('.'):
+            path.append((node, word))
+            node = node.children.get(word)
+            if node is None:
+                return
+        node.queues.pop(queue.name, None)
+        # 清理空节点
+        for parent, word in reversed(path):
+            child = parent.children[word]
+            if child.queues or child.children:
+                break
+            del parent.children[word]
+
+    def _match(self, node: _TopicNode, words, i, matched):
+        hash_node = node.children.get('#')
+        if hash_node is not None:
+            for j in range(i, len(words) + 1):
+                self._match(hash_node, words, j, matched)
+        if i == len(words):
+            matched.update(node.queues)
+            return
+        for word in (words[i], '*'):
+            child = node.children.get(word)
+            if child is not None:
+                self._match(child, words, i + 1, matched)
+
+    def match(self, routing_key):
+        """返回所有绑定模式匹配routing_key的队列 {队列名: 队列}"""
+        matched = {}
+        self._match(self._root, routing_key.split('.'), 0, matched)
+        return matched
+
+    def get_queue(self, routing_key, queue_name):
+        return self.match(routing_key).get(queue_name)
+
+
+_index_classes = {
+    ExchangeType.Direct: DirectIndex,
+    ExchangeType.Topic: TopicIndex,
+    ExchangeType.Fanout: FanoutIndex,
+}
+
+
+def _build_index(exchange: models.Exchange, bindings):
+    index = _index_classes.get(exchange.type, FanoutIndex)()
+    for queue in bindings.values():
+        if queue.exchange_id == exchange.id:
+            index.bind(queue)
+    return index
+
+
+class Snapshot:
+    """路由表的快照, 创建后不再修改, 变更时生成新的快照整体替换, 查询不需要加锁"""
+
+    __slots__ = ('exchanges', 'exchange_names', 'bindings', 'indexes')
+
+    def __init__(self, exchanges, bindings, indexes):
+        self.exchanges = exchanges
+        self.exchange_names = {exchange.name: exchange_id for exchange_id, exchange in exchanges.items()}
+        self.bindings = bindings
+        self.indexes = indexes
+
+    @classmethod
+    def build(cls, exchanges, bindings):
+        return cls(exchanges, bindings, {exchange_id: _build_index(exchange, bindings)
+                                         for exchange_id, exchange in exchanges.items()})
+
+    def derive(self, exchanges=None, bindings=None, rebuild=()):
+        """生成新快照, 只重建rebuild中交换机的索引, 其余索引沿用"""
+        exchanges = self.exchanges if exchanges is None else exchanges
+        bindings = self.bindings if bindings is None else bindings
+        indexes = {exchange_id: index for exchange_id, index in self.indexes.items()
+                   if exchange_id in exchanges and exchange_id not in rebuild}
+        for exchange_id in rebuild:
+            if exchange_id in exchanges:
+                indexes[exchange_id] = _build_index(exchanges[exchange_id], bindings)
+        return Snapshot(exchanges, bindings, indexes)
+
+
+class RoutingTable:
+    """
+        进程内路由表, 第一次使用时从Exchange和Queue加载为快照, 路由查询不再访问数据库;
+        本进程的修改由post_save/post_delete增量生成新快照, 其它进程的修改通过invalidation的广播或版本号失效后重新加载
+    """
+
+    def __init__(self, check_interval=1):
+        self._snapshot = None
+        self.stamp = invalidation.Stamp('routing', check_interval)
+        self._lock = threading.RLock()
+
+    def load(self):
+        with self._lock:
+            self.stamp.reset()
+            bindings = {queue.name: queue for queue in models.Queue.objects.all()}
+            exchanges = {exchange.id: exchange for exchange in models.Exchange.objects.all()}
+            self._snapshot = Snapshot.build(exchanges, bindings)
+        invalidation.broadcaster.start()
+        return self._snapshot
+
+    @property
+    def loaded(self):
+        if self._snapshot is not None and self.stamp.is_stale():
+            self.clear()
+        return self._snapshot is not None
+
+    def ensure_loaded(self) -> Snapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and not self.stamp.is_stale():
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or self._snapshot is snapshot:
+                self.load()
+            return self._snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+
+    def add_exchange(self, exchange: models.Exchange):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+            exchanges = dict(snapshot.exchanges)
+            old = exchanges.get(exchange.id)
+            exchanges[exchange.id] = exchange
+            rebuild = (exchange.id, ) if old is None or old.type != exchange.type else ()
+            self._snapshot = snapshot.derive(exchanges=exchanges, rebuild=rebuild)
+
+    def remove_exchange(self, exchange: models.Exchange):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+            exchanges = dict(snapshot.exchanges)
+            exchanges.pop(exchange.id, None)
+            self._snapshot = snapshot.derive(exchanges=exchanges)
+
+    def add_queue(self, queue: models.Queue):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+            bindings = dict(snapshot.bindings)
+            old = bindings.pop(queue.name, None)
+            bindings[queue.name] = queue
+            rebuild = {queue.exchange_id} | ({old.exchange_id} if old is not None else set())
+            self._snapshot = snapshot.derive(bindings=bindings, rebuild=rebuild)
+
+    def remove_queue(self, queue: models.Queue):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+            bindings = dict(snapshot.bindings)
+            old = bindings.pop(queue.name, None)
+            if old is not None:
+                self._snapshot = snapshot.derive(bindings=bindings, rebuild=(old.exchange_id, ))
+
+    def get_exchange(self, name):
+        snapshot = self.ensure_loaded()
+        exchange_id = snapshot.exchange_names.get(name)
+        return snapshot.exchanges.get(exchange_id) if exchange_id is not None else None
+
+    def get_queue(self, exchange: models.Exchange, routing_key, queue_name):
+        index = self.ensure_loaded().indexes.get(exchange.id)
+        return index.get_queue(routing_key, queue_name) if index is not None else None
+
+
+table = RoutingTable(getattr(settings, 'TASK_CACHE_CHECK_INTERVAL', 1))
+invalidation.broadcaster.subscribe(table.stamp.namespace, table.clear)
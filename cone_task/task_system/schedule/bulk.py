@@ -0,0 +1,86 @@
+from datetime import datetime
+from django.utils import timezone
+from ..choices import ScheduleTimingType
+from .compiled import CompiledInterval, CompiledTiming, catch_up
+from .times import to_schedule_time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _interval_python(items, now):
+    return [compiled.next_time(last_time, is_rigorous, now) for compiled, last_time, is_rigorous in items]
+
+
+def _interval_numpy(items, now):
+    last = np.array([last_time for _, last_time, _ in items], dtype='datetime64[us]')
+    step = np.array([compiled.step for compiled, _, _ in items], dtype='timedelta64[us]')
+    rigorous = np.array([is_rigorous for _, _, is_rigorous in items], dtype=bool)
+    now = np.datetime64(now, 'us')
+    next_time = last + step
+    behind = ~rigorous & (next_time <= now)
+    missed = np.where(behind, (now - next_time) // step + 1, 0)
+    return (next_time + step * missed).tolist()
+
+
+def _day_python(items, now):
+    result = []
+    for compiled, last_time, is_rigorous in items:
+        start = last_time if is_rigorous else now
+        base = datetime(start.year, start.month, start.day, compiled.hour, compiled.minute, compiled.second)
+        result.append(catch_up(base, compiled.step, start)[0])
+    return result
+
+
+def _day_numpy(items, now):
+    start = np.array([last_time if is_rigorous else now for _, last_time, is_rigorous in items],
+                     dtype='datetime64[us]')
+    time_of_day = np.array([compiled.time_of_day for compiled, _, _ in items], dtype='timedelta64[us]')
+    step = np.array([compiled.step for compiled, _, _ in items], dtype='timedelta64[us]')
+    base = start.astype('datetime64[D]').astype('datetime64[us]') + time_of_day
+    behind = base <= start
+    missed = np.where(behind, (start - base) // step + 1, 0)
+    return (base + step * missed).tolist()
+
+
+def bulk_next_times(tasks, now: datetime = None, use_numpy=None):
+    """
+        批量计算任务的下次运行时间, 结果与Task.generate_next_task(now)一致, 没有运行过的任务从now开始计算;
+        interval和按天的timing计划分组后用NumPy datetime64向量化计算, 没有安装NumPy或其它类型逐个计算
+        :return: 与tasks顺序一致的naive时间列表, 计划已结束的为None
+    """
+    now = to_schedule_time(now or timezone.now())
+    use_numpy = np is not None if use_numpy is None else use_numpy
+    results = [None] * len(tasks)
+    intervals, days = [], []
+    # 逐个任务的开销主要在时区转换和编译缓存查找上, 当前时区和编译结果在循环外取一次
+    tz = timezone.get_current_timezone()
+    compiled_by_schedule = {}
+    for i, task in enumerate(tasks):
+        schedule = task.schedule
+        if not schedule:
+            continue
+        compiled = compiled_by_schedule.get(schedule.pk) if schedule.pk else schedule.compiled
+        if compiled is None:
+            compiled = compiled_by_schedule[schedule.pk] = schedule.compiled
+        last_time = task.last_run_at
+        if last_time is None:
+            last_time = now
+        elif last_time.tzinfo is not None:
+            last_time = last_time.astimezone(tz).replace(tzinfo=None)
+        if isinstance(compiled, CompiledInterval):
+            intervals.append((i, (compiled, last_time, task.is_rigorous)))
+        elif isinstance(compiled, CompiledTiming) and compiled.type == ScheduleTimingType.DAY:
+            days.append((i, (compiled, last_time, task.is_rigorous)))
+        else:
+            results[i] = compiled.next_time(last_time, task.is_rigorous, now)
+    for group, vectorized, fallback in ((intervals, _interval_numpy, _interval_python),
+                                        (days, _day_numpy, _day_python)):
+        if not group:
+            continue
+        indexes, items = zip(*group)
+        for i, next_time in zip(indexes, (vectorized if use_numpy else fallback)(items, now)):
+            results[i] = next_time
+    return results
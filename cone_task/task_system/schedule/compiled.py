@@ -0,0 +1,263 @@
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.validators import ValidationError
+from ..choices import ScheduleTimingType, ScheduleType, IntervalPeriodType
+from croniter import croniter
+
+
+mdays = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+def catch_up(next_time: datetime, step: timedelta, now: datetime):
+    """
+        把next_time按step推进到now之后的第一个时间点, O(1)计算而不是逐个周期循环
+        :return: (推进后的时间, 跳过的次数)
+    """
+    if next_time > now:
+        return next_time, 0
+    missed = (now - next_time) // step + 1
+    return next_time + step * missed, missed
+
+
+def _get_interval_seconds(config: dict):
+    interval, period = config['interval'], config['period']
+    if period == IntervalPeriodType.Days:
+        return interval * 24 * 60 * 60
+    elif period == IntervalPeriodType.Hours:
+        return interval * 60 * 60
+    elif period == IntervalPeriodType.Minutes:
+        return interval * 60
+    elif period == IntervalPeriodType.Seconds:
+        return interval
+    raise ValidationError(f'不支持的周期类型: {period}')
+
+
+def _parse_time(value: str):
+    """"HH:MM:SS"或"HH:MM" -> (hour, minute, second)"""
+    parts = [int(i) for i in value.split(':')]
+    if not 2 <= len(parts) <= 3:
+        raise ValidationError(f'时间格式错误: {value}')
+    return tuple(parts + [0] * (3 - len(parts)))
+
+
+def _parse_datetime(value):
+    if not value or isinstance(value, datetime):
+        return value or None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+class CompiledSchedule:
+    """
+        解析后的计划配置, 创建后不可修改;
+        next_after(dt)返回dt之后的下一次运行时间, next_time(last_time, is_rigorous)与get_next_schedule_time语义一致
+    """
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def _set(self, **kwargs):
+        for key, value in kwargs.items():
+            object.__setattr__(self, key, value)
+
+    def next_after(self, dt: datetime):
+        raise NotImplementedError
+
+    def next_time(self, last_time: datetime, is_rigorous=False, now=None):
+        return self.next_after(last_time if is_rigorous else now or datetime.now())
+
+    def next_time_and_missed(self, last_time: datetime, is_rigorous=False, now=None):
+        """
+            :return: (下次运行时间, 遗漏的运行次数), 只有连续性计划按周期补齐并统计遗漏次数, 其它计划为0
+        """
+        return self.next_time(last_time, is_rigorous, now), 0
+
+
+class CompiledCrontab(CompiledSchedule):
+    __slots__ = ('crontab', '_croniter', '_lock')
+
+    def __init__(self, config: dict):
+        crontab = config['crontab']
+        self._set(crontab=crontab, _croniter=croniter(crontab), _lock=threading.Lock())
+
+    def next_after(self, dt: datetime):
+        # croniter对象有状态, 复用时需要加锁
+        with self._lock:
+            self._croniter.set_current(dt, force=True)
+            return self._croniter.get_next(datetime)
+
+
+class CompiledClocked(CompiledSchedule):
+    """指定时间列表解析为排序后的datetime, 二分查找下一个时间点, 全部过期时返回None"""
+    __slots__ = ('clocked',)
+
+    def __init__(self, config: dict):
+        clocked = []
+        for clock in config['clocked']:
+            try:
+                clocked.append(clock if isinstance(clock, datetime) else datetime.fromisoformat(clock))
+            except (TypeError, ValueError):
+                raise ValidationError(f'时间格式错误: {clock}')
+        self._set(clocked=tuple(sorted(clocked)))
+
+    def next_after(self, dt: datetime):
+        if dt is None:
+            return self.clocked[0] if self.clocked else None
+        i = bisect_right(self.clocked, dt)
+        return self.clocked[i] if i < len(self.clocked) else None
+
+    def next_time(self, last_time: datetime, is_rigorous=False, now=None):
+        return self.next_after(last_time)
+
+
+class CompiledInterval(CompiledSchedule):
+    __slots__ = ('step', 'start_time')
+
+    def __init__(self, config: dict):
+        self._set(step=timedelta(seconds=_get_interval_seconds(config)),
+                  start_time=_parse_datetime(config.get('start_time')))
+
+    def next_after(self, dt: datetime):
+        if self.start_time is None:
+            return dt + self.step
+        return catch_up(self.start_time, self.step, dt)[0]
+
+    def next_time_and_missed(self, last_time: datetime, is_rigorous=False, now=None):
+        """
+            :return: (下次运行时间, 遗漏的运行次数), 严格模式下不跳过, 遗漏次数为0
+        """
+        next_time = last_time + self.step
+        if is_rigorous:
+            return next_time, 0
+        # 不是简单的由now + interval是因为这样如果由延迟的话可以根据日志看出遗漏了多少
+        return catch_up(next_time, self.step, now or datetime.now())
+
+    def next_time(self, last_time: datetime, is_rigorous=False, now=None):
+        return self.next_time_and_missed(last_time, is_rigorous, now)[0]
+
+
+class CompiledTiming(CompiledSchedule):
+    __slots__ = ('type', 'hour', 'minute', 'second', 'period', 'weekdays', 'monthdays', 'step', 'time_of_day')
+
+    def __init__(self, config: dict):
+        timing_type = config['type']
+        if timing_type not in (ScheduleTimingType.DAY, ScheduleTimingType.WEEKDAY, ScheduleTimingType.MONTHDAY):
+            raise ValidationError("unsupported timing type: %s" % timing_type)
+        timing_config = config[timing_type]
+        hour, minute, second = _parse_time(timing_config['time'])
+        self._set(type=timing_type, hour=hour, minute=minute, second=second,
+                  period=timing_config.get('period', 1),
+                  weekdays=tuple(timing_config.get('weekdays', ())),
+                  monthdays=tuple(timing_config.get('monthdays', ())),
+                  step=timedelta(days=timing_config.get('period', 1)),
+                  time_of_day=timedelta(hours=hour, minutes=minute, seconds=second))
+
+    def next_after(self, last_time: datetime):
+        hour, minute, second, timing_period = self.hour, self.minute, self.second, self.period
+        next_time = datetime(last_time.year, last_time.month, last_time.day, hour, minute, second)
+        if self.type == ScheduleTimingType.DAY:
+            next_time = catch_up(next_time, self.step, last_time)[0]
+        elif self.type == ScheduleTimingType.WEEKDAY:
+            weekdays = self.weekdays
+            weekday = last_time.isoweekday()
+            for i in weekdays:
+                if i > weekday:
+                    days = i - weekday
+                    delta = timedelta(days=days)
+                    break
+            else:
+                days = weekday - weekdays[0]
+                delta = timedelta(days=timing_period * 7 - days)
+            next_time = next_time + delta
+        else:
+            day = 1
+            for day in self.monthdays:
+                if day == 0:
+                    day = 1
+                elif day == 32:
+                    day = mdays[last_time.month]
+                next_time = datetime(last_time.year, last_time.month, day, hour, minute, second)
+                if next_time > last_time:
+                    break
+            else:
+                month = (last_time.month + timing_period) % 12
+                if month == 0:
+                    month = 1
+                year = last_time.year + (last_time.month + timing_period) // 12
+                next_time = datetime(year, month, day, hour, minute, second)
+        return next_time
+
+
+class CompiledNLP(CompiledSchedule):
+    __slots__ = ()
+
+    def __init__(self, config: dict):
+        pass
+
+    def next_after(self, dt: datetime):
+        return None
+
+
+_compiled_classes = {
+    ScheduleType.CRONTAB: CompiledCrontab,
+    ScheduleType.Clocked: CompiledClocked,
+    ScheduleType.Interval: CompiledInterval,
+    ScheduleType.Timing: CompiledTiming,
+    ScheduleType.NLP: CompiledNLP,
+}
+
+
+def compile_config(schedule_type, config: dict) -> CompiledSchedule:
+    # 兼容ScheduleConfig格式的完整配置, 即{"schedule_type": ..., "<schedule_type>": {...}}
+    type_config = config.get(schedule_type)
+    if isinstance(type_config, dict):
+        config = type_config
+    return _compiled_classes[schedule_type](config)
+
+
+class CompiledScheduleCache:
+    """
+        按(schedule.id, update_time)缓存编译结果, Schedule修改后update_time变化自然失效, LRU淘汰;
+        queryset.update(config=...)不会更新auto_now字段, 需要同时更新update_time(其它进程据此失效),
+        本进程也可以调用invalidate; 未保存的Schedule不缓存
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, schedule) -> CompiledSchedule:
+        if schedule.pk is None:
+            return compile_config(schedule.schedule_type, schedule.config)
+        key = (schedule.pk, schedule.update_time)
+        with self._lock:
+            compiled = self._cache.get(key)
+            if compiled is not None:
+                self._cache.move_to_end(key)
+                return compiled
+        compiled = compile_config(schedule.schedule_type, schedule.config)
+        with self._lock:
+            self._cache[key] = compiled
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return compiled
+
+    def invalidate(self, pk):
+        """丢弃pk的所有编译结果"""
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == pk]:
+                del self._cache[key]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+compiled_schedules = CompiledScheduleCache(getattr(settings, 'TASK_SCHEDULE_CACHE_SIZE', 1024))
@@ -1,92 +1,30 @@
-from datetime import datetime, timedelta
-from django.core.validators import ValidationError
-from ..choices import ScheduleTimingType, ScheduleType, IntervalPeriodType
-from croniter import croniter
-
-
-mdays = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+from datetime import datetime
+from ..choices import ScheduleType
+from .compiled import (catch_up, compile_config, CompiledCrontab, CompiledClocked, CompiledInterval,
+                       CompiledTiming)
 
 
 def _get_next_time_of_crontab(config: dict, last_time, is_rigorous=False):
-    crontab = config['crontab']
-    start_time = last_time if is_rigorous else datetime.now()
-    return croniter(crontab, start_time, datetime)
+    return CompiledCrontab(config).next_time(last_time, is_rigorous)
 
 
 def _get_next_time_of_clocked(config: dict, last_time, is_rigorous=False):
-    clocked = config['clocked']
-    for clock in clocked:
-        if last_time < clock:
-            return clock
-    return None
+    return CompiledClocked(config).next_time(last_time, is_rigorous)
+
+
+def get_next_interval_time(config: dict, last_time, is_rigorous=False, now=None):
+    """
+        :return: (下次运行时间, 遗漏的运行次数), 严格模式下不跳过, 遗漏次数为0
+    """
+    return CompiledInterval(config).next_time_and_missed(last_time, is_rigorous, now)
 
 
 def _get_next_time_of_interval(config: dict, last_time, is_rigorous=False):
-    start_time, interval, period = config['start_time'], config['interval'], config['period']
-    if period == IntervalPeriodType.Days:
-        seconds = interval * 24 * 60 * 60
-    elif period == IntervalPeriodType.Hours:
-        seconds = interval * 60 * 60
-    elif period == IntervalPeriodType.Minutes:
-        seconds = interval * 60
-    elif period == IntervalPeriodType.Seconds:
-        seconds = interval
-    else:
-        raise ValidationError(f'不支持的周期类型: {period}')
-    if is_rigorous:
-        next_time = last_time + timedelta(seconds=seconds)
-    else:
-        # 不是简单的由now + interval是因为这样如果由延迟的话可以根据日志看出遗漏了多少
-        next_time = last_time + timedelta(seconds=seconds)
-        now = datetime.now()
-        while next_time <= now:
-            next_time += timedelta(seconds=seconds)
-    return next_time
+    return get_next_interval_time(config, last_time, is_rigorous)[0]
 
 
 def _get_next_time_of_timing(config: dict, last_time, is_rigorous=False):
-    last_time = last_time if is_rigorous else datetime.now()
-    timing_type = config['type']
-    timing_config = config[timing_type]
-    hour, minute, second = timing_config['time'].split(':')
-    hour, minute, second = int(hour), int(minute), int(second)
-    timing_period = timing_config.get('period', 1)
-    next_time = datetime(last_time.year, last_time.month, last_time.day, hour, minute, second)
-    if timing_type == ScheduleTimingType.DAY:
-        while next_time <= last_time:
-            next_time += timedelta(days=timing_period)
-    elif timing_type == ScheduleTimingType.WEEKDAY:
-        weekdays = timing_config['weekdays']
-        weekday = last_time.isoweekday()
-        for i in weekdays:
-            if i > weekday:
-                days = i - weekday
-                delta = timedelta(days=days)
-                break
-        else:
-            days = weekday - weekdays[0]
-            delta = timedelta(days=timing_period * 7 - days)
-        next_time = next_time + delta
-    elif timing_type == ScheduleTimingType.MONTHDAY:
-        monthdays = timing_config['monthdays']
-        day = 1
-        for day in monthdays:
-            if day == 0:
-                day = 1
-            elif day == 32:
-                day = mdays[last_time.month]
-            next_time = datetime(last_time.year, last_time.month, day, hour, minute, second)
-            if next_time > last_time:
-                break
-        else:
-            month = (last_time.month + timing_period) % 12
-            if month == 0:
-                month = 1
-            year = last_time.year + (last_time.month + timing_period) // 12
-            next_time = datetime(year, month, day, hour, minute, second)
-    else:
-        raise ValidationError("unsupported timing type: %s" % timing_type)
-    return next_time
+    return CompiledTiming(config).next_time(last_time, is_rigorous)
 
 
 def _get_next_time_of_nlp(config: dict, last_time, is_rigorous=False):
@@ -103,7 +41,7 @@ _next_time_get_mapping = {
 
 
 def get_next_schedule_time(schedule_type, config: dict, last_time, is_rigorous=False):
-    return _next_time_get_mapping[schedule_type](config, last_time, is_rigorous)
+    return compile_config(schedule_type, config).next_time(last_time, is_rigorous)
 
 
 class ScheduleConfig:
@@ -0,0 +1,20 @@
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.utils import timezone
+
+
+def to_schedule_time(value: datetime):
+    """schedule模块按本地naive时间计算"""
+    if value is not None and timezone.is_aware(value):
+        value = timezone.make_naive(value)
+    return value
+
+
+def from_schedule_time(value: datetime):
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc if value == datetime.max else None)
+    return value
+
+
+def max_time():
+    return from_schedule_time(datetime.max)
@@ -0,0 +1,215 @@
+import heapq
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from django.db import connection, transaction, DatabaseError
+from django.db.models import F
+from django.utils import timezone
+from kombu import Exchange
+from .connections import pools
+from .schedule.times import to_schedule_time, from_schedule_time, max_time
+from .sharding import ShardCoordinator
+from . import broker
+from . import timeline
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# 调度发布的消息带有该消息头, 调度时已经计入total_run_count, worker上报运行状态时原样带回, 不再重复计数
+SCHEDULED_HEADER = 'x-scheduled'
+
+
+class Scheduler:
+    """
+        调度进程: 在内存最小堆中维护window秒内即将运行的任务, 按next_start_time区间查询补充;
+        堆按(next_start_time, -priority)排序, 同一时间到期的任务优先级高的先发布;
+        睡眠到堆顶任务的运行时间, 到期的任务按队列批量发布, 并批量更新next_start_time/last_run_at/total_run_count,
+        同时补齐ScheduledRun运行计划
+        指定coordinator时只调度本节点持有租约的分片, 多个节点共同分担任务
+    """
+
+    def __init__(self, window=60, refill_interval=10, batch_size=1000, retry_delay=5,
+                 coordinator: ShardCoordinator = None):
+        self.window = timedelta(seconds=window)
+        self.refill_interval = timedelta(seconds=refill_interval)
+        self.batch_size = batch_size
+        self.retry_delay = timedelta(seconds=retry_delay)
+        self.heap = []
+        self.next_refill = None
+        self.coordinator = coordinator
+        self.next_sync = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def task_queryset(self):
+        return models.Task.objects.filter(enabled=True)
+
+    def refill(self, now):
+        """重新加载[.., now + window)内的任务, 堆中只保存(运行时间, -优先级, id)"""
+        rows = self.task_queryset().filter(next_start_time__lt=now + self.window).values_list(
+            'next_start_time', 'priority', 'id')
+        if self.coordinator:
+            rows = (row for row in rows if self.coordinator.owns(row[2]))
+        self.heap = [(next_start_time, -priority, task_id) for next_start_time, priority, task_id in rows]
+        heapq.heapify(self.heap)
+        self.next_refill = now + self.refill_interval
+
+    def pop_due(self, now):
+        ids = []
+        while self.heap and self.heap[0][0] <= now and len(ids) < self.batch_size:
+            ids.append(heapq.heappop(self.heap)[2])
+        return ids
+
+    def next_timeout(self, now):
+        deadline = self.next_refill
+        if self.next_sync and self.next_sync < deadline:
+            deadline = self.next_sync
+        if self.heap and self.heap[0][0] < deadline:
+            deadline = self.heap[0][0]
+        return max((deadline - now).total_seconds(), 0)
+
+    def reschedule(self, task: models.Task, now):
+        """计算下次运行时间, 以本次计划运行时间作为last_time; 调度延迟跳过的周期记录到日志"""
+        next_time = None
+        if task.schedule:
+            next_time, missed = task.schedule.compiled.next_time_and_missed(
+                to_schedule_time(task.next_start_time), task.is_rigorous, to_schedule_time(now))
+            next_time = from_schedule_time(next_time)
+            if missed:
+                logger.warning('task %s missed %s runs, next run at %s', task, missed, next_time)
+            if next_time is None:
+                task.enabled = False
+        task.next_start_time = next_time or max_time()
+
+    def advance(self, task: models.Task, now):
+        """已发布的任务: 计算下次运行时间并计入一次运行"""
+        self.reschedule(task, now)
+        task.last_run_at = now
+        task.total_run_count += 1
+
+    def save(self, tasks, now):
+        """last_run_at和total_run_count对本批任务相同, 一条UPDATE完成"""
+        if not tasks:
+            return
+        models.Task.objects.filter(id__in=[task.id for task in tasks]).update(
+            last_run_at=now, total_run_count=F('total_run_count') + 1)
+        self.save_next_times(tasks)
+
+    @staticmethod
+    def save_next_times(tasks):
+        """next_start_time按值分组更新, 取值唯一的任务用一条executemany逐行更新"""
+        groups = defaultdict(list)
+        for task in tasks:
+            groups[(task.next_start_time, task.enabled)].append(task)
+        singles = []
+        for (next_start_time, enabled), group in groups.items():
+            if len(group) == 1:
+                singles.extend(group)
+            else:
+                models.Task.objects.filter(id__in=[task.id for task in group]).update(
+                    next_start_time=next_start_time, enabled=enabled)
+        models.Task.bulk_save_next_times(singles)
+
+    def publish(self, queue: models.Queue, tasks):
+        exchange = Exchange(name=queue.exchange.name, type=queue.exchange.type)
+        with pools.acquire(queue) as conn:
+            results = broker.publish_loaded_tasks(conn, queue, exchange, queue.routing_key, tasks,
+                                                  chunk_size=self.batch_size, headers={SCHEDULED_HEADER: True})
+            return {result['id'] for result in results if result['status'] == 'published'}
+
+    @property
+    def locks_rows(self):
+        return self.coordinator is not None and connection.features.has_select_for_update_skip_locked
+
+    def lock_tasks(self, ids, now):
+        queryset = self.task_queryset().filter(id__in=ids, next_start_time__lte=now)
+        if self.locks_rows:
+            queryset = queryset.select_for_update(skip_locked=True, of=('self',))
+        return list(queryset.select_related('schedule', 'queue__exchange'))
+
+    def dispatch(self, ids, now):
+        """发布到期任务, 返回成功发布的任务数; 发布失败的任务延迟retry_delay后重试"""
+        # SQLite没有行锁, 读后写的事务在并发时反而会直接报database is locked, 只依赖分片租约
+        if self.locks_rows:
+            with transaction.atomic():
+                return self._dispatch(ids, now)
+        return self._dispatch(ids, now)
+
+    def _dispatch(self, ids, now):
+        # 重新读取, 过滤掉已被修改或禁用的任务, 多节点时锁住任务行, 已被其它事务锁住的跳过
+        tasks = self.lock_tasks(ids, now)
+        by_queue = defaultdict(list)
+        # 同一队列内按优先级从高到低发布
+        # 没有队列的任务没有发布, 只推进next_start_time, 不计入运行次数
+        skipped = []
+        for task in sorted(tasks, key=lambda task: -task.priority):
+            if task.queue is None:
+                logger.warning('task %s has no queue, skipped', task)
+                skipped.append(task)
+            else:
+                by_queue[task.queue].append(task)
+        dispatched = []
+        for queue, queue_tasks in by_queue.items():
+            try:
+                published = self.publish(queue, queue_tasks)
+            except Exception:
+                logger.exception('publish to queue %s failed', queue)
+                published = set()
+            for task in queue_tasks:
+                if str(task.id) in published:
+                    dispatched.append(task)
+                else:
+                    heapq.heappush(self.heap, (now + self.retry_delay, -task.priority, task.id))
+        for task in dispatched:
+            self.advance(task, now)
+        for task in skipped:
+            self.reschedule(task, now)
+        self.save(dispatched, now)
+        self.save_next_times(skipped)
+        timeline.extend(dispatched + skipped, now)
+        for task in dispatched + skipped:
+            if task.next_start_time < self.next_refill + self.window:
+                heapq.heappush(self.heap, (task.next_start_time, -task.priority, task.id))
+        return len(dispatched)
+
+    def sync(self, now):
+        if self.coordinator.sync(now):
+            self.next_refill = None
+        self.next_sync = now + self.coordinator.sync_interval
+
+    def tick(self, now=None):
+        now = now or timezone.now()
+        if self.coordinator:
+            if self.next_sync is None or now >= self.next_sync:
+                self.sync(now)
+            if not self.coordinator.is_valid(now):
+                return 0
+        if self.next_refill is None or now >= self.next_refill:
+            self.refill(now)
+        dispatched = 0
+        while True:
+            ids = self.pop_due(now)
+            if not ids:
+                break
+            dispatched += self.dispatch(ids, now)
+        return dispatched
+
+    def run(self):
+        logger.info('scheduler started')
+        while not self._stopped.is_set():
+            try:
+                self.tick()
+            except DatabaseError:
+                logger.exception('scheduler tick failed')
+                self._wakeup.wait(self.retry_delay.total_seconds())
+                continue
+            self._wakeup.wait(self.next_timeout(timezone.now()))
+            self._wakeup.clear()
+        if self.coordinator:
+            self.coordinator.leave()
+        logger.info('scheduler stopped')
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
@@ -1,10 +1,64 @@
+from django.db import connection
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
 from . import models
 
 
+def _ancestor_ids(model, ids):
+    """递归CTE一次查出ids及其所有祖先的主键, UNION去重保证parent成环时也能结束"""
+    if not ids:
+        return set()
+    pk = model._meta.pk
+    qn = connection.ops.quote_name
+    table, pk_column = qn(model._meta.db_table), qn(pk.column)
+    parent_column = qn(model._meta.get_field('parent').column)
+    sql = f'''
+        WITH RECURSIVE ancestors(id, parent_id) AS (
+            SELECT {pk_column}, {parent_column} FROM {table} WHERE {pk_column} IN ({', '.join(['%s'] * len(ids))})
+            UNION
+            SELECT t.{pk_column}, t.{parent_column} FROM {table} t JOIN ancestors a ON t.{pk_column} = a.parent_id
+        )
+        SELECT id FROM ancestors
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [pk.get_db_prep_value(i, connection) for i in ids])
+        return {pk.to_python(row[0]) for row in cursor.fetchall()}
+
+
+def _set_cached(objs, field_name, id_map):
+    field = objs[0]._meta.get_field(field_name) if objs else None
+    for obj in objs:
+        field.set_cached_value(obj, id_map.get(getattr(obj, field.attname)))
+
+
+def prefetch_task_tree(tasks):
+    """
+        为一批任务预先加载序列化需要的全部关联数据: 祖先任务链、类别树和标签,
+        查询数固定, 与任务数量和层级深度无关, 之后TaskSerializer序列化不再产生查询
+    """
+    tasks = list(tasks)
+    task_map = {task.id: task for task in tasks}
+    parent_ids = {task.parent_id for task in tasks if task.parent_id and task.parent_id not in task_map}
+    ancestor_ids = _ancestor_ids(models.Task, parent_ids) - task_map.keys()
+    if ancestor_ids:
+        task_map.update((task.id, task) for task in models.Task.objects.filter(id__in=ancestor_ids))
+    all_tasks = list(task_map.values())
+    if not all_tasks:
+        return tasks
+    _set_cached(all_tasks, 'parent', task_map)
+    prefetch_related_objects(all_tasks, 'tags')
+
+    category_ids = _ancestor_ids(models.Category, {task.category_id for task in all_tasks})
+    category_map = models.Category.objects.in_bulk(category_ids)
+    categories = list(category_map.values())
+    _set_cached(all_tasks, 'category', category_map)
+    _set_cached(categories, 'parent', category_map)
+    return tasks
+
+
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
-        model = models.Task
+        model = models.Tag
         fields = ('name', )
 
 
@@ -40,8 +94,9 @@ class TaskSerializer(serializers.ModelSerializer):
     parent = serializers.SerializerMethodField()
 
     def get_parent(self, obj):
+        # 复用当前实例的字段序列化祖先任务, DAG等较深的任务树每层都新建serializer的开销很大
         if obj.parent:
-            return self.__class__(obj.parent).data
+            return self.to_representation(obj.parent)
 
     class Meta:
         exclude = ('update_time', )
@@ -0,0 +1,96 @@
+import logging
+import math
+import os
+import socket
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(task_id, shards):
+    return task_id.int % shards
+
+
+def default_node_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class ShardCoordinator:
+    """
+        多个调度节点按Task.id的hash把任务划分为shards个分片, 每个分片同一时刻只租给一个节点:
+        - 节点通过SchedulerNode心跳登记, 心跳超过ttl的节点视为下线;
+        - 分片租约记录在SchedulerShard, 只能由租约过期或无主的分片上用条件UPDATE抢占, 各数据库上都是原子的;
+        - 每次同步时按在线节点数重新计算每个节点应持有的分片数, 多出的分片主动释放, 不足的从空闲分片中抢占;
+        - 节点名最小的在线节点为leader, 负责清理下线节点
+        节点只在租约到期前margin秒内调度自己持有的分片, 保证同一任务不会被两个节点同时调度
+    """
+
+    def __init__(self, name=None, shards=None, ttl=30):
+        self.name = name or default_node_name()
+        self.shards = shards or getattr(settings, 'TASK_SCHEDULER_SHARDS', 64)
+        self.ttl = timedelta(seconds=ttl)
+        self.margin = self.ttl / 3
+        self.owned = frozenset()
+        self.lease_until = None
+        self.is_leader = False
+        self._shards_created = False
+
+    @property
+    def sync_interval(self):
+        return self.margin
+
+    def ensure_shards(self):
+        if self._shards_created:
+            return
+        self._shards_created = True
+        models.SchedulerShard.objects.bulk_create(
+            [models.SchedulerShard(shard=i) for i in range(self.shards)], ignore_conflicts=True)
+
+    def heartbeat(self, now):
+        models.SchedulerNode.objects.update_or_create(name=self.name, defaults={'heartbeat': now})
+        live = sorted(models.SchedulerNode.objects.filter(heartbeat__gt=now - self.ttl).values_list('name', flat=True))
+        self.is_leader = bool(live) and live[0] == self.name
+        if self.is_leader:
+            models.SchedulerNode.objects.filter(heartbeat__lte=now - self.ttl).delete()
+        return live
+
+    def rebalance(self, now, live_count):
+        shards = models.SchedulerShard.objects
+        lease_until = now + self.ttl
+        shards.filter(owner=self.name).update(lease_until=lease_until)
+        owned = sorted(shards.filter(owner=self.name).values_list('shard', flat=True))
+        target = math.ceil(self.shards / max(live_count, 1))
+        if len(owned) > target:
+            shards.filter(owner=self.name, shard__in=owned[target:]).update(owner='', lease_until=None)
+        elif len(owned) < target:
+            free = list(shards.filter(Q(owner='') | Q(lease_until__lt=now)).values_list('shard', flat=True)
+                        [:target - len(owned)])
+            # 条件UPDATE抢占, 被其它节点先抢到的分片不会被覆盖
+            shards.filter(Q(owner='') | Q(lease_until__lt=now), shard__in=free).update(
+                owner=self.name, lease_until=lease_until)
+        owned = frozenset(shards.filter(owner=self.name).values_list('shard', flat=True))
+        changed = owned != self.owned
+        if changed:
+            logger.info('node %s owns %s shards', self.name, len(owned))
+        self.owned, self.lease_until = owned, lease_until
+        return changed
+
+    def sync(self, now):
+        """心跳并重新分配分片, 持有的分片有变化时返回True"""
+        self.ensure_shards()
+        live = self.heartbeat(now)
+        return self.rebalance(now, len(live))
+
+    def is_valid(self, now):
+        return self.lease_until is not None and now < self.lease_until - self.margin
+
+    def owns(self, task_id):
+        return shard_of(task_id, self.shards) in self.owned
+
+    def leave(self):
+        models.SchedulerShard.objects.filter(owner=self.name).update(owner='', lease_until=None)
+        models.SchedulerNode.objects.filter(name=self.name).delete()
+        self.owned, self.lease_until = frozenset(), None
@@ -0,0 +1,132 @@
+import json
+import logging
+import queue as queue_module
+import socket
+import threading
+import uuid
+from collections import deque
+from time import monotonic
+from kombu import Connection, Consumer, Exchange, Message
+from . import broker
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+def sse(event, data, id=None):
+    lines = [f'id: {id}'] if id is not None else []
+    lines += [f'event: {event}', f'data: {json.dumps(data, default=str)}']
+    return '\n'.join(lines) + '\n\n'
+
+
+class Stream:
+    """
+        一个SSE消费者: 独立的broker连接上注册consumer, 按prefetch限制未确认的消息数, 收到消息立即推送;
+        消息用delivery_tag作为SSE的id, 客户端通过ack接口确认或退回, 确认请求放入队列,
+        由推送所在线程在两次drain_events之间执行, channel只在一个线程中使用;
+        客户端断开时未确认的消息退回队列
+    """
+
+    def __init__(self, queue: models.Queue, exchange: Exchange, prefetch=10, heartbeat=15, poll_interval=0.05):
+        self.id = uuid.uuid4().hex
+        self.queue = queue
+        self.exchange = exchange
+        self.prefetch = prefetch
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.pending = {}
+        self._received = deque()
+        self._acks = queue_module.SimpleQueue()
+        self._closed = threading.Event()
+
+    def ack(self, tags, requeue=None):
+        """requeue为None时确认, 否则退回(requeue=True)或丢弃(requeue=False); 返回是否仍在推送"""
+        if self._closed.is_set():
+            return False
+        self._acks.put((list(tags), requeue))
+        return True
+
+    def _apply_acks(self):
+        while True:
+            try:
+                tags, requeue = self._acks.get_nowait()
+            except queue_module.Empty:
+                return
+            for tag in tags:
+                message: Message = self.pending.pop(str(tag), None)
+                if message is None:
+                    continue
+                if requeue is None:
+                    message.ack()
+                else:
+                    message.reject(requeue=requeue)
+
+    def _on_message(self, body, message: Message):
+        self._received.append(message)
+
+    def events(self):
+        """生成SSE事件, 生成器关闭(客户端断开)时关闭连接"""
+        streams.add(self)
+        conn = Connection(self.queue.connection)
+        try:
+            channel = conn.channel()
+            kombu_queue = broker.build_queue(self.queue, self.exchange, channel=channel)
+            with Consumer(channel, queues=[kombu_queue], callbacks=[self._on_message], no_ack=False,
+                          prefetch_count=self.prefetch):
+                yield sse('open', {'stream': self.id, 'prefetch': self.prefetch})
+                last_sent = monotonic()
+                while not self._closed.is_set():
+                    self._apply_acks()
+                    try:
+                        conn.drain_events(timeout=self.poll_interval)
+                    except socket.timeout:
+                        pass
+                    while self._received:
+                        message = self._received.popleft()
+                        tag = str(message.delivery_tag)
+                        self.pending[tag] = message
+                        last_sent = monotonic()
+                        yield sse('task', broker.message_to_dict(message), id=tag)
+                    if monotonic() - last_sent >= self.heartbeat:
+                        last_sent = monotonic()
+                        yield ': keepalive\n\n'
+        finally:
+            self._closed.set()
+            streams.remove(self)
+            try:
+                # 主动退回未确认的消息, 不依赖broker在连接断开后的处理
+                for message in [*self.pending.values(), *self._received]:
+                    if not message.acknowledged:
+                        message.requeue()
+                conn.release()
+            except Exception:
+                logger.exception('close stream %s failed', self.id)
+
+    def close(self):
+        self._closed.set()
+
+
+class StreamRegistry:
+    """本进程中正在推送的Stream, ack请求需要路由到建立该Stream的进程"""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def add(self, stream: Stream):
+        with self._lock:
+            self._streams[stream.id] = stream
+        return stream
+
+    def remove(self, stream: Stream):
+        with self._lock:
+            self._streams.pop(stream.id, None)
+
+    def get(self, stream_id):
+        return self._streams.get(stream_id)
+
+    def __len__(self):
+        return len(self._streams)
+
+
+streams = StreamRegistry()
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+class TaskLogWriter:
+    """
+        缓冲写TaskLog, 缓冲满batch_size条或距上次写入超过flush_interval秒时用一条bulk_create批量插入;
+        flush_interval为0时不启动后台线程, 只在缓冲满或调用flush时写入;
+        上报和worker的运行状态由reports.apply按批合并写入, 不经过这里, 需要时由调用方创建实例并在退出前close
+        配置(settings.TASK_LOG_WRITER):
+        {
+            "batch_size": 500,          # 每批插入的日志数
+            "flush_interval": 1,        # 后台定时写入的间隔秒数
+            "max_buffer": 100000,       # 写入失败时最多保留在内存中的日志数, 超过的丢弃
+        }
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1, max_buffer=100000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(**getattr(settings, 'TASK_LOG_WRITER', {}))
+
+    def write(self, task: models.Task, state, queue='', result=None, start_time: datetime = None):
+        """记录一次运行, preserve_log为False的任务不记录"""
+        if not task.preserve_log:
+            return
+        self.add(models.TaskLog(task_id=task.id, state=state, queue=queue, result=result,
+                                start_time=start_time or timezone.now()))
+
+    def add(self, *logs: models.TaskLog):
+        with self._lock:
+            self.buffer.extend(logs)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+        elif self.flush_interval and self._thread is None:
+            self._start()
+
+    def flush(self):
+        """写入当前缓冲中的所有日志, 返回写入条数"""
+        with self._flush_lock:
+            with self._lock:
+                logs, self.buffer = self.buffer, []
+            if not logs:
+                return 0
+            try:
+                models.TaskLog.objects.bulk_create(logs, batch_size=self.batch_size)
+            except Exception:
+                logger.exception('write %s task logs failed', len(logs))
+                with self._lock:
+                    self.buffer[:0] = logs
+                    if len(self.buffer) > self.max_buffer:
+                        logger.warning('task log buffer full, %s logs dropped', len(self.buffer) - self.max_buffer)
+                        del self.buffer[:len(self.buffer) - self.max_buffer]
+                return 0
+            return len(logs)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='task-log-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+        connection.close()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+def prune(before: datetime, batch_size=5000, pause=0, states=None):
+    """
+        删除create_time早于before的日志, 每批按create_time索引取batch_size个id再按主键删除,
+        每批单独提交, 不会长时间锁表; pause为每批之间的等待秒数, 给其它写入让路
+        :return: 删除的总条数
+    """
+    queryset = models.TaskLog.objects.filter(create_time__lt=before).order_by()
+    if states:
+        queryset = queryset.filter(state__in=states)
+    total = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return total
+        total += models.TaskLog.objects.filter(id__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def retention_cutoff(days=None, now: datetime = None):
+    days = getattr(settings, 'TASK_LOG_RETENTION_DAYS', 30) if days is None else days
+    return (now or timezone.now()) - timedelta(days=days)
+
@@ -1,3 +1,1604 @@
-from django.test import TestCase
+import asyncio
+import ipaddress
+import json
+import random
+import signal
+import socket
+import threading
+import time
+from unittest import mock, skipIf
+from datetime import datetime, timedelta
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, AsyncClient, override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from kombu import Connection, Exchange, Producer
 
-# Create your tests here.
+from . import models
+from . import broker
+from . import routing
+from . import serializers
+from .schedule import bulk as schedule_bulk
+from .schedule import config as schedule_config
+from .scheduler import Scheduler
+from .schedule.times import from_schedule_time, max_time
+from .schedule.compiled import CompiledScheduleCache, compiled_schedules
+from .sharding import ShardCoordinator
+from . import timeline
+from . import tasklog
+from . import reports
+from . import streaming
+from . import leases
+from . import invalidation
+from . import dag
+from . import async_views
+from . import callbacks
+from . import local_broker
+from .worker import Worker
+from .connections import BrokerPools
+from .admin import EstimatedCountPaginator, TaskParentFilter
+from .whitelist import whitelist, PrefixTable, Snapshot as WhitelistSnapshot
+
+
+class TaskSerializerQueryTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.exchange = models.Exchange.objects.create(name='test')
+        cls.queue = models.Queue.objects.create(exchange=cls.exchange, name='test', routing_key='test',
+                                                connection='memory://')
+        category = None
+        for i in range(3):
+            category = models.Category.objects.create(name=f'category{i}', parent=category)
+        cls.category = category
+        cls.tags = [models.Tag.objects.create(name=f'tag{i}') for i in range(3)]
+
+    def setUp(self):
+        routing.table.clear()
+
+    def create_tasks(self, count, depth=3, prefix='task'):
+        tasks = []
+        for i in range(count):
+            parent = None
+            for level in range(depth):
+                parent = models.Task.objects.create(name=f'{prefix}-{i}-{level}', parent=parent,
+                                                    category=self.category, queue=self.queue)
+                parent.tags.set(self.tags)
+            tasks.append(parent)
+        return tasks
+
+    def serialize(self, tasks):
+        queryset = models.Task.objects.filter(id__in=[task.id for task in tasks])
+        return serializers.TaskSerializer(serializers.prefetch_task_tree(queryset), many=True).data
+
+    def test_prefetch_task_tree_query_count(self):
+        tasks = self.create_tasks(5)
+        # tasks, ancestor ids, ancestors, tags, category ids, categories
+        with self.assertNumQueries(6):
+            data = self.serialize(tasks)
+        self.assertEqual(len(data), 5)
+        self.assertEqual(data[0]['parent']['parent']['parent'], None)
+        self.assertEqual(data[0]['category']['parent']['parent']['name'], 'category0')
+        self.assertEqual(len(data[0]['parent']['tags']), 3)
+
+    def test_query_count_independent_of_size(self):
+        small, large = self.create_tasks(2, prefix='small'), self.create_tasks(20, depth=5, prefix='large')
+        with CaptureQueriesContext(connection) as small_queries:
+            self.serialize(small)
+        with CaptureQueriesContext(connection) as large_queries:
+            self.serialize(large)
+        self.assertEqual(len(small_queries), len(large_queries))
+
+    def test_prefetch_matches_plain_serializer(self):
+        tasks = self.create_tasks(3)
+        queryset = models.Task.objects.filter(id__in=[task.id for task in tasks]).order_by('name')
+        plain = serializers.TaskSerializer(queryset, many=True).data
+        prefetched = serializers.TaskSerializer(serializers.prefetch_task_tree(queryset), many=True).data
+        self.assertEqual(plain, prefetched)
+
+    def test_parent_cycle(self):
+        first, second = self.create_tasks(1, depth=2)[0].parent, self.create_tasks(1, depth=1, prefix='x')[0]
+        models.Task.objects.filter(id=first.id).update(parent=second)
+        models.Task.objects.filter(id=second.id).update(parent=first)
+        self.assertEqual(serializers._ancestor_ids(models.Task, {first.id}), {first.id, second.id})
+
+    def test_put_query_count(self):
+        url = f'/task/put/{self.exchange.name}/{self.queue.name}/{self.queue.routing_key}/'
+        small, large = self.create_tasks(2, prefix='small'), self.create_tasks(30, prefix='large')
+        routing.table.ensure_loaded()
+        with CaptureQueriesContext(connection) as small_queries:
+            self.client.post(url, [str(task.id) for task in small], content_type='application/json')
+        with CaptureQueriesContext(connection) as large_queries:
+            response = self.client.post(url, [str(task.id) for task in large], content_type='application/json')
+        self.assertEqual(len(small_queries), len(large_queries))
+        self.assertEqual({result['status'] for result in response.json()}, {'published'})
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+
+class RoutingTableTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        self.direct = models.Exchange.objects.create(name='direct', type='direct')
+        self.topic = models.Exchange.objects.create(name='topic', type='topic')
+        self.fanout = models.Exchange.objects.create(name='fanout', type='fanout')
+
+    def create_queue(self, exchange, name, routing_key):
+        return models.Queue.objects.create(exchange=exchange, name=name, routing_key=routing_key,
+                                           connection='memory://')
+
+    def test_topic_wildcards(self):
+        index = routing.TopicIndex()
+        for name, pattern in (('star', 'order.*'), ('hash', 'order.#'), ('exact', 'order.created'),
+                              ('middle', '*.created.#'), ('all', '#')):
+            index.bind(models.Queue(name=name, routing_key=pattern))
+        self.assertEqual(set(index.match('order')), {'hash', 'all'})
+        self.assertEqual(set(index.match('order.created')), {'star', 'hash', 'exact', 'middle', 'all'})
+        self.assertEqual(set(index.match('order.created.eu.1')), {'hash', 'middle', 'all'})
+        self.assertEqual(set(index.match('user.deleted')), {'all'})
+        index.unbind(models.Queue(name='all', routing_key='#'))
+        self.assertEqual(set(index.match('user.deleted')), set())
+
+    def test_get_queue_without_queries(self):
+        self.create_queue(self.direct, 'direct-q', 'key')
+        self.create_queue(self.topic, 'topic-q', 'order.#')
+        self.create_queue(self.fanout, 'fanout-q', 'ignored')
+        routing.table.ensure_loaded()
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(routing.table.get_queue(routing.table.get_exchange('direct'), 'key', 'direct-q'))
+            self.assertIsNone(routing.table.get_queue(self.direct, 'other', 'direct-q'))
+            self.assertIsNotNone(routing.table.get_queue(self.topic, 'order.created.eu', 'topic-q'))
+            self.assertIsNone(routing.table.get_queue(self.topic, 'user.created', 'topic-q'))
+            self.assertIsNotNone(routing.table.get_queue(self.fanout, 'anything', 'fanout-q'))
+
+    def test_incremental_updates(self):
+        queue = self.create_queue(self.topic, 'topic-q', 'order.*')
+        routing.table.ensure_loaded()
+        queue.routing_key = 'user.*'
+        queue.save()
+        self.assertIsNone(routing.table.get_queue(self.topic, 'order.created', 'topic-q'))
+        self.assertIsNotNone(routing.table.get_queue(self.topic, 'user.created', 'topic-q'))
+        self.topic.type = 'direct'
+        self.topic.save()
+        self.assertIsNotNone(routing.table.get_queue(self.topic, 'user.*', 'topic-q'))
+        queue.delete()
+        self.assertIsNone(routing.table.get_queue(self.topic, 'user.*', 'topic-q'))
+
+    def test_version_invalidation(self):
+        queue = self.create_queue(self.direct, 'direct-q', 'key')
+        routing.table.ensure_loaded()
+        # 本进程的修改提交后版本号递增, 快照已经增量更新, 不需要重新加载
+        with self.captureOnCommitCallbacks(execute=True):
+            queue.routing_key = 'other'
+            queue.save()
+        self.assertEqual(routing.table.stamp.version, invalidation.get_version('routing'))
+        # 其它进程的修改: 不经过信号直接修改数据库并递增版本号, 下次检查时重新加载
+        models.Queue.objects.filter(name='direct-q').update(routing_key='changed')
+        invalidation.incr_version('routing')
+        self.assertIsNotNone(routing.table.get_queue(self.direct, 'other', 'direct-q'))
+        routing.table.stamp.next_check = 0
+        self.assertIsNone(routing.table.get_queue(self.direct, 'other', 'direct-q'))
+        self.assertIsNotNone(routing.table.get_queue(self.direct, 'changed', 'direct-q'))
+
+    def test_broadcast_invalidation(self):
+        routing.table.ensure_loaded()
+        other = invalidation.Broadcaster(invalidation.broadcaster.url)
+        deadline = time.monotonic() + 5
+        # 订阅线程启动后才会收到广播
+        while routing.table.loaded and time.monotonic() < deadline:
+            other.publish('routing', 0)
+            time.sleep(0.05)
+        self.assertFalse(routing.table.loaded)
+        # 本进程发出的广播不会清空自己的快照
+        routing.table.ensure_loaded()
+        invalidation.broadcaster.publish('routing', 0)
+        time.sleep(0.2)
+        self.assertTrue(routing.table.loaded)
+
+
+class SchedulerTestCase(TestCase):
+
+    def setUp(self):
+        exchange = models.Exchange.objects.create(name='scheduler')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='scheduler', routing_key='scheduler',
+                                                 connection='memory://')
+        self.category = models.Category.objects.create(name='scheduler')
+        self.schedule = models.Schedule.objects.create(schedule_type='interval', config={
+            'interval': {'start_time': '2024-01-01 00:00:00', 'interval': 1, 'period': 'hours'}
+        })
+
+    def tearDown(self):
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    def test_task_without_queue(self):
+        now = timezone.now().replace(microsecond=0)
+        task = models.Task.objects.create(name='no-queue', category=self.category, schedule=self.schedule,
+                                          is_rigorous=True, next_start_time=now)
+        with self.assertLogs('task_system.scheduler', 'WARNING'):
+            self.assertEqual(Scheduler().tick(now), 0)
+        # 没有发布, 只推进下次运行时间, 不计入运行次数
+        task.refresh_from_db()
+        self.assertEqual(task.next_start_time, now + timedelta(hours=1))
+        self.assertEqual((task.total_run_count, task.last_run_at), (0, None))
+        self.assertEqual(task.scheduled_runs.first().run_time, task.next_start_time)
+
+    def test_missed_runs_logged(self):
+        now = timezone.now().replace(microsecond=0)
+        task = models.Task.objects.create(name='late', category=self.category, queue=self.queue,
+                                          schedule=self.schedule, next_start_time=now - timedelta(hours=5, minutes=30))
+        with self.assertLogs('task_system.scheduler', 'WARNING') as logs:
+            self.assertEqual(Scheduler().tick(now), 1)
+        self.assertIn('missed 5 runs', logs.output[0])
+        task.refresh_from_db()
+        self.assertEqual(task.next_start_time, now + timedelta(minutes=30))
+
+    def test_dispatch_due_tasks(self):
+        now = timezone.now()
+        due = [models.Task.objects.create(name=f'due-{i}', category=self.category, queue=self.queue,
+                                          schedule=self.schedule, next_start_time=now - timedelta(seconds=i))
+               for i in range(3)]
+        later = models.Task.objects.create(name='later', category=self.category, queue=self.queue,
+                                           schedule=self.schedule, next_start_time=now + timedelta(seconds=30))
+        scheduler = Scheduler(window=60, refill_interval=60)
+        self.assertEqual(scheduler.tick(now), 3)
+        self.assertEqual(scheduler.tick(now), 0)
+        for task in due:
+            task.refresh_from_db()
+            self.assertEqual(task.total_run_count, 1)
+            self.assertEqual(task.last_run_at, now)
+            self.assertGreater(task.next_start_time, now)
+        self.assertEqual(scheduler.next_timeout(now), 30)
+        self.assertEqual(scheduler.tick(later.next_start_time), 1)
+        with Connection(self.queue.connection) as conn:
+            self.assertEqual(conn.SimpleQueue(self.queue.name).qsize(), 4)
+
+    def test_dispatch_by_priority(self):
+        now = timezone.now()
+        tasks = [models.Task.objects.create(name=f'priority-{priority}', category=self.category, queue=self.queue,
+                                            schedule=self.schedule, priority=priority, next_start_time=now)
+                 for priority in (0, 9, 5)]
+        early = models.Task.objects.create(name='early', category=self.category, queue=self.queue,
+                                           schedule=self.schedule, next_start_time=now - timedelta(seconds=1))
+        scheduler = Scheduler(refill_interval=60)
+        scheduler.refill(now)
+        # 先按运行时间, 同一时间优先级高的先出堆
+        self.assertEqual(scheduler.pop_due(now), [early.id, tasks[1].id, tasks[2].id, tasks[0].id])
+
+    def test_sharded_nodes_dispatch_once(self):
+        now = timezone.now()
+        for i in range(50):
+            models.Task.objects.create(name=f'due-{i}', category=self.category, queue=self.queue,
+                                       schedule=self.schedule, next_start_time=now - timedelta(seconds=1))
+        first = Scheduler(refill_interval=60, coordinator=ShardCoordinator('first', shards=8))
+        second = Scheduler(refill_interval=60, coordinator=ShardCoordinator('second', shards=8))
+        first.sync(now)
+        second.sync(now)
+        # first先启动持有全部分片, 第二个节点加入后重新平衡
+        self.assertEqual(len(first.coordinator.owned), 8)
+        first.sync(now)
+        second.sync(now)
+        self.assertEqual(len(first.coordinator.owned), 4)
+        self.assertEqual(len(second.coordinator.owned), 4)
+        self.assertFalse(first.coordinator.owned & second.coordinator.owned)
+        self.assertTrue(first.coordinator.is_leader)
+        self.assertEqual(first.tick(now) + second.tick(now), 50)
+        self.assertEqual(first.tick(now) + second.tick(now), 0)
+        self.assertEqual(set(models.Task.objects.values_list('total_run_count', flat=True)), {1})
+
+        # second下线后租约过期, first接管全部分片
+        later = now + timedelta(seconds=60)
+        models.Task.objects.update(next_start_time=later)
+        first.sync(later)
+        self.assertEqual(len(first.coordinator.owned), 8)
+        self.assertEqual(first.tick(later), 50)
+
+
+class ScheduleCatchUpTestCase(SimpleTestCase):
+    """与原来逐个周期循环的实现比较, 随机生成的输入结果必须一致"""
+    samples = 2000
+
+    @staticmethod
+    def loop_catch_up(next_time, step, now):
+        missed = 0
+        while next_time <= now:
+            next_time += step
+            missed += 1
+        return next_time, missed
+
+    def random_time(self, rnd):
+        return datetime(2024, 1, 1) + timedelta(seconds=rnd.randint(0, 3 * 365 * 24 * 3600),
+                                                microseconds=rnd.randint(0, 999999))
+
+    def test_catch_up_matches_loop(self):
+        rnd = random.Random(20240501)
+        for _ in range(self.samples):
+            next_time = self.random_time(rnd)
+            step = timedelta(seconds=rnd.choice([1, 7, 60, 3600, 86400]) * rnd.randint(1, 50),
+                             microseconds=rnd.choice([0, rnd.randint(0, 999999)]))
+            now = next_time + timedelta(seconds=rnd.randint(-3600, 300 * int(step.total_seconds())))
+            self.assertEqual(schedule_config.catch_up(next_time, step, now),
+                             self.loop_catch_up(next_time, step, now), (next_time, step, now))
+
+    def test_interval_matches_loop(self):
+        rnd = random.Random(20240502)
+        for _ in range(self.samples):
+            period, seconds = rnd.choice([('seconds', 1), ('minutes', 60), ('hours', 3600), ('days', 86400)])
+            config = {'start_time': '', 'interval': rnd.randint(1, 30), 'period': period}
+            last_time = self.random_time(rnd)
+            step = timedelta(seconds=config['interval'] * seconds)
+            now = last_time + timedelta(seconds=rnd.randint(0, 1000 * int(step.total_seconds())))
+            expected = self.loop_catch_up(last_time + step, step, now)
+            self.assertEqual(schedule_config.get_next_interval_time(config, last_time, now=now), expected)
+            self.assertEqual(schedule_config.get_next_interval_time(config, last_time, True, now=now),
+                             (last_time + step, 0))
+
+    def test_paused_seconds_interval(self):
+        last_time = datetime(2024, 1, 1)
+        now = last_time + timedelta(days=7, seconds=5)
+        config = {'start_time': '', 'interval': 1, 'period': 'seconds'}
+        next_time, missed = schedule_config.get_next_interval_time(config, last_time, now=now)
+        self.assertEqual(next_time, now + timedelta(seconds=1))
+        self.assertEqual(missed, 7 * 24 * 3600 + 5)
+
+    def test_day_timing_matches_loop(self):
+        rnd = random.Random(20240503)
+        for _ in range(self.samples):
+            last_time = self.random_time(rnd)
+            period = rnd.randint(1, 10)
+            time = f'{rnd.randint(0, 23)}:{rnd.randint(0, 59)}:{rnd.randint(0, 59)}'
+            config = {'type': 'DAY', 'DAY': {'time': time, 'period': period}}
+            hour, minute, second = map(int, time.split(':'))
+            start = datetime(last_time.year, last_time.month, last_time.day, hour, minute, second)
+            expected = self.loop_catch_up(start, timedelta(days=period), last_time)[0]
+            self.assertEqual(schedule_config._get_next_time_of_timing(config, last_time, True), expected)
+
+
+class CompiledScheduleCacheTestCase(TestCase):
+
+    def test_compile(self):
+        configs = {
+            'crontab': ({'crontab': '0 * * * *'}, schedule_config.CompiledCrontab),
+            'interval': ({'interval': 5, 'period': 'minutes'}, schedule_config.CompiledInterval),
+            'timing': ({'type': 'DAY', 'DAY': {'time': '08:30'}}, schedule_config.CompiledTiming),
+            'clocked': ({'clocked': ['2024-05-08 12:00:00']}, schedule_config.CompiledClocked),
+        }
+        cache = CompiledScheduleCache()
+        for schedule_type, (config, cls) in configs.items():
+            with self.subTest(schedule_type=schedule_type):
+                # ScheduleConfig格式的完整配置同样可以编译
+                schedule = models.Schedule(id=1, schedule_type=schedule_type, config={schedule_type: config},
+                                           update_time=timezone.now())
+                compiled = cache.get(schedule)
+                self.assertIsInstance(compiled, cls)
+                self.assertIs(cache.get(schedule), compiled)
+                cache.clear()
+        with self.assertRaises(AttributeError):
+            compiled.clocked = ()
+
+    def test_lru(self):
+        cache = CompiledScheduleCache(maxsize=2)
+        now = timezone.now()
+        schedules = [models.Schedule(id=i + 1, schedule_type='crontab', config={'crontab': f'{i} * * * *'},
+                                     update_time=now) for i in range(3)]
+        first = cache.get(schedules[0])
+        cache.get(schedules[1])
+        self.assertIs(cache.get(schedules[0]), first)
+        # 淘汰最久没有使用的schedules[1]
+        cache.get(schedules[2])
+        self.assertIs(cache.get(schedules[0]), first)
+        self.assertEqual(len(cache._cache), 2)
+        self.assertNotIn((schedules[1].pk, now), cache._cache)
+        # 未保存的Schedule不缓存
+        self.assertIsNot(cache.get(models.Schedule(schedule_type='crontab', config={'crontab': '* * * * *'})),
+                         cache.get(models.Schedule(schedule_type='crontab', config={'crontab': '* * * * *'})))
+
+    def test_invalidated_by_config(self):
+        schedule = models.Schedule.objects.create(schedule_type='interval', config={'interval': 1, 'period': 'hours'})
+        self.assertEqual(schedule.compiled.step, timedelta(hours=1))
+        schedule.config = {'interval': 2, 'period': 'hours'}
+        schedule.save()
+        self.assertEqual(models.Schedule.objects.get(id=schedule.id).compiled.step, timedelta(hours=2))
+        # queryset.update需要同时更新update_time
+        models.Schedule.objects.filter(id=schedule.id).update(config={'interval': 3, 'period': 'hours'},
+                                                                update_time=timezone.now())
+        self.assertEqual(models.Schedule.objects.get(id=schedule.id).compiled.step, timedelta(hours=3))
+        # 只更新config时update_time不变, 命中旧的编译结果, 本进程可以显式失效
+        models.Schedule.objects.filter(id=schedule.id).update(config={'interval': 4, 'period': 'hours'})
+        self.assertEqual(models.Schedule.objects.get(id=schedule.id).compiled.step, timedelta(hours=3))
+        compiled_schedules.invalidate(schedule.id)
+        self.assertEqual(models.Schedule.objects.get(id=schedule.id).compiled.step, timedelta(hours=4))
+
+    def test_invalidated_on_delete(self):
+        schedule = models.Schedule.objects.create(schedule_type='interval', config={'interval': 1, 'period': 'hours'})
+        schedule.compiled
+        pk = schedule.pk
+        self.assertTrue(any(key[0] == pk for key in compiled_schedules._cache))
+        schedule.delete()
+        self.assertFalse(any(key[0] == pk for key in compiled_schedules._cache))
+
+
+class ClockedScheduleTestCase(TestCase):
+
+    def test_next_after(self):
+        compiled = schedule_config.CompiledClocked({'clocked': ['2024-05-09 12:00:00', '2024-05-08 12:00:00',
+                                                                 datetime(2024, 5, 10)]})
+        self.assertEqual(compiled.next_after(None), datetime(2024, 5, 8, 12))
+        self.assertEqual(compiled.next_after(datetime(2024, 5, 8, 12)), datetime(2024, 5, 9, 12))
+        self.assertEqual(compiled.next_after(datetime(2024, 5, 9, 13)), datetime(2024, 5, 10))
+        self.assertIsNone(compiled.next_after(datetime(2024, 5, 10)))
+
+    def test_exhausted_task_disabled(self):
+        schedule = models.Schedule.objects.create(schedule_type='clocked', config={
+            'clocked': {'clocked': ['2024-05-08 12:00:00', '2024-05-09 12:00:00']}})
+        task = models.Task.objects.create(name='clocked', category=models.Category.objects.create(name='c'),
+                                          schedule=schedule, last_run_at=timezone.make_aware(datetime(2024, 5, 8, 12)))
+        # 从数据库读出的last_run_at是aware时间
+        task.refresh_from_db()
+        task.generate_next_task()
+        task.refresh_from_db()
+        self.assertTrue(task.enabled)
+        self.assertEqual(task.next_start_time, timezone.make_aware(datetime(2024, 5, 9, 12)))
+        models.Task.objects.filter(id=task.id).update(last_run_at=timezone.make_aware(datetime(2024, 5, 9, 12)))
+        task.refresh_from_db()
+        task.generate_next_task()
+        task.refresh_from_db()
+        self.assertFalse(task.enabled)
+        self.assertEqual(task.next_start_time, max_time())
+
+
+class BulkNextTimesTestCase(TestCase):
+
+    def setUp(self):
+        rnd = random.Random(20240504)
+        self.now = datetime(2024, 6, 1, 8, 30)
+        self.tasks = []
+        for i in range(300):
+            if i % 2:
+                schedule = models.Schedule(id=i, schedule_type='interval', update_time=self.now, config={
+                    'interval': rnd.randint(1, 100), 'period': rnd.choice(['seconds', 'minutes', 'hours', 'days'])})
+            else:
+                schedule = models.Schedule(id=i, schedule_type='timing', update_time=self.now, config={
+                    'type': 'DAY', 'DAY': {'time': f'{rnd.randint(0, 23)}:{rnd.randint(0, 59)}',
+                                           'period': rnd.randint(1, 7)}})
+            last_run_at = self.now - timedelta(seconds=rnd.randint(0, 30 * 24 * 3600))
+            self.tasks.append(models.Task(name=f'task-{i}', schedule=schedule, is_rigorous=rnd.random() < 0.3,
+                                          last_run_at=last_run_at))
+        self.expected = [task.schedule.compiled.next_time(task.last_run_at, task.is_rigorous, self.now)
+                         for task in self.tasks]
+
+    def test_python(self):
+        self.assertEqual(schedule_bulk.bulk_next_times(self.tasks, self.now, use_numpy=False), self.expected)
+
+    @skipIf(schedule_bulk.np is None, 'numpy is not installed')
+    def test_numpy(self):
+        self.assertEqual(schedule_bulk.bulk_next_times(self.tasks, self.now, use_numpy=True), self.expected)
+
+    def test_never_run(self):
+        category = models.Category.objects.create(name='never')
+        now = timezone.make_aware(datetime(2024, 6, 1, 8, 30))
+        configs = {
+            'interval': {'interval': 10, 'period': 'minutes'},
+            'timing': {'type': 'DAY', 'DAY': {'time': '09:00'}},
+            'clocked': {'clocked': ['2024-05-08 12:00:00', '2024-07-01 00:00:00']},
+            'crontab': {'crontab': '0 * * * *'},
+        }
+        for schedule_type, config in configs.items():
+            for is_rigorous in (False, True):
+                with self.subTest(schedule_type=schedule_type, is_rigorous=is_rigorous):
+                    schedule = models.Schedule.objects.create(schedule_type=schedule_type, config=config)
+                    task = models.Task.objects.create(name=f'never-{schedule_type}-{is_rigorous}', category=category,
+                                                      schedule=schedule, is_rigorous=is_rigorous)
+                    expected, = schedule_bulk.bulk_next_times([task], now)
+                    # 逐个计算与批量计算一致, 都从now开始
+                    task.generate_next_task(now)
+                    self.assertEqual(task.next_start_time, from_schedule_time(expected))
+                    self.assertGreater(task.next_start_time, now)
+
+    def test_bulk_generate_next_task(self):
+        category = models.Category.objects.create(name='bulk')
+        schedule = models.Schedule.objects.create(schedule_type='interval', config={'interval': 1, 'period': 'hours'})
+        tasks = [models.Task.objects.create(name=f'bulk-{i}', category=category, schedule=schedule,
+                                            is_rigorous=True, last_run_at=timezone.now()) for i in range(5)]
+        tasks = list(models.Task.objects.select_related('schedule'))
+        # 一条executemany写回, 运行计划的增量维护3条, 与任务数无关
+        with self.assertNumQueries(4):
+            models.Task.bulk_generate_next_task(tasks, batch_size=10)
+        for task in models.Task.objects.all():
+            self.assertEqual(task.next_start_time, task.last_run_at + timedelta(hours=1))
+
+
+@override_settings(TASK_TIMELINE_SIZE=5)
+class TimelineTestCase(TestCase):
+
+    def setUp(self):
+        exchange = models.Exchange.objects.create(name='timeline')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='timeline', routing_key='timeline',
+                                                 connection='memory://')
+        self.category = models.Category.objects.create(name='timeline')
+        self.schedule = models.Schedule.objects.create(schedule_type='interval', config={'interval': 1,
+                                                                                         'period': 'hours'})
+        self.now = timezone.now().replace(microsecond=0)
+        self.task = models.Task.objects.create(name='timeline', category=self.category, queue=self.queue,
+                                               schedule=self.schedule, is_rigorous=True,
+                                               next_start_time=self.now + timedelta(minutes=30))
+
+    def tearDown(self):
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    def run_times(self):
+        return list(self.task.scheduled_runs.values_list('run_time', flat=True))
+
+    def test_rebuilt_on_save(self):
+        start = self.task.next_start_time
+        self.assertEqual(self.run_times(), [start + timedelta(hours=i) for i in range(5)])
+        self.schedule.config = {'interval': 2, 'period': 'hours'}
+        self.schedule.save()
+        self.assertEqual(self.run_times(), [start + timedelta(hours=2 * i) for i in range(5)])
+        self.task.enabled = False
+        self.task.save()
+        self.assertEqual(self.run_times(), [])
+
+    def test_rebuilt_only_on_schedule_change(self):
+        ids = set(self.task.scheduled_runs.values_list('id', flat=True))
+        task = models.Task.objects.get(id=self.task.id)
+        task.description = 'changed'
+        task.save()
+        task.save(update_fields=('description', ))
+        self.assertEqual(set(self.task.scheduled_runs.values_list('id', flat=True)), ids)
+        task.next_start_time += timedelta(minutes=10)
+        task.save(update_fields=('next_start_time', ))
+        self.assertEqual(self.run_times(), [task.next_start_time + timedelta(hours=i) for i in range(5)])
+
+    def test_bulk_generate_next_task(self):
+        self.task.last_run_at = self.now
+        models.Task.objects.filter(id=self.task.id).update(last_run_at=self.now)
+        tasks = list(models.Task.objects.select_related('schedule'))
+        # 批量写回不触发post_save, 运行计划同样跟随新的next_start_time
+        models.Task.bulk_generate_next_task(tasks)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.next_start_time, self.now + timedelta(hours=1))
+        self.assertEqual(self.run_times(), [self.task.next_start_time + timedelta(hours=i) for i in range(5)])
+
+    def test_window_single_query(self):
+        with self.assertNumQueries(1):
+            runs = list(timeline.window(self.now, self.now + timedelta(hours=3)))
+        self.assertEqual([run['run_time'] for run in runs], self.run_times()[:3])
+        response = self.client.get('/task/timeline/', {'start': self.now.isoformat().replace('+00:00', ''),
+                                                           'hours': 6})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 5)
+        self.assertEqual(response.json()[0]['name'], 'timeline')
+
+    def test_extended_after_dispatch(self):
+        scheduler = Scheduler(refill_interval=60)
+        counts = []
+        for _ in range(4):
+            scheduler.next_refill = None
+            self.assertEqual(scheduler.tick(self.task.next_start_time), 1)
+            self.task.refresh_from_db()
+            run_times = self.run_times()
+            start = self.task.next_start_time
+            self.assertEqual(run_times, [start + timedelta(hours=i) for i in range(len(run_times))])
+            counts.append(len(run_times))
+        # 剩余不到一半时补齐
+        self.assertEqual(counts, [4, 3, 5, 4])
+
+
+class TaskLogTestCase(TestCase):
+
+    def setUp(self):
+        category = models.Category.objects.create(name='log')
+        self.task = models.Task.objects.create(name='log', category=category)
+
+    def test_writer_batches_inserts(self):
+        writer = tasklog.TaskLogWriter(batch_size=10, flush_interval=0)
+        with self.assertNumQueries(0):
+            for _ in range(9):
+                writer.write(self.task, 'SUCCESS', 'queue')
+        with self.assertNumQueries(1):
+            writer.write(self.task, 'SUCCESS', 'queue')
+        self.assertEqual(models.TaskLog.objects.count(), 10)
+        writer.write(self.task, 'FAILURE', 'queue')
+        self.task.preserve_log = False
+        writer.write(self.task, 'FAILURE', 'queue')
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(models.TaskLog.objects.filter(state='FAILURE').count(), 1)
+
+    def test_prune_in_batches(self):
+        now = timezone.now()
+        models.TaskLog.objects.bulk_create([
+            models.TaskLog(task=self.task, state='SUCCESS', queue='queue', start_time=now,
+                           create_time=now - timedelta(days=i)) for i in range(25)
+        ])
+        # 每批一次查询id和一次删除, 最后一批不足batch_size时结束
+        with self.assertNumQueries(6):
+            deleted = tasklog.prune(tasklog.retention_cutoff(10, now), batch_size=5)
+        self.assertEqual(deleted, 14)
+        self.assertEqual(models.TaskLog.objects.count(), 11)
+
+
+class ReportTestCase(TestCase):
+
+    def setUp(self):
+        category = models.Category.objects.create(name='report')
+        self.tasks = [models.Task.objects.create(name=f'report-{i}', category=category) for i in range(3)]
+        self.tasks[2].preserve_log = False
+        self.tasks[2].save()
+        self.now = timezone.now()
+
+    def event(self, task, state, run=None, seconds=0, **kwargs):
+        return dict(task=str(task.id), state=state, run=run, time=(self.now + timedelta(seconds=seconds)).isoformat(),
+                    **kwargs)
+
+    def test_coalesced_batch(self):
+        events = []
+        for i, task in enumerate(self.tasks):
+            for j in range(2):
+                run = f'{task.id}-{j}'
+                events += [self.event(task, 'SUCCESS', run, 10 * j + 5, result={'j': j}),
+                           self.event(task, 'STARTED', run, 10 * j)]
+        events += [self.event(self.tasks[0], 'STARTED', 'pending', 30), {'task': 'bad', 'state': 'SUCCESS'},
+                   dict(self.event(self.tasks[0], 'SUCCESS'), task=str(models.uuid.uuid4()))]
+        # 查询任务, 查询已有日志, 批量upsert日志, 按增量分组的两条F()更新, 一条executemany更新last_run_at, 以及事务的savepoint
+        with self.assertNumQueries(8):
+            result = reports.apply(events, self.now)
+        self.assertEqual((result['runs'], result['logs']), (7, 5))
+        self.assertEqual([error['index'] for error in result['errors']], [13])
+        self.assertEqual(len(result['missing']), 1)
+        counts = dict(models.Task.objects.values_list('name', 'total_run_count'))
+        self.assertEqual(counts, {'report-0': 3, 'report-1': 2, 'report-2': 2})
+        self.tasks[1].refresh_from_db()
+        self.assertEqual(self.tasks[1].last_run_at, self.now + timedelta(seconds=10))
+        log = models.TaskLog.objects.get(run_id=f'{self.tasks[0].id}-1')
+        self.assertEqual((log.state, log.result, log.start_time), ('SUCCESS', {'j': 1}, self.now + timedelta(seconds=10)))
+
+        # 后续上报同一次运行只更新状态, 不重复计数
+        response = self.client.post('/task/report/', [self.event(self.tasks[0], 'FAILURE', 'pending', 40)],
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(models.TaskLog.objects.get(run_id='pending').state, 'FAILURE')
+        self.assertEqual(models.Task.objects.get(id=self.tasks[0].id).total_run_count, 3)
+        self.assertEqual(models.TaskLog.objects.count(), 5)
+
+    def test_reapply_is_idempotent(self):
+        task = self.tasks[0]
+        started = self.event(task, 'STARTED', 'run', 0, queue='q')
+        reports.apply([started], self.now)
+        reports.apply([started], self.now)
+        self.assertEqual(models.Task.objects.get(id=task.id).total_run_count, 1)
+        # 缺少queue的新事件不清空已有的值, 迟到的旧事件不让状态倒退
+        reports.apply([self.event(task, 'SUCCESS', 'run', 10, result={'x': 1})], self.now)
+        reports.apply([self.event(task, 'RETRY', 'run', 5), self.event(task, 'SUCCESS', 'run', 10)], self.now)
+        log = models.TaskLog.objects.get(run_id='run')
+        self.assertEqual((log.state, log.result, log.queue, log.start_time, log.state_time),
+                         ('SUCCESS', {'x': 1}, 'q', self.now, self.now + timedelta(seconds=10)))
+        self.assertEqual(models.Task.objects.get(id=task.id).total_run_count, 1)
+        # 没有run的事件各自作为一次运行
+        result = reports.apply([self.event(self.tasks[1], 'SUCCESS', seconds=1),
+                                self.event(self.tasks[1], 'SUCCESS', seconds=2)], self.now)
+        self.assertEqual(result['logs'], 2)
+        self.assertEqual(models.TaskLog.objects.filter(task=self.tasks[1]).count(), 2)
+
+    def test_scheduled_runs_counted_once(self):
+        # 调度进程发布时已经计数, 上报只更新日志和last_run_at
+        models.Task.objects.filter(id=self.tasks[0].id).update(total_run_count=1, last_run_at=self.now)
+        reports.apply([self.event(self.tasks[0], 'STARTED', 'scheduled', 5, scheduled=True),
+                       self.event(self.tasks[0], 'SUCCESS', 'scheduled', 6)], self.now)
+        task = models.Task.objects.get(id=self.tasks[0].id)
+        self.assertEqual((task.total_run_count, task.last_run_at), (1, self.now + timedelta(seconds=5)))
+        self.assertEqual(models.TaskLog.objects.get(run_id='scheduled').state, 'SUCCESS')
+
+
+class TaskGetTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        self.sweep_interval, leases.sweeper.interval = leases.sweeper.interval, 0
+        exchange = models.Exchange.objects.create(name='get')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='get', routing_key='get',
+                                                 connection='memory://')
+        category = models.Category.objects.create(name='get')
+        self.tasks = [models.Task.objects.create(name=f'get-{i}', category=category) for i in range(3)]
+        self.client.post('/task/put/get/get/get/', [str(task.id) for task in self.tasks],
+                         content_type='application/json')
+        self.path = '/task/get/get/get/get/'
+
+    def tearDown(self):
+        leases.sweeper.interval = self.sweep_interval
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    def test_batch(self):
+        self.assertEqual(len(self.client.get(self.path, {'max': 2}).json()), 2)
+        self.assertEqual(len(self.client.get(self.path, {'max': 10}).json()), 1)
+        self.assertEqual(self.client.get(self.path, {'max': 10}).json(), [])
+        self.assertEqual(self.client.get(self.path, {'max': 1, 'ack': 'manual'}).status_code, 400)
+
+    def test_long_poll(self):
+        self.client.get(self.path, {'max': 10})
+        start = time.monotonic()
+        self.assertEqual(self.client.get(self.path, {'max': 10, 'wait': 0.2}).json(), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+        def publish():
+            with Connection(self.queue.connection) as conn:
+                Producer(conn).publish({'id': str(self.tasks[0].id)}, exchange=Exchange('get'), routing_key='get',
+                                       serializer='json')
+
+        # 等待期间发布的消息立即返回, 不等到wait结束
+        threading.Timer(0.2, publish).start()
+        start = time.monotonic()
+        messages = self.client.get(self.path, {'max': 10, 'wait': 5}).json()
+        self.assertEqual([message['task']['id'] for message in messages], [str(self.tasks[0].id)])
+        self.assertLess(time.monotonic() - start, 4)
+
+    def test_topic_binding(self):
+        exchange = models.Exchange.objects.create(name='get-topic', type='topic')
+        queue = models.Queue.objects.create(exchange=exchange, name='get-topic', routing_key='get.*',
+                                            connection='memory://')
+        response = self.client.post('/task/put/get-topic/get-topic/get.a/', [str(self.tasks[0].id)],
+                                    content_type='application/json')
+        self.assertEqual(response.json()[0]['status'], 'published')
+        # 队列按Queue.routing_key绑定, 其它匹配get.*的消息同样投递到队列
+        with Connection(queue.connection) as conn:
+            Producer(conn).publish({'id': str(self.tasks[1].id)}, exchange=Exchange('get-topic', type='topic'),
+                                   routing_key='get.b', serializer='json')
+        messages = self.client.get('/task/get/get-topic/get-topic/get.a/', {'max': 10}).json()
+        self.assertEqual([message['task']['id'] for message in messages],
+                         [str(self.tasks[0].id), str(self.tasks[1].id)])
+
+    def test_explicit_ack(self):
+        # explicit由客户端用token确认, 不确认的消息不会丢失
+        messages = self.client.get(self.path, {'max': 2, 'ack': 'explicit', 'visibility': 30}).json()
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(models.MessageLease.objects.count(), 2)
+        response = self.client.post('/task/ack/', {'tokens': [messages[0]['token']]}, content_type='application/json')
+        self.assertEqual(response.json(), {'acked': 1})
+        self.assertEqual(leases.sweep(timezone.now() + timedelta(seconds=31)), 1)
+        self.assertEqual(len(self.client.get(self.path, {'max': 10}).json()), 2)
+
+
+class AsyncTaskAPITestCase(TransactionTestCase):
+    """异步视图的broker调用在线程池中执行, 使用TransactionTestCase让其它线程的数据库连接能看到数据"""
+
+    def setUp(self):
+        routing.table.clear()
+        exchange = models.Exchange.objects.create(name='async')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='async', routing_key='async',
+                                                 connection='memory://')
+        category = models.Category.objects.create(name='async')
+        self.tasks = [models.Task.objects.create(name=f'async-{i}', category=category) for i in range(3)]
+        self.client = AsyncClient()
+
+    def tearDown(self):
+        routing.table.clear()
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    async def test_put_and_long_poll(self):
+        ids = [str(task.id) for task in self.tasks] + [str(models.uuid.uuid4()), 'bad']
+        response = await self.client.post('/task/async/put/async/async/async/', ids, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.json()],
+                         ['failed', 'missing', 'published', 'published', 'published'])
+        response = await self.client.get('/task/async/get/async/async/async/', {'max': 10, 'wait': 1})
+        self.assertEqual(sorted(message['task']['id'] for message in response.json()), sorted(ids[:3]))
+
+        start = time.monotonic()
+        response = await self.client.get('/task/async/get/async/async/async/', {'max': 10, 'wait': 0.3})
+        self.assertEqual(response.json(), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        response = await self.client.get('/task/async/get/async/async/async/')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_executor_closes_connections(self):
+        threads = []
+        with mock.patch.object(async_views, 'close_old_connections',
+                               side_effect=lambda: threads.append(threading.current_thread().name)):
+            await self.client.post('/task/async/put/async/async/async/', [str(self.tasks[0].id)],
+                                   content_type='application/json')
+            await self.client.get('/task/async/get/async/async/async/', {'max': 10})
+        # 路由解析和broker调用各占一次, 线程池中的每次调用前后都检查数据库连接, 不会在线程中一直持有
+        self.assertEqual(len(threads), 8)
+        self.assertTrue(all(name.startswith('task-io') for name in threads))
+
+    async def test_route_resolved_off_loop(self):
+        threads = []
+        get_exchange = routing.table.get_exchange
+
+        def record(*args):
+            threads.append(threading.current_thread().name)
+            return get_exchange(*args)
+
+        # 快照可能随时被失效广播清空, 路由解析(包括重新加载)整体在线程池中执行
+        with mock.patch.object(routing.table, 'get_exchange', side_effect=record):
+            for _ in range(2):
+                routing.table.clear()
+                response = await self.client.post('/task/async/put/async/async/async/', [str(self.tasks[0].id)],
+                                                  content_type='application/json')
+                self.assertEqual(response.json()[0]['status'], 'published')
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith('task-io') for name in threads))
+
+    async def test_explicit_ack(self):
+        await self.client.post('/task/async/put/async/async/async/', [str(task.id) for task in self.tasks],
+                               content_type='application/json')
+        response = await self.client.get('/task/async/get/async/async/async/', {'max': 10, 'ack': 'explicit'})
+        tokens = [message['token'] for message in response.json()]
+        self.assertEqual(len(tokens), 3)
+        response = await self.client.post('/task/ack/', {'tokens': tokens}, content_type='application/json')
+        self.assertEqual(response.json(), {'acked': 3})
+
+    async def test_concurrent_long_polls(self):
+        async def publish(number):
+            await asyncio.sleep(0.2)
+            for _ in range(number):
+                await self.client.get('/task/async/put/async/async/async/', {'task_id': str(self.tasks[0].id)})
+
+        # 30个长轮询同时挂起, 消息陆续发布后各自返回
+        polls = [self.client.get('/task/async/get/async/async/async/', {'max': 1, 'wait': 5}) for _ in range(30)]
+        responses = await asyncio.gather(*polls, publish(30))
+        self.assertEqual(sum(len(response.json()) for response in responses[:-1]), 30)
+
+
+class StreamTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        exchange = models.Exchange.objects.create(name='stream')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='stream', routing_key='stream',
+                                                 connection='memory://')
+        category = models.Category.objects.create(name='stream')
+        self.tasks = [models.Task.objects.create(name=f'stream-{i}', category=category) for i in range(3)]
+
+    def tearDown(self):
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    @staticmethod
+    def parse(chunk):
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        fields = dict(line.split(': ', 1) for line in chunk.strip().splitlines() if not line.startswith(':'))
+        return fields.get('id'), fields.get('event'), json.loads(fields['data']) if 'data' in fields else None
+
+    def test_push_and_ack(self):
+        self.client.post('/task/put/stream/stream/stream/', [str(task.id) for task in self.tasks],
+                         content_type='application/json')
+        stream = self.client.get('/task/stream/stream/stream/stream/', {'prefetch': 2, 'heartbeat': 1})
+        self.assertEqual(stream['Content-Type'], 'text/event-stream')
+        events = iter(stream.streaming_content)
+        _, event, data = self.parse(next(events))
+        self.assertEqual(event, 'open')
+        stream_id = data['stream']
+        received = [self.parse(next(events)) for _ in range(2)]
+        self.assertEqual([event for _, event, _ in received], ['task', 'task'])
+        # prefetch为2, 确认一条之后才推送第三条
+        self.assertEqual(next(events), b': keepalive\n\n')
+        response = self.client.post(f'/task/stream/{stream_id}/ack/', {'ack': [received[0][0]]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        received.append(self.parse(next(events)))
+        self.assertEqual(sorted(data['task']['id'] for _, _, data in received),
+                         sorted(str(task.id) for task in self.tasks))
+        stream.close()
+        self.assertIsNone(streaming.streams.get(stream_id))
+        self.assertEqual(self.client.post(f'/task/stream/{stream_id}/ack/', {'ack': [1]},
+                                          content_type='application/json').status_code, 404)
+        # 断开时未确认的两条退回队列
+        with Connection(self.queue.connection) as conn:
+            self.assertEqual(conn.SimpleQueue(self.queue.name).qsize(), 2)
+
+    def test_ack_and_reject(self):
+        self.client.post('/task/put/stream/stream/stream/', [str(task.id) for task in self.tasks],
+                         content_type='application/json')
+        stream = self.client.get('/task/stream/stream/stream/stream/', {'prefetch': 2, 'heartbeat': 1})
+        events = iter(stream.streaming_content)
+        stream_id = self.parse(next(events))[2]['stream']
+        received = [self.parse(next(events)) for _ in range(2)]
+        # 同一请求里确认一条、丢弃一条
+        response = self.client.post(f'/task/stream/{stream_id}/ack/',
+                                    {'ack': [received[0][0]], 'reject': [received[1][0]], 'requeue': False},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.parse(next(events))[1], 'task')
+        stream.close()
+        # 只有第三条未确认, 退回队列
+        with Connection(self.queue.connection) as conn:
+            self.assertEqual(conn.SimpleQueue(self.queue.name).qsize(), 1)
+
+
+class LeaseTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        self.sweep_interval, leases.sweeper.interval = leases.sweeper.interval, 0
+        exchange = models.Exchange.objects.create(name='lease')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='lease', routing_key='lease',
+                                                 connection='memory://')
+        category = models.Category.objects.create(name='lease')
+        self.tasks = [models.Task.objects.create(name=f'lease-{i}', category=category) for i in range(3)]
+        self.client.post('/task/put/lease/lease/lease/', [str(task.id) for task in self.tasks],
+                         content_type='application/json')
+
+    def tearDown(self):
+        leases.sweeper.interval = self.sweep_interval
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    def qsize(self):
+        with Connection(self.queue.connection) as conn:
+            return conn.SimpleQueue(self.queue.name).qsize()
+
+    def test_ack_nack_and_sweep(self):
+        response = self.client.get('/task/get/lease/lease/lease/', {'ack': 'lease', 'max': 3, 'visibility': 30})
+        messages = response.json()
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(self.qsize(), 0)
+        self.assertEqual(models.MessageLease.objects.count(), 3)
+        tokens = [message['token'] for message in messages]
+
+        response = self.client.post('/task/ack/', {'tokens': tokens[:1]}, content_type='application/json')
+        self.assertEqual(response.json(), {'acked': 1})
+        response = self.client.post('/task/nack/', {'tokens': tokens[1:2]}, content_type='application/json')
+        self.assertEqual(response.json(), {'nacked': 1})
+        self.assertEqual(self.qsize(), 1)
+
+        # 未确认的消息过期后重新入队, 投递次数加一
+        self.assertEqual(leases.sweep(timezone.now()), 0)
+        self.assertEqual(leases.sweep(timezone.now() + timedelta(seconds=31)), 1)
+        self.assertEqual(models.MessageLease.objects.count(), 0)
+        self.assertEqual(self.client.post('/task/ack/', {'tokens': tokens[2:]},
+                                          content_type='application/json').json(), {'acked': 0})
+        messages = self.client.get('/task/get/lease/lease/lease/', {'ack': 'lease', 'max': 3}).json()
+        self.assertEqual(sorted(message['deliveries'] for message in messages), [2, 2])
+        self.assertEqual(sorted(message['task']['id'] for message in messages), sorted(map(str, [
+            self.tasks[1].id, self.tasks[2].id])))
+
+
+class FakeConfirmChannel:
+
+    def __init__(self):
+        self.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.confirming = False
+
+    def confirm_select(self):
+        self.confirming = True
+
+    def emit(self, event, delivery_tag, multiple=False):
+        for callback in self.events[event]:
+            callback(delivery_tag, multiple)
+
+
+class FakeConfirmConnection:
+    """drain_events时依次投递预设的ack/nack事件, 没有事件时超时"""
+
+    def __init__(self, channel, events):
+        self.channel = channel
+        self.events = list(events)
+
+    def drain_events(self, timeout=None):
+        if not self.events:
+            raise socket.timeout()
+        self.channel.emit(*self.events.pop(0))
+
+
+class BrokerPoolsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.pools = BrokerPools(limit=2)
+        self.addCleanup(self.pools.close_all)
+        self.queue = models.Queue(name='pool', connection='memory://')
+
+    def test_reuse(self):
+        with self.pools.acquire(self.queue) as conn:
+            first = conn.connection
+        with self.pools.acquire(self.queue) as conn:
+            # 归还后再取出的是同一个底层连接
+            self.assertIs(conn.connection, first)
+        with self.pools.connection('memory://') as conn:
+            self.assertIs(conn.connection, first)
+        self.assertEqual(list(self.pools._pools), ['memory://'])
+
+    def test_invalidate_waits_for_acquired(self):
+        with self.pools.acquire(self.queue):
+            pass
+        pool = self.pools._pools['memory://']
+        with mock.patch.object(pool, 'force_close_all', wraps=pool.force_close_all) as close:
+            with self.pools.acquire(self.queue) as conn:
+                self.pools.invalidate(self.queue)
+                # 已取出的连接不受影响, 新的请求使用新的连接池
+                self.assertNotIn(pool, self.pools._pools.values())
+                conn.default_channel.queue_declare('pool')
+                with self.pools.acquire(self.queue):
+                    self.assertIsNot(self.pools._pools['memory://'], pool)
+                close.assert_not_called()
+            # 最后一个连接归还后关闭失效的连接池
+            close.assert_called_once()
+        self.assertEqual((self.pools._retired, dict(self.pools._active)), (set(), {}))
+
+    def test_invalidate_idle(self):
+        with self.pools.acquire(self.queue):
+            pass
+        pool = self.pools._pools['memory://']
+        self.queue.connection = 'local://'
+        with mock.patch.object(pool, 'force_close_all') as close:
+            # 旧的connection对应的连接池同样关闭
+            self.pools.invalidate(self.queue)
+        close.assert_called_once()
+        self.assertEqual(self.pools._pools, {})
+
+
+class PublishTasksTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        category = models.Category.objects.create(name='publish')
+        self.tasks = [models.Task.objects.create(name=f'publish-{i}', category=category) for i in range(5)]
+
+    def publish(self, transport, task_ids, **kwargs):
+        exchange = models.Exchange.objects.get_or_create(name='publish')[0]
+        queue = models.Queue.objects.get_or_create(name=f'publish-{transport[:-3]}', defaults={
+            'exchange': exchange, 'routing_key': 'publish', 'connection': transport})[0]
+        with Connection(transport) as conn:
+            results = list(broker.publish_tasks(conn, queue, Exchange('publish'), 'publish', task_ids, **kwargs))
+            size = conn.SimpleQueue(queue.name).qsize()
+            conn.SimpleQueue(queue.name).clear()
+        return results, size
+
+    def test_chunks_and_invalid_ids(self):
+        missing = '00000000-0000-0000-0000-000000000000'
+        task_ids = [str(task.id) for task in self.tasks] + [str(self.tasks[0].id), 'bad', missing]
+        for transport in ('memory://', 'local://'):
+            with self.subTest(transport=transport), \
+                    mock.patch.object(serializers, 'prefetch_task_tree', wraps=serializers.prefetch_task_tree) as tree:
+                results, size = self.publish(transport, task_ids, chunk_size=2)
+                # 去重后7个id分4批查询
+                self.assertEqual(tree.call_count, 4)
+                self.assertEqual(sorted(result['id'] for result in results), sorted(set(task_ids)))
+                statuses = {result['id']: result['status'] for result in results}
+                self.assertEqual(statuses, {**{str(task.id): 'published' for task in self.tasks},
+                                            'bad': 'failed', missing: 'missing'})
+                self.assertEqual(size, len(self.tasks))
+
+    def test_confirm_without_support(self):
+        # memory/local不支持publisher confirm, 发布成功即视为确认
+        for transport in ('memory://', 'local://'):
+            with self.subTest(transport=transport):
+                results, size = self.publish(transport, [str(task.id) for task in self.tasks], confirm=True)
+                self.assertEqual({result['status'] for result in results}, {'published'})
+                self.assertEqual(size, len(self.tasks))
+
+    def test_confirms_ack_and_nack(self):
+        channel = FakeConfirmChannel()
+        conn = FakeConfirmConnection(channel, [('basic_ack', 2, True), ('basic_nack', 3)])
+        confirms = broker.PublisherConfirms(conn, channel, timeout=1)
+        self.assertTrue(confirms.supported and channel.confirming)
+        for key in 'abcd':
+            confirms.published(key)
+        # 1和2一起确认, 3被拒绝, 4一直没有确认
+        self.assertEqual(confirms.wait(), {'c', 'd'})
+        conn.events = [('basic_ack', 5)]
+        confirms.published('e')
+        self.assertEqual(confirms.wait(), set())
+
+    def test_unconfirmed_tasks_failed(self):
+        channel = FakeConfirmChannel()
+        confirms = broker.PublisherConfirms(FakeConfirmConnection(channel, []), channel, timeout=1)
+        producer = mock.Mock()
+        results = {}
+        broker._publish_chunk(producer, confirms, 'publish', {str(task.id): task for task in self.tasks[:2]},
+                              results)
+        self.assertEqual(producer.publish.call_count, 2)
+        self.assertEqual({result['status'] for result in results.values()}, {'failed'})
+        self.assertEqual({result['error'] for result in results.values()}, {'not confirmed by broker'})
+
+
+class LocalBrokerTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        self.sweep_interval, leases.sweeper.interval = leases.sweeper.interval, 0
+        exchange = models.Exchange.objects.create(name='local')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='local', routing_key='local',
+                                                 connection='local://')
+        category = models.Category.objects.create(name='local')
+        self.tasks = [models.Task.objects.create(name=f'local-{i}', category=category, priority=priority)
+                      for i, priority in enumerate((1, 5, 3, 5))]
+
+    def tearDown(self):
+        leases.sweeper.interval = self.sweep_interval
+
+    def test_get_put_by_priority(self):
+        response = self.client.post('/task/put/local/local/local/', [str(task.id) for task in self.tasks],
+                                    content_type='application/json')
+        self.assertEqual({result['status'] for result in response.json()}, {'published'})
+        self.assertEqual(models.LocalMessage.objects.filter(queue='local').count(), 4)
+        first = self.client.get('/task/get/local/local/local/').json()
+        self.assertEqual(first['task']['id'], str(self.tasks[1].id))
+        messages = self.client.get('/task/get/local/local/local/', {'max': 10, 'ack': 'explicit'}).json()
+        # 优先级从高到低, 同优先级先进先出
+        self.assertEqual([message['task']['id'] for message in [first] + messages],
+                         [str(self.tasks[i].id) for i in (1, 3, 2, 0)])
+        self.assertEqual(models.LocalMessage.objects.count(), 0)
+        self.assertEqual(self.client.get('/task/get/local/local/local/').status_code, 404)
+
+    def test_get_without_delete_returning(self):
+        self.assertEqual(local_broker.supports_delete_returning(),
+                         connection.Database.sqlite_version_info >= (3, 35))
+        self.client.post('/task/put/local/local/local/', [str(task.id) for task in self.tasks],
+                         content_type='application/json')
+        # 不支持DELETE ... RETURNING的数据库在事务中查询并删除
+        with mock.patch.object(local_broker, 'supports_delete_returning', return_value=False), \
+                mock.patch.object(local_broker.Channel, '_delete_returning') as delete_returning:
+            messages = self.client.get('/task/get/local/local/local/', {'max': 10}).json()
+        delete_returning.assert_not_called()
+        self.assertEqual([message['task']['id'] for message in messages],
+                         [str(self.tasks[i].id) for i in (1, 3, 2, 0)])
+        self.assertEqual(models.LocalMessage.objects.count(), 0)
+
+    def test_priority_queue(self):
+        self.queue.config = {'max_priority': 10}
+        kombu_queue = broker.build_queue(self.queue, Exchange('local'))
+        self.assertEqual(kombu_queue.max_priority, 10)
+        self.client.post('/task/put/local/local/local/', [str(self.tasks[2].id)], content_type='application/json')
+        message = self.client.get('/task/get/local/local/local/', {'max': 1, 'ack': 'lease'}).json()[0]
+        self.assertEqual(message['properties']['priority'], 3)
+        # 退回的消息保留原来的优先级
+        self.client.post('/task/put/local/local/local/', [str(self.tasks[0].id)], content_type='application/json')
+        self.client.post('/task/nack/', {'tokens': [message['token']]}, content_type='application/json')
+        self.assertEqual(self.client.get('/task/get/local/local/local/').json()['task']['id'], str(self.tasks[2].id))
+
+
+class WhitelistTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        whitelist.clear()
+        exchange = models.Exchange.objects.create(name='whitelist')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='whitelist', routing_key='whitelist',
+                                                 connection='memory://')
+        self.path = '/task/get/whitelist/whitelist/whitelist/'
+
+    def tearDown(self):
+        whitelist.clear()
+
+    def test_prefix_table(self):
+        table = PrefixTable()
+        for network in ('10.0.0.0/8', '192.168.1.7', '2001:db8::/32', '10.0.0.0/8'):
+            table.add(ipaddress.ip_network(network))
+        self.assertTrue(table.contains(4, int(ipaddress.ip_address('10.255.0.1'))))
+        self.assertTrue(table.contains(4, int(ipaddress.ip_address('192.168.1.7'))))
+        self.assertFalse(table.contains(4, int(ipaddress.ip_address('192.168.1.8'))))
+        self.assertTrue(table.contains(6, int(ipaddress.ip_address('2001:db8::1'))))
+        # 同一网段添加了两次, 删除一次后仍然生效
+        table.remove(ipaddress.ip_network('10.0.0.0/8'))
+        self.assertTrue(table.contains(4, int(ipaddress.ip_address('10.0.0.1'))))
+        table.remove(ipaddress.ip_network('10.0.0.0/8'))
+        self.assertFalse(table.contains(4, int(ipaddress.ip_address('10.0.0.1'))))
+
+    def test_middleware(self):
+        # 没有白名单的队列不限制
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='8.8.8.8').status_code, 404)
+        entry = models.QueueIPWhitelist.objects.create(queue=self.queue, allowed_ip='10.0.0.0/8')
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='10.1.2.3').status_code, 404)
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='::ffff:10.1.2.3').status_code, 404)
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='8.8.8.8').status_code, 403)
+        self.assertEqual(self.client.get('/task/async/get/whitelist/whitelist/whitelist/',
+                                         REMOTE_ADDR='8.8.8.8').status_code, 403)
+        # 修改记录时撤销旧网段
+        entry.allowed_ip = '8.8.8.0/24'
+        entry.save()
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='10.1.2.3').status_code, 403)
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='8.8.8.8').status_code, 404)
+        entry.enabled = False
+        entry.save()
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='10.1.2.3').status_code, 404)
+        entry.enabled = True
+        entry.save()
+        entry.delete()
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='10.1.2.3').status_code, 404)
+
+    def test_reload_keeps_old_snapshot(self):
+        entry = models.QueueIPWhitelist.objects.create(queue=self.queue, allowed_ip='10.0.0.0/8')
+        self.assertFalse(whitelist.is_allowed(self.queue.name, '8.8.8.8'))
+        old = whitelist.ensure_loaded()
+        build = WhitelistSnapshot.build.__func__
+        checked = []
+
+        def check_during_build(cls, entries):
+            # 新快照构建完成前仍然使用旧快照, 不会放行
+            checked.append(whitelist.is_allowed(self.queue.name, '8.8.8.8'))
+            return build(cls, entries)
+
+        with mock.patch.object(WhitelistSnapshot, 'build', classmethod(check_during_build)):
+            whitelist.load()
+        self.assertEqual(checked, [False])
+        # 增量修改生成新快照, 旧快照不变
+        entry.allowed_ip = '8.8.8.0/24'
+        entry.save()
+        self.assertTrue(old.tables[self.queue.name].contains(4, int(ipaddress.ip_address('10.0.0.1'))))
+        self.assertTrue(whitelist.is_allowed(self.queue.name, '8.8.8.8'))
+        # 广播线程丢弃快照后, 查询重新加载而不是放行
+        whitelist.clear()
+        self.assertFalse(whitelist.is_allowed(self.queue.name, '10.0.0.1'))
+
+    @override_settings(TASK_WHITELIST_IP_HEADER='HTTP_X_FORWARDED_FOR', TASK_WHITELIST_TRUSTED_PROXIES=2)
+    def test_forwarded_for(self):
+        models.QueueIPWhitelist.objects.create(queue=self.queue, allowed_ip='10.0.0.1')
+        # 客户端 -> 代理1(追加10.0.0.1) -> 代理2(追加代理1的地址127.0.0.1) -> 应用
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='127.0.0.2',
+                                         HTTP_X_FORWARDED_FOR='10.0.0.1, 127.0.0.1').status_code, 404)
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='10.0.0.1',
+                                         HTTP_X_FORWARDED_FOR='10.0.0.2, 127.0.0.1').status_code, 403)
+        # 地址数少于可信代理数时不使用请求头
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='10.0.0.1',
+                                         HTTP_X_FORWARDED_FOR='8.8.8.8').status_code, 404)
+
+    @override_settings(TASK_WHITELIST_IP_HEADER='HTTP_X_FORWARDED_FOR')
+    def test_spoofed_forwarded_for(self):
+        models.QueueIPWhitelist.objects.create(queue=self.queue, allowed_ip='10.0.0.1')
+        # 客户端自己填写的白名单地址在最左边, 可信代理追加的真实地址在最右边
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='127.0.0.1',
+                                         HTTP_X_FORWARDED_FOR='10.0.0.1, 8.8.8.8').status_code, 403)
+        self.assertEqual(self.client.get(self.path, REMOTE_ADDR='127.0.0.1',
+                                         HTTP_X_FORWARDED_FOR='8.8.8.8, 10.0.0.1').status_code, 404)
+
+    def test_routes_without_queue(self):
+        category = models.Category.objects.create(name='whitelist')
+        task = models.Task.objects.create(name='whitelist', category=category, queue=self.queue)
+        models.QueueIPWhitelist.objects.create(queue=self.queue, allowed_ip='10.0.0.0/8')
+        self.client.get('/task/put/whitelist/whitelist/whitelist/', {'task_id': str(task.id)}, REMOTE_ADDR='10.0.0.1')
+        token = self.client.get(self.path, {'ack': 'lease'}, REMOTE_ADDR='10.0.0.1').json()['token']
+        for path in ('/task/ack/', '/task/nack/'):
+            response = self.client.post(path, {'tokens': [token]}, content_type='application/json',
+                                        REMOTE_ADDR='8.8.8.8')
+            self.assertEqual(response.status_code, 403)
+        event = {'task': str(task.id), 'state': 'SUCCESS'}
+        self.assertEqual(self.client.post('/task/report/', [event], content_type='application/json',
+                                          REMOTE_ADDR='8.8.8.8').status_code, 403)
+        self.assertEqual(self.client.post('/task/report/', [event], content_type='application/json',
+                                          REMOTE_ADDR='10.0.0.1').status_code, 200)
+        response = self.client.post('/task/ack/', {'tokens': [token]}, content_type='application/json',
+                                    REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.json(), {'acked': 1})
+
+
+class DagTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        exchange = models.Exchange.objects.create(name='dag')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='dag', routing_key='dag',
+                                                 connection='memory://')
+        self.category = models.Category.objects.create(name='dag')
+
+    def tearDown(self):
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    def create_task(self, name, parent=None):
+        return models.Task.objects.create(name=name, category=self.category, queue=self.queue, parent=parent)
+
+    def drain(self):
+        messages = self.client.get('/task/get/dag/dag/dag/', {'max': 100}).json()
+        return {message['task']['id']: message['headers'].get(dag.DAG_HEADER) for message in messages}
+
+    def report(self, run_id, task, state):
+        return self.client.post('/task/report/', [{'task': str(task.id), 'state': state, 'dag': run_id}],
+                                content_type='application/json').json()
+
+    def test_run_children_after_parent(self):
+        root = self.create_task('root')
+        first, second = self.create_task('first', root), self.create_task('second', root)
+        leaf = self.create_task('leaf', first)
+        response = self.client.post(f'/task/dag/{root.id}/').json()
+        run_id = str(response['id'])
+        self.assertEqual((response['tasks'], response['released']), (4, 1))
+        self.assertEqual(self.drain(), {str(root.id): run_id})
+
+        self.assertEqual(self.report(run_id, root, 'SUCCESS')['released'], 2)
+        self.assertEqual(self.drain(), {str(first.id): run_id, str(second.id): run_id})
+        # 重复上报不会再次发布
+        self.assertEqual(self.report(run_id, root, 'SUCCESS')['released'], 0)
+        self.assertEqual(self.report(run_id, first, 'SUCCESS')['released'], 1)
+        self.assertEqual(self.drain(), {str(leaf.id): run_id})
+        self.report(run_id, leaf, 'SUCCESS')
+        self.assertEqual(self.client.get(f'/task/dag/run/{run_id}/').json()['state'], 'RUNNING')
+        self.report(run_id, second, 'SUCCESS')
+        status = self.client.get(f'/task/dag/run/{run_id}/').json()
+        self.assertEqual((status['state'], status['tasks']), ('SUCCESS', {'SUCCESS': 4}))
+
+    def test_failure_skips_descendants(self):
+        root = self.create_task('root')
+        first, second = self.create_task('first', root), self.create_task('second', root)
+        self.create_task('leaf', first)
+        run_id = str(self.client.post(f'/task/dag/{root.id}/').json()['id'])
+        self.report(run_id, root, 'SUCCESS')
+        self.report(run_id, first, 'FAILURE')
+        self.report(run_id, second, 'SUCCESS')
+        status = self.client.get(f'/task/dag/run/{run_id}/').json()
+        self.assertEqual(status['state'], 'FAILURE')
+        self.assertEqual(status['tasks'], {'SUCCESS': 2, 'FAILURE': 1, 'SKIPPED': 1})
+
+    def test_cycle_detected_before_dispatch(self):
+        first = self.create_task('first')
+        second = self.create_task('second', first)
+        models.Task.objects.filter(id=first.id).update(parent=second)
+        response = self.client.post(f'/task/dag/{first.id}/')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.DagRun.objects.exists())
+        self.assertEqual(self.drain(), {})
+        with self.assertRaises(dag.CycleError):
+            dag.topological_sort(['a', 'b', 'c'], {'a': ['b'], 'b': ['c'], 'c': ['b']})
+
+    def test_fan_out_query_count(self):
+        def run(children):
+            root = self.create_task(f'root-{children}')
+            for i in range(children):
+                self.create_task(f'child-{children}-{i}', root)
+            run, _ = dag.start(root.id)
+            self.drain()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(dag.advance([(run.id, root.id, 'SUCCESS')]), children)
+            self.drain()
+            return len(queries)
+
+        self.assertEqual(run(3), run(30))
+
+
+def echo_callback(task, status):
+    return task['name'], status
+
+
+def slow_callback(task, status):
+    time.sleep(task.get('sleep', 0.5))
+
+
+class CallbackTestCase(TestCase):
+
+    def wait_idle(self, engine, timeout=5):
+        deadline = time.monotonic() + timeout
+        while (engine.metrics()['pending'] or engine.metrics()['abandoned']) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_resolve_cached(self):
+        callbacks.resolve.cache_clear()
+        for _ in range(3):
+            self.assertIs(callbacks.resolve('task_system.tests.echo_callback')[0], echo_callback)
+        self.assertEqual(callbacks.resolve.cache_info().misses, 1)
+        func, error = callbacks.resolve('task_system.tests.missing_callback')
+        self.assertIsNone(func)
+        self.assertIn('missing_callback', error)
+
+    def test_thread_pool(self):
+        engine = callbacks.Callback(workers=3, max_pending=2, timeout=0.2)
+        self.addCleanup(engine.shutdown)
+        future = engine.submit('task_system.tests.echo_callback', {'name': 'echo'}, 'SUCCESS')
+        self.assertEqual(future.result(timeout=5), ('echo', 'SUCCESS'))
+        engine.submit('task_system.tests.missing_callback', {}, 'SUCCESS')
+        self.wait_idle(engine)
+        # 两个名额都被慢回调占用时拒绝, 超时后释放名额
+        engine.submit('task_system.tests.slow_callback', {}, 'SUCCESS')
+        engine.submit('task_system.tests.slow_callback', {}, 'SUCCESS')
+        self.assertIsNone(engine.submit('task_system.tests.echo_callback', {'name': 'rejected'}, 'SUCCESS'))
+        self.wait_idle(engine)
+        self.assertIsNotNone(engine.submit('task_system.tests.echo_callback', {'name': 'echo'}, 'SUCCESS'))
+        self.wait_idle(engine)
+        metrics = engine.metrics()
+        self.assertEqual({key: metrics[key] for key in ('submitted', 'completed', 'failed', 'timeouts', 'rejected')},
+                         {'submitted': 5, 'completed': 2, 'failed': 1, 'timeouts': 2, 'rejected': 1})
+        self.assertGreaterEqual(metrics['latency']['max'], 0.2)
+
+    def test_timed_out_thread_keeps_slot(self):
+        engine = callbacks.Callback(workers=1, max_pending=2, timeout=0.1)
+        self.addCleanup(engine.shutdown)
+        slow = engine.submit('task_system.tests.slow_callback', {'sleep': 0.5}, 'SUCCESS')
+        time.sleep(0.2)
+        # 超时后线程仍在执行, 名额不释放
+        self.assertEqual((engine.metrics()['pending'], engine.metrics()['abandoned']), (0, 1))
+        self.assertIsNotNone(engine.submit('task_system.tests.echo_callback', {'name': 'queued'}, 'SUCCESS'))
+        self.assertIsNone(engine.submit('task_system.tests.echo_callback', {'name': 'rejected'}, 'SUCCESS'))
+        slow.result(timeout=5)
+        self.wait_idle(engine)
+        self.assertEqual(engine.metrics()['abandoned'], 0)
+        self.assertIsNotNone(engine.submit('task_system.tests.echo_callback', {'name': 'echo'}, 'SUCCESS'))
+
+    def test_run_deduplicated(self):
+        engine = callbacks.Callback(recent_runs=2)
+        self.addCleanup(engine.shutdown)
+        task = models.Task(name='dedupe', callback='task_system.tests.echo_callback')
+        self.assertIsNotNone(engine.run(task, 'SUCCESS', run='a'))
+        self.assertIsNone(engine.run(task, 'SUCCESS', run='a'))
+        engine.run(task, 'SUCCESS', run='b')
+        engine.run(task, 'SUCCESS', run='c')
+        # 超出recent_runs的运行被淘汰
+        self.assertIsNotNone(engine.run(task, 'SUCCESS', run='a'))
+        self.wait_idle(engine)
+        self.assertEqual((engine.metrics()['submitted'], engine.metrics()['duplicates']), (4, 1))
+
+    @skipIf(not hasattr(signal, 'SIGALRM'), 'SIGALRM is not available')
+    def test_process_pool(self):
+        engine = callbacks.Callback(mode='process', workers=1, timeout=0.2)
+        self.addCleanup(engine.shutdown)
+        self.assertEqual(engine.submit('task_system.tests.echo_callback', {'name': 'echo'}, 'SUCCESS').result(30),
+                         ('echo', 'SUCCESS'))
+        # 进程池中超时的回调被中断, 不会一直占用工作进程
+        engine.submit('task_system.tests.slow_callback', {'sleep': 5}, 'SUCCESS')
+        future = engine.submit('task_system.tests.echo_callback', {'name': 'next'}, 'SUCCESS')
+        self.assertEqual(future.result(timeout=3), ('next', 'SUCCESS'))
+
+    def test_report_runs_callback(self):
+        category = models.Category.objects.create(name='callback')
+        task = models.Task.objects.create(name='callback', category=category,
+                                          callback='task_system.tests.echo_callback')
+        completed = callbacks.engine.metrics()['completed']
+        self.client.post('/task/report/', [{'task': str(task.id), 'state': 'STARTED'}],
+                         content_type='application/json')
+        self.client.post('/task/report/', [{'task': str(task.id), 'state': 'SUCCESS'}],
+                         content_type='application/json')
+        self.wait_idle(callbacks.engine)
+        self.assertEqual(self.client.get('/task/callbacks/metrics/').json()['completed'], completed + 1)
+        # 重复上报同一次运行的结束状态不会再次回调
+        self.client.post('/task/report/', [{'task': str(task.id), 'run': 'callback-run', 'state': 'SUCCESS'}],
+                         content_type='application/json')
+        self.client.post('/task/report/', [{'task': str(task.id), 'run': 'callback-run', 'state': 'SUCCESS'}],
+                         content_type='application/json')
+        self.wait_idle(callbacks.engine)
+        self.assertEqual(callbacks.engine.metrics()['completed'], completed + 2)
+
+
+def add_task(a, b):
+    return a + b
+
+
+async def async_add_task(a, b):
+    await asyncio.sleep(0.01)
+    return a + b
+
+
+def failing_task():
+    raise RuntimeError('boom')
+
+
+class WorkerTestCase(TestCase):
+
+    def setUp(self):
+        routing.table.clear()
+        exchange = models.Exchange.objects.create(name='worker')
+        self.queue = models.Queue.objects.create(exchange=exchange, name='worker', routing_key='worker',
+                                                 connection='memory://')
+        self.category = models.Category.objects.create(name='worker')
+
+    def tearDown(self):
+        with Connection(self.queue.connection) as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    def put(self, tasks):
+        self.client.post('/task/put/worker/worker/worker/', [str(task.id) for task in tasks],
+                         content_type='application/json')
+
+    def create_task(self, name, function, config=None):
+        return models.Task.objects.create(name=name, category=self.category, queue=self.queue,
+                                          function=function, config=config)
+
+    def test_run_and_report(self):
+        tasks = [self.create_task(f'add-{i}', 'task_system.tests.add_task', {'a': i, 'b': 1}) for i in range(5)]
+        failing = self.create_task('failing', 'task_system.tests.failing_task')
+        self.put(tasks + [failing])
+        for mode in ('thread', 'asyncio'):
+            with self.subTest(mode=mode):
+                models.TaskLog.objects.all().delete()
+                if mode == 'asyncio':
+                    models.Task.objects.filter(id__in=[task.id for task in tasks]).update(
+                        function='task_system.tests.async_add_task')
+                    self.put(tasks)
+                    expected = len(tasks)
+                else:
+                    expected = len(tasks) + 1
+                worker = Worker(self.queue, mode=mode, concurrency=2, report_interval=60)
+                self.assertEqual(worker.run(max_tasks=expected), expected)
+                logs = {log.task_id: log for log in models.TaskLog.objects.all()}
+                self.assertEqual(len(logs), expected)
+                for i, task in enumerate(tasks):
+                    self.assertEqual((logs[task.id].state, logs[task.id].result), ('SUCCESS', i + 1))
+                if mode == 'thread':
+                    self.assertEqual(logs[failing.id].state, 'FAILURE')
+                    self.assertIn('boom', logs[failing.id].result['error'])
+                with Connection(self.queue.connection) as conn:
+                    self.assertEqual(conn.SimpleQueue(self.queue.name).qsize(), 0)
+        tasks[0].refresh_from_db()
+        self.assertEqual(tasks[0].total_run_count, 2)
+
+    def test_stop_drains_in_flight(self):
+        tasks = [self.create_task(f'slow-{i}', 'time.sleep', 0.05) for i in range(4)]
+        self.put(tasks)
+        worker = Worker(self.queue, concurrency=4, prefetch=4)
+        threading.Timer(0.02, worker.stop).start()
+        # 停止时已经接收的任务执行完成后才退出
+        processed = worker.run()
+        self.assertEqual(processed, 4)
+        self.assertEqual(models.TaskLog.objects.filter(state='SUCCESS').count(), 4)
+
+    def test_started_reported_while_running(self):
+        task = self.create_task('slow', 'time.sleep', 0.3)
+        self.put([task])
+        worker = Worker(self.queue, concurrency=1, prefetch=1, report_interval=0, poll_interval=0.02)
+        with mock.patch.object(reports, 'apply', wraps=reports.apply) as apply:
+            self.assertEqual(worker.run(max_tasks=1), 1)
+        # 预取已满时照常上报, STARTED在任务结束前写入
+        batches = [[event['state'] for event in call.args[0]] for call in apply.call_args_list]
+        self.assertEqual(batches, [['STARTED'], ['SUCCESS']])
+        log = models.TaskLog.objects.get(task=task)
+        self.assertEqual(log.state, 'SUCCESS')
+        self.assertLess(log.start_time, log.state_time)
+
+
+class AdminTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser('admin', password='admin'))
+        self.category = models.Category.objects.create(name='admin')
+
+    def create_tasks(self, number, prefix):
+        queues = [models.Queue.objects.create(exchange=models.Exchange.objects.create(name=f'{prefix}-{i}'),
+                                              name=f'{prefix}-{i}', routing_key='admin', connection='memory://')
+                  for i in range(3)]
+        parents = [models.Task.objects.create(name=f'{prefix}-parent-{i}', category=self.category) for i in range(3)]
+        return [models.Task.objects.create(name=f'{prefix}-{i}', category=self.category, queue=queues[i % 3],
+                                           parent=parents[i % 3]) for i in range(number)]
+
+    def changelist(self, model, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/admin/task_system/{model}/', params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_task_changelist_query_budget(self):
+        self.create_tasks(3, 'small')
+        # session, user, 父任务选项, 分类选项, 标签选项, count, 当前页
+        with self.assertNumQueries(7):
+            self.client.get('/admin/task_system/task/')
+        self.create_tasks(60, 'large')
+        cache.clear()
+        self.assertEqual(self.changelist('task'), 7)
+        # 父任务选项已缓存
+        self.assertEqual(self.changelist('task'), 6)
+        self.assertEqual(self.changelist('task', {'parent': TaskParentFilter.other[0]}), 6)
+
+    def test_queue_changelist_query_budget(self):
+        self.create_tasks(1, 'small')
+        small = self.changelist('queue')
+        self.create_tasks(1, 'large')
+        self.assertEqual(self.changelist('queue'), small)
+
+    def test_parent_filter(self):
+        tasks = self.create_tasks(4, 'filter')
+        orphan = models.Task.objects.create(name='orphan', category=self.category)
+        response = self.client.get('/admin/task_system/task/', {'parent': str(tasks[0].parent_id)})
+        self.assertEqual({task.id for task in response.context['cl'].result_list}, {tasks[0].id, tasks[3].id})
+        # 其它选项的取值固定, 不随进程变化
+        response = self.client.get('/admin/task_system/task/', {'parent': 'none'})
+        self.assertEqual({task.id for task in response.context['cl'].result_list},
+                         {orphan.id} | {task.parent_id for task in tasks})
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Task.objects.create(name='child', category=self.category, parent=orphan)
+        response = self.client.get('/admin/task_system/task/')
+        choices = [choice['display'] for choice in response.context['cl'].filter_specs[-1].choices(
+            response.context['cl'])]
+        self.assertIn('orphan', choices)
+
+    def test_estimated_count(self):
+        self.create_tasks(3, 'estimate')
+        queryset = models.Task.objects.order_by('name')
+        with mock.patch('task_system.admin.estimate_count', return_value=50000):
+            self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 50000)
+            self.assertEqual(EstimatedCountPaginator(queryset.filter(parent__isnull=True), 100).count, 3)
+        with mock.patch('task_system.admin.estimate_count', return_value=100):
+            self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 6)
+        self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 6)
@@ -0,0 +1,94 @@
+from datetime import datetime
+from django.conf import settings
+from django.db.models import Count, Max, Min
+from .schedule.times import to_schedule_time, from_schedule_time
+from . import models
+
+
+def timeline_size():
+    return getattr(settings, 'TASK_TIMELINE_SIZE', 10)
+
+
+def _is_max(value: datetime):
+    return value is None or value.replace(tzinfo=None) == datetime.max
+
+
+def occurrences(task: models.Task, start: datetime, count: int, include_start=True):
+    """
+        从start开始按任务的计划依次推算count个运行时间点, 与get_next_schedule_time的严格模式一致;
+        计划已结束时提前停止
+    """
+    if count <= 0 or not task.schedule or _is_max(start):
+        return []
+    compiled = task.schedule.compiled
+    times = [start] if include_start else []
+    last_time = to_schedule_time(start)
+    while len(times) < count:
+        last_time = compiled.next_time(last_time, is_rigorous=True)
+        if last_time is None:
+            break
+        times.append(from_schedule_time(last_time))
+    return times
+
+
+def _scheduled(task: models.Task):
+    return task.enabled and task.schedule_id is not None and not _is_max(task.next_start_time)
+
+
+def rebuild(tasks, size=None):
+    """丢弃tasks已有的运行计划并从next_start_time开始重新生成, 计划或任务修改后调用"""
+    size = timeline_size() if size is None else size
+    tasks = list(tasks)
+    if not tasks:
+        return
+    models.ScheduledRun.objects.filter(task_id__in=[task.id for task in tasks]).delete()
+    if size <= 0:
+        return
+    models.ScheduledRun.objects.bulk_create([
+        models.ScheduledRun(task_id=task.id, run_time=run_time)
+        for task in tasks if _scheduled(task)
+        for run_time in occurrences(task, task.next_start_time, size)
+    ], batch_size=1000)
+
+
+def extend(tasks, now: datetime, size=None):
+    """
+        增量维护: 删除tasks已经消费(<= now)的运行点, 剩余不到一半的任务从最后一个运行点往后补齐到size个,
+        每个任务平均运行size/2次才补齐一次; 第一个运行点与next_start_time不一致(如跳过了遗漏的周期)的任务重新生成,
+        已禁用或计划结束的任务清空
+    """
+    size = timeline_size() if size is None else size
+    tasks = list(tasks)
+    if not tasks or size <= 0:
+        return
+    runs = models.ScheduledRun.objects
+    runs.filter(task_id__in=[task.id for task in tasks if not _scheduled(task)]).delete()
+    active = [task for task in tasks if _scheduled(task)]
+    if not active:
+        return
+    ids = [task.id for task in active]
+    runs.filter(task_id__in=ids, run_time__lte=now).delete()
+    stats = {row['task_id']: row for row in runs.filter(task_id__in=ids).values('task_id').annotate(
+        count=Count('id'), first=Min('run_time'), last=Max('run_time')).order_by()}
+    created, stale = [], []
+    for task in active:
+        row = stats.get(task.id)
+        if row is None or row['first'] != task.next_start_time:
+            if row is not None:
+                stale.append(task.id)
+            times = occurrences(task, task.next_start_time, size)
+        elif row['count'] <= size // 2:
+            times = occurrences(task, row['last'], size - row['count'], include_start=False)
+        else:
+            continue
+        created.extend(models.ScheduledRun(task_id=task.id, run_time=run_time) for run_time in times)
+    if stale:
+        runs.filter(task_id__in=stale).delete()
+    runs.bulk_create(created, batch_size=1000, ignore_conflicts=True)
+
+
+def window(start: datetime, end: datetime, limit=None):
+    """[start, end)内的运行计划, 按(run_time, task)索引范围查询, 一条SQL"""
+    queryset = models.ScheduledRun.objects.filter(run_time__gte=start, run_time__lt=end).order_by(
+        'run_time', 'task_id').values('task_id', 'task__name', 'run_time')
+    return queryset[:limit] if limit else queryset
@@ -1,8 +1,20 @@
 from django.urls import path
 from . import views
+from . import async_views
 
 
 urlpatterns = [
     path('get/<str:exchange>/<str:queue>/<str:routing_key>/', views.TaskAPI.get, name='task-get'),
     path('put/<str:exchange>/<str:queue>/<str:routing_key>/', views.TaskAPI.put, name='task-put'),
+    path('async/get/<str:exchange>/<str:queue>/<str:routing_key>/', async_views.get, name='task-get-async'),
+    path('async/put/<str:exchange>/<str:queue>/<str:routing_key>/', async_views.put, name='task-put-async'),
+    path('ack/', views.TaskAPI.ack, name='task-ack'),
+    path('nack/', views.TaskAPI.nack, name='task-nack'),
+    path('stream/<str:exchange>/<str:queue>/<str:routing_key>/', views.StreamAPI.get, name='task-stream'),
+    path('stream/<str:stream_id>/ack/', views.StreamAPI.ack, name='task-stream-ack'),
+    path('report/', views.ReportAPI.post, name='task-report'),
+    path('timeline/', views.TimelineAPI.get, name='task-timeline'),
+    path('dag/<uuid:task_id>/', views.DagAPI.start, name='task-dag-start'),
+    path('dag/run/<uuid:dag_run_id>/', views.DagAPI.get, name='task-dag-run'),
+    path('callbacks/metrics/', views.CallbackAPI.metrics, name='task-callback-metrics'),
 ]
@@ -1,83 +1,121 @@
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from rest_framework.exceptions import NotFound
+from django.conf import settings
+from django.db import transaction
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
-from kombu import Connection, Exchange, Queue, Consumer, Producer, Message
-from .choices import ExchangeType
+from django.db.models import Count
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta
+import uuid
+from functools import partial
+from kombu import Exchange, Message
+from .connections import pools
 from . import models
-from django.core.cache import cache
-from . import serializers
+from . import broker
+from . import callbacks
+from . import dag
+from . import invalidation
+from . import routing
+from . import timeline
+from . import reports
+from . import streaming
+from . import leases
+from .middleware import check_queues
+from .schedule.compiled import compiled_schedules
+from .whitelist import whitelist
 
 
 @receiver(post_save, sender=models.QueueIPWhitelist)
 def add_queue_ip_whitelist(sender, instance: models.QueueIPWhitelist, created, **kwargs):
-    cache.set(f'{instance.queue_id}:whitelist:{instance.allowed_ip}', 1)
+    whitelist.add(instance)
+    invalidation.changed(whitelist.stamp)
 
 
 @receiver(post_delete, sender=models.QueueIPWhitelist)
 def delete_queue_ip_whitelist(sender, instance: models.QueueIPWhitelist, **kwargs):
-    cache.delete(f'{instance.queue_id}:whitelist:{instance.allowed_ip}')
+    whitelist.remove(instance)
+    invalidation.changed(whitelist.stamp)
 
 
 @receiver(post_delete, sender=models.Queue)
 def delete_queue(sender, instance: models.Queue, **kwargs):
-    cache.delete(f'queue:{instance.name}')
+    routing.table.remove_queue(instance)
+    invalidation.changed(routing.table.stamp)
+    pools.invalidate(instance)
 
 
 @receiver(post_save, sender=models.Queue)
 def add_queue(sender, instance: models.Queue, created, **kwargs):
-    cache.set(f'queue:{instance.name}', instance)
+    routing.table.add_queue(instance)
+    invalidation.changed(routing.table.stamp)
+    if not created:
+        pools.invalidate(instance)
 
 
 @receiver(post_delete, sender=models.Exchange)
 def delete_exchange(sender, instance: models.Exchange, **kwargs):
-    cache.delete(f'exchange:{instance.name}')
+    routing.table.remove_exchange(instance)
+    invalidation.changed(routing.table.stamp)
 
 
 @receiver(post_save, sender=models.Exchange)
 def add_exchange(sender, instance: models.Exchange, created, **kwargs):
-    cache.set(f'exchange:{instance.name}', instance)
+    routing.table.add_exchange(instance)
+    invalidation.changed(routing.table.stamp)
 
 
-try:
-    for obj in models.Exchange.objects.all():
-        add_exchange('', obj, True)
-    for obj in models.Queue.objects.all():
-        add_queue('', obj, True)
-    for obj in models.QueueIPWhitelist.objects.all():
-        add_queue_ip_whitelist('', obj, True)
-except Exception as e:
-    pass
+@receiver(post_save, sender=models.Task)
+def rebuild_task_timeline(sender, instance: models.Task, created, update_fields=None, **kwargs):
+    """计划相关的字段变化时才重新生成运行计划, 调度进程的批量更新路径由scheduler/bulk_generate_next_task增量维护"""
+    if update_fields is not None and not set(update_fields) & set(models.Task.TIMELINE_FIELDS):
+        return
+    state = instance.timeline_state()
+    if not created and getattr(instance, 'saved_timeline_state', None) == state:
+        return
+    instance.saved_timeline_state = state
+    timeline.rebuild([instance])
 
 
-def direct_match(queue: models.Queue, routing_key, queue_str):
-    return queue.routing_key == routing_key and queue.name == queue_str
+@receiver(post_delete, sender=models.Task)
+@receiver(post_save, sender=models.Task)
+def task_parents_changed(sender, instance: models.Task, **kwargs):
+    transaction.on_commit(partial(invalidation.incr_version, invalidation.TASK_PARENTS))
 
 
-def topic_match(queue: models.Queue, routing_key, queue_str):
-    return queue.routing_key == routing_key and queue.name == queue_str
+@receiver(post_delete, sender=models.Schedule)
+@receiver(post_save, sender=models.Schedule)
+def invalidate_compiled_schedule(sender, instance: models.Schedule, **kwargs):
+    compiled_schedules.invalidate(instance.pk)
 
 
-def fanout_match(queue: models.Queue, routing_key, queue_str):
-    return queue.name == queue_str
+@receiver(post_save, sender=models.Schedule)
+def rebuild_schedule_timeline(sender, instance: models.Schedule, created, **kwargs):
+    if not created:
+        timeline.rebuild(models.Task.objects.filter(schedule=instance).select_related('schedule'))
 
 
 def get_queue(exchange: models.Exchange, routing_key, queue_str):
-    if exchange.type == ExchangeType.Direct:
-        match = direct_match
-    elif exchange.type == ExchangeType.Topic:
-        match = topic_match
-    else:
-        match = fanout_match
-    for q in exchange.queue_set.all():
-        if match(q, routing_key, queue_str):
-            return q
+    return routing.table.get_queue(exchange, routing_key, queue_str)
+
+
+def _get_number_param(params, name, type_, min_value, max_value, default=None):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        value = type_(value)
+    except ValueError:
+        raise ValidationError({name: f'{name}必须是数字'})
+    return min(max(value, min_value), max_value)
 
 
 def get_exchange_and_queue(exchange, queue, routing_key) -> [Exchange, models.Queue]:
-    exchange: models.Exchange = cache.get(f'exchange:{exchange}')
+    exchange: models.Exchange = routing.table.get_exchange(exchange)
     if not exchange:
         raise NotFound
     queue: models.Queue = get_queue(exchange, routing_key, queue)
@@ -86,42 +124,230 @@ def get_exchange_and_queue(exchange, queue, routing_key) -> [Exchange, models.Qu
     return Exchange(name=exchange.name, type=exchange.type), queue
 
 
-class TaskAPI:
+def _get_datetime_param(params, name, default=None):
+    value = params.get(name)
+    if value is None:
+        return default
+    value = parse_datetime(value)
+    if value is None:
+        raise ValidationError({name: f'{name}必须是ISO格式的时间'})
+    return timezone.make_aware(value) if timezone.is_naive(value) else value
+
+
+class TimelineAPI:
+
+    @staticmethod
+    @api_view(['GET'])
+    def get(request: Request):
+        """
+            ?start=2024-01-01T00:00:00&hours=6&limit=1000 返回[start, start + hours)内即将运行的任务,
+            start默认为当前时间, 也可以用end指定结束时间
+        """
+        params = request.query_params
+        start = _get_datetime_param(params, 'start', default=timezone.now())
+        hours = _get_number_param(params, 'hours', float, 0, getattr(settings, 'TASK_TIMELINE_MAX_HOURS', 24 * 7),
+                                  default=6)
+        end = _get_datetime_param(params, 'end', default=start + timedelta(hours=hours))
+        limit = _get_number_param(params, 'limit', int, 1, getattr(settings, 'TASK_MAX_BATCH', 1000),
+                                  default=getattr(settings, 'TASK_MAX_BATCH', 1000))
+        return Response([
+            {'task': run['task_id'], 'name': run['task__name'], 'run_time': run['run_time']}
+            for run in timeline.window(start, end, limit)
+        ])
+
+
+class ReportAPI:
+
+    @staticmethod
+    @api_view(['POST'])
+    def post(request: Request):
+        """
+            worker批量上报运行状态, body为事件列表:
+            [{"task": "<uuid>", "run": "<运行id>", "state": "STARTED", "time": "...", "queue": "...", "result": ...}]
+            同一次运行的多个事件合并后批量写入TaskLog, 并更新任务的last_run_at/total_run_count;
+            DAG中的任务带上消息头x-dag-run的值作为"dag", 结束后发布依赖已完成的子任务
+        """
+        max_events = getattr(settings, 'TASK_MAX_REPORT', 10000)
+        if isinstance(request.data, list) and len(request.data) > max_events:
+            raise ValidationError({'events': f'每次最多上报{max_events}个事件'})
+        if whitelist.restricted():
+            check_queues(request, ReportAPI._queues(request.data))
+        return Response(reports.apply(request.data))
+
+    @staticmethod
+    def _queues(events):
+        """事件中的队列和任务所属的队列"""
+        queues, task_ids = set(), []
+        for event in events if isinstance(events, list) else ():
+            if not isinstance(event, dict):
+                continue
+            queues.add(event.get('queue'))
+            try:
+                task_ids.append(uuid.UUID(str(event.get('task'))))
+            except ValueError:
+                pass
+        queues.update(models.Task.objects.filter(id__in=task_ids).values_list('queue_id', flat=True))
+        return queues - {None, ''}
+
+
+class DagAPI:
+
+    @staticmethod
+    @api_view(['POST'])
+    def start(request: Request, task_id):
+        """以task_id为根, 按parent启动一次DAG运行: 先发布根任务, 父任务上报成功后发布子任务"""
+        try:
+            run, released = dag.start(task_id)
+        except models.Task.DoesNotExist:
+            raise NotFound
+        except ValueError as e:
+            raise ValidationError({'task': str(e)})
+        return Response({'id': run.id, 'tasks': run.tasks.count(), 'released': released})
+
+    @staticmethod
+    @api_view(['GET'])
+    def get(request: Request, dag_run_id):
+        """DAG运行的状态和各状态的任务数"""
+        run = models.DagRun.objects.filter(id=dag_run_id).first()
+        if run is None:
+            raise NotFound
+        states = dict(run.tasks.values_list('state').annotate(count=Count('id')).order_by())
+        return Response({'id': run.id, 'root': run.root_id, 'state': run.state, 'tasks': states,
+                         'create_time': run.create_time, 'finish_time': run.finish_time})
+
+
+class CallbackAPI:
+
+    @staticmethod
+    @api_view(['GET'])
+    def metrics(request: Request):
+        """本进程回调引擎的排队深度、成功/失败/超时/拒绝数和耗时分位数(秒)"""
+        return Response(callbacks.engine.metrics())
+
+
+class StreamAPI:
 
     @staticmethod
     @api_view(['GET'])
     def get(request: Request, exchange, queue: str, routing_key: str):
+        """
+            Server-Sent Events推送队列中的消息, ?prefetch=10限制未确认的消息数, ?heartbeat=15空闲时的心跳秒数;
+            第一个事件open返回stream id, 之后每条消息一个task事件, 事件id为delivery_tag
+        """
         exchange, queue = get_exchange_and_queue(exchange, queue, routing_key)
-        with Connection(queue.connection) as conn:
-            channel = conn.channel()
-            message: Message = channel.basic_get(queue.name, no_ack=True)
-            if not message:
-                raise NotFound
-        # ip = request.META.get('HTTP_X_FORWARDED_FOR') if request.META.get('HTTP_X_FORWARDED_FOR') else \
-        #     request.META.get('REMOTE_ADDR')
-        # cache_ip = cache.get(f'{queue}:whitelist:{ip}')
-        # if not cache_ip:
-        #     return Response({'error': f'IP {ip} Not Allowed'}, status=status.HTTP_403_FORBIDDEN)
-        return Response({
-            'properties': message.properties,
-            'headers': message.headers,
-            'task': message.payload
-        })
+        params = request.query_params
+        prefetch = _get_number_param(params, 'prefetch', int, 1, getattr(settings, 'TASK_MAX_BATCH', 1000),
+                                     default=10)
+        heartbeat = _get_number_param(params, 'heartbeat', float, 1, 300, default=15)
+        stream = streaming.Stream(queue, exchange, prefetch=prefetch, heartbeat=heartbeat)
+        response = StreamingHttpResponse(stream.events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @staticmethod
+    @api_view(['POST'])
+    def ack(request: Request, stream_id: str):
+        """
+            确认stream推送的消息, body: {"ack": [id, ...], "reject": [id, ...], "requeue": true}
+            reject的消息在requeue为true(默认)时退回队列, 否则丢弃; 请求必须发到建立stream的进程
+        """
+        stream = streaming.streams.get(stream_id)
+        if stream is None:
+            raise NotFound
+        check_queues(request, [stream.queue.name])
+        data = request.data if isinstance(request.data, dict) else {}
+        accepted = stream.ack(data.get('ack') or [])
+        if data.get('reject'):
+            accepted = stream.ack(data['reject'], requeue=bool(data.get('requeue', True))) or accepted
+        if not accepted:
+            raise NotFound
+        return Response(status=202)
+
+
+class TaskAPI:
 
     @staticmethod
     @api_view(['GET'])
+    def get(request: Request, exchange, queue: str, routing_key: str):
+        """
+            ?max=100&wait=5 批量获取, 最多返回max条消息的列表, 队列为空时最多等待wait秒, 消息取出即确认;
+            ack=lease&visibility=60 租用模式, 每条消息附带token, visibility秒内没有通过ack接口确认的消息重新入队;
+            ack=explicit与lease相同, 由客户端用token确认
+        """
+        exchange, queue = get_exchange_and_queue(exchange, queue, routing_key)
+        params = request.query_params
+        if params.get('ack') in ('lease', 'explicit'):
+            return TaskAPI.lease(queue, exchange, routing_key, params)
+        if 'max' not in params:
+            with pools.acquire(queue) as conn:
+                message: Message = conn.default_channel.basic_get(queue.name, no_ack=True)
+                if not message:
+                    raise NotFound
+            return Response(broker.message_to_dict(message))
+        limit = _get_number_param(params, 'max', int, 1, getattr(settings, 'TASK_MAX_BATCH', 1000))
+        wait = _get_number_param(params, 'wait', float, 0, getattr(settings, 'TASK_MAX_WAIT', 30), default=0)
+        if params.get('ack', 'auto') != 'auto':
+            raise ValidationError({'ack': 'ack只能为auto、explicit或lease'})
+        with pools.acquire(queue) as conn:
+            with broker.consume(conn, queue, exchange, limit, wait) as messages:
+                data = [broker.message_to_dict(message) for message in messages]
+        return Response(data)
+
+    @staticmethod
+    def lease(queue: models.Queue, exchange: Exchange, routing_key, params):
+        limit = _get_number_param(params, 'max', int, 1, getattr(settings, 'TASK_MAX_BATCH', 1000), default=1)
+        wait = _get_number_param(params, 'wait', float, 0, getattr(settings, 'TASK_MAX_WAIT', 30), default=0)
+        max_visibility = getattr(settings, 'TASK_LEASE_MAX_TIMEOUT', 3600)
+        visibility = _get_number_param(params, 'visibility', float, 1, max_visibility,
+                                       default=getattr(settings, 'TASK_LEASE_TIMEOUT', 60))
+        with pools.acquire(queue) as conn:
+            data = leases.lease(conn, queue, exchange, routing_key, limit, wait, visibility)
+        if 'max' in params:
+            return Response(data)
+        if not data:
+            raise NotFound
+        return Response(data[0])
+
+    @staticmethod
+    def _tokens(request: Request):
+        tokens = request.data.get('tokens') if isinstance(request.data, dict) else request.data
+        if not isinstance(tokens, list):
+            raise ValidationError({'tokens': 'tokens必须是列表'})
+        try:
+            tokens = [uuid.UUID(str(token)) for token in tokens]
+        except ValueError:
+            raise ValidationError({'tokens': 'token格式错误'})
+        if whitelist.restricted():
+            check_queues(request, models.MessageLease.objects.filter(token__in=tokens).values_list(
+                'queue', flat=True).distinct())
+        return tokens
+
+    @staticmethod
+    @api_view(['POST'])
+    def ack(request: Request):
+        """确认租用的消息, body: {"tokens": [...]}, 返回确认的条数, 已超时重新入队的消息不计入"""
+        return Response({'acked': leases.ack(TaskAPI._tokens(request))})
+
+    @staticmethod
+    @api_view(['POST'])
+    def nack(request: Request):
+        """退回租用的消息, body: {"tokens": [...], "requeue": true}, requeue为false时直接丢弃"""
+        requeue = request.data.get('requeue', True) if isinstance(request.data, dict) else True
+        return Response({'nacked': leases.nack(TaskAPI._tokens(request), requeue=bool(requeue))})
+
+    @staticmethod
+    @api_view(['GET', 'POST'])
     def put(request: Request, exchange, queue: str, routing_key: str):
         task_ids = request.query_params.get('task_id')
         if task_ids:
             task_ids = task_ids.split(',')
         else:
             task_ids = request.data
-        tasks = models.Task.objects.filter(id__in=task_ids)
         exchange, queue_model = get_exchange_and_queue(exchange, queue, routing_key)
-        with Connection(queue_model.connection) as conn:
-            queue: Queue = Queue(channel=conn, name=queue_model.name, exchange=exchange, routing_key=routing_key)
-            producer = Producer(conn, exchange=exchange)
-            data = serializers.TaskSerializer(tasks, many=True).data
-            for o in data:
-                producer.publish(o, routing_key=routing_key, serializer='json', declare=[queue])
-        return Response(data)
+        confirm = request.query_params.get('confirm') in ('1', 'true')
+        chunk_size = getattr(settings, 'TASK_PUBLISH_CHUNK', 500)
+        with pools.acquire(queue_model) as conn:
+            results = list(broker.publish_tasks(conn, queue_model, exchange, routing_key, task_ids,
+                                                chunk_size=chunk_size, confirm=confirm))
+        return Response(results)
@@ -0,0 +1,231 @@
+"""
+    内置worker: 直接消费一个Queue, 执行任务的Task.function
+    - 独立的broker连接上注册consumer, 按prefetch限制未确认的消息数, 任务执行结束后才确认(至少执行一次);
+    - function按导入路径解析, 与回调共用LRU缓存, 每个进程只import一次; Task.config为dict时作为关键字参数传入;
+    - 任务在thread/process/asyncio执行器中运行, concurrency限制同时运行的任务数;
+    - 提交执行时记录STARTED, 结束时记录SUCCESS/FAILURE, 事件缓存在内存中, 按report_interval/report_batch批量交给reports.apply写入TaskLog,
+      消息头x-dag-run一并上报, DAG和回调照常推进;
+    - 确认消息和上报都在消费线程中执行, channel和数据库连接只在一个线程中使用;
+    - stop后先取消consumer不再接收新消息, 等待已接收的任务全部执行完成、确认并上报后退出
+"""
+import asyncio
+import json
+import logging
+import queue as queue_module
+import socket
+import threading
+import traceback
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+import django
+from django.utils import timezone
+from kombu import Connection, Consumer, Exchange, Message
+from .callbacks import resolve
+from .choices import TaskState
+from .dag import DAG_HEADER
+from .scheduler import SCHEDULED_HEADER
+from . import broker
+from . import models
+from . import reports
+
+logger = logging.getLogger(__name__)
+
+
+def _resolve(function):
+    func, error = resolve(function)
+    if func is None:
+        raise ImportError(error)
+    return func
+
+
+def _apply(func, config):
+    if isinstance(config, dict):
+        return func(**config)
+    return func() if config is None else func(config)
+
+
+def _outcome(start, result=None, error=None):
+    """执行结果转换为可以跨进程传递和写入JSON字段的格式"""
+    if error is not None:
+        return TaskState.FAILURE, start, timezone.now(), {
+            'error': repr(error), 'traceback': ''.join(traceback.format_exception(error))}
+    try:
+        json.dumps(result)
+    except (TypeError, ValueError):
+        result = repr(result)
+    return TaskState.SUCCESS, start, timezone.now(), result
+
+
+def execute(function, config):
+    """在线程池/进程池中执行一个任务, 异常也作为结果返回; 协程函数用asyncio.run执行"""
+    start = timezone.now()
+    try:
+        result = _apply(_resolve(function), config)
+        if asyncio.iscoroutine(result):
+            result = asyncio.run(result)
+    except Exception as e:
+        return _outcome(start, error=e)
+    return _outcome(start, result)
+
+
+class AsyncioExecutor:
+    """在独立线程的事件循环中执行任务, 协程函数直接await, 普通函数放到循环的默认线程池中执行"""
+
+    def __init__(self, max_workers):
+        self._semaphore = None
+        self._max_workers = max_workers
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='task-worker-loop', daemon=True)
+        self._thread.start()
+        self._pending = set()
+
+    async def _execute(self, function, config):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_workers)
+        async with self._semaphore:
+            start = timezone.now()
+            try:
+                func = _resolve(function)
+                if asyncio.iscoroutinefunction(func):
+                    result = await _apply(func, config)
+                else:
+                    result = await self._loop.run_in_executor(None, partial(_apply, func, config))
+            except Exception as e:
+                return _outcome(start, error=e)
+            return _outcome(start, result)
+
+    def submit(self, function, config) -> Future:
+        future = asyncio.run_coroutine_threadsafe(self._execute(function, config), self._loop)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def shutdown(self, wait=True):
+        if wait:
+            for future in list(self._pending):
+                future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def create_executor(mode, concurrency):
+    if mode == 'thread':
+        return ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='task-worker')
+    if mode == 'process':
+        return ProcessPoolExecutor(max_workers=concurrency, initializer=django.setup)
+    if mode == 'asyncio':
+        return AsyncioExecutor(concurrency)
+    raise ValueError(f'invalid worker mode: {mode}')
+
+
+class Worker:
+
+    def __init__(self, queue: models.Queue, mode='thread', concurrency=4, prefetch=None, report_interval=1,
+                 report_batch=500, poll_interval=0.1):
+        self.queue = queue
+        self.mode = mode
+        self.concurrency = concurrency
+        self.prefetch = prefetch or concurrency * 2
+        self.report_interval = report_interval
+        self.report_batch = report_batch
+        self.poll_interval = poll_interval
+        self.processed = 0
+        self.in_flight = 0
+        self._events = []
+        self._next_report = 0
+        self._done = queue_module.SimpleQueue()
+        self._stopping = threading.Event()
+        self._executor = None
+
+    def _submit(self, function, config) -> Future:
+        if isinstance(self._executor, AsyncioExecutor):
+            return self._executor.submit(function, config)
+        return self._executor.submit(execute, function, config)
+
+    def _on_message(self, body, message: Message):
+        task = body if isinstance(body, dict) else {}
+        headers = message.headers or {}
+        run = {'run': uuid.uuid4().hex, 'task': task.get('id'), 'queue': self.queue.name,
+               'dag': headers.get(DAG_HEADER), 'scheduled': bool(headers.get(SCHEDULED_HEADER)) or None}
+        self.in_flight += 1
+        if run['task']:
+            self._events.append(dict(run, state=TaskState.STARTED, time=timezone.now()))
+        if not task.get('function'):
+            future = Future()
+            future.set_result(_outcome(timezone.now(), error=ValueError('task has no function')))
+        else:
+            future = self._submit(task['function'], task.get('config'))
+        future.add_done_callback(lambda f: self._done.put((message, run, f)))
+
+    def _apply_done(self, timeout=0):
+        """确认并记录已完成的任务, timeout>0时最多等待timeout秒直到有任务完成"""
+        while True:
+            try:
+                message, run, future = self._done.get(timeout=timeout) if timeout else self._done.get_nowait()
+            except queue_module.Empty:
+                return
+            timeout = 0
+            try:
+                state, _, end, result = future.result()
+            except Exception as e:
+                # 进程池的工作进程异常退出等执行器错误
+                state, _, end, result = _outcome(timezone.now(), error=e)
+            message.ack()
+            self.in_flight -= 1
+            self.processed += 1
+            if run['task']:
+                self._events.append(dict(run, state=state, time=end, result=result))
+
+    def flush(self, force=False):
+        if not self._events or (not force and len(self._events) < self.report_batch
+                                and monotonic() < self._next_report):
+            return
+        events, self._events = self._events, []
+        self._next_report = monotonic() + self.report_interval
+        try:
+            reports.apply([{key: value for key, value in event.items() if value is not None} for event in events])
+        except Exception:
+            logger.exception('report %s task events failed', len(events))
+
+    def run(self, max_tasks=None):
+        """消费直到stop被调用, 或者处理完max_tasks个任务"""
+        exchange = Exchange(name=self.queue.exchange.name, type=self.queue.exchange.type)
+        self._executor = create_executor(self.mode, self.concurrency)
+        self._next_report = monotonic() + self.report_interval
+        conn = Connection(self.queue.connection)
+        try:
+            channel = conn.channel()
+            kombu_queue = broker.build_queue(self.queue, exchange, channel=channel)
+            kombu_queue.declare()
+            consumer = Consumer(channel, queues=[kombu_queue], callbacks=[self._on_message], no_ack=False,
+                                prefetch_count=self.prefetch)
+            with consumer:
+                logger.info('worker consuming %s, mode %s, concurrency %s', self.queue, self.mode, self.concurrency)
+                while not self._stopping.is_set() and (max_tasks is None or self.processed < max_tasks):
+                    self._apply_done()
+                    if self.in_flight >= self.prefetch:
+                        # 预取的消息都在执行, broker不会再投递, 直接等待任务完成
+                        self._apply_done(self.poll_interval)
+                    else:
+                        try:
+                            conn.drain_events(timeout=self.poll_interval)
+                        except socket.timeout:
+                            pass
+                    self.flush()
+                consumer.cancel()
+                # 不再接收新消息, 等待已接收的任务执行完成并确认
+                while self.in_flight:
+                    self._apply_done(self.poll_interval)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._apply_done()
+            self.flush(force=True)
+            conn.release()
+        logger.info('worker stopped, %s tasks processed', self.processed)
+        return self.processed
+
+    def stop(self):
+        self._stopping.set()